@@ -0,0 +1,297 @@
+import re
+import sys
+import json
+import asyncio
+import argparse
+from datetime import datetime
+from itertools import count
+
+# Optional: only the asyncio pipeline needs them.
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+from settings import SETTINGS
+
+from cache_ms import write_cached_response
+
+from metrics_ms import PROFILE_MODES, add_counter, add_rows, measure_stage, profile_mode, profile_stage
+
+from query_ms import invalidate_ms_cache
+
+from model_ms import MS, MSChange, MS_KEY_COLUMNS, ms_partitioned, pg_database, pg_host, pg_password, pg_port, pg_user
+
+from msparser import LOGERR_IF_ENABLED, LOGINFO_IF_ENABLED, LOGVAR_IF_ENABLED, FULL_SYNC_FROM_DATE, SyncStats, \
+    add_upsert_outcomes, change_log_enabled, chunked, commit_batch_size, current_sync_id, diff_ms_snapshot, fetch_concurrency, fetch_page_size, \
+    fetch_retries, fetch_timeout, incremental_sync, keep_published_dates, load_ms_snapshot, mark_created_rows, \
+    ms_change_probe_query, ms_changes, \
+    ms_upsert_query, ms_upsert_rows, \
+    msbulletin_request, normalize_ms_items, outcome_sample_size, parse_published_date, run, sync_mode, \
+    track_published_date, update_ms_vulners, write_batch_size
+
+# SOURCE_FILE is read at sync time.
+import msparser
+
+ASYNC_PIPELINE = SETTINGS.get("async_pipeline", {})
+
+# Pages waiting to be normalized and record batches waiting to be written;
+# a full queue holds back the stage feeding it.
+async_queue_size = int(ASYNC_PIPELINE.get("queue_size", 8))
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_BACKOFF = 0.5
+
+# asyncpg takes at most 32767 parameters per statement.
+ASYNCPG_MAX_PARAMETERS = 32767
+
+STAGE_DONE = None
+
+
+def asyncpg_sql(sql):
+    # peewee renders psycopg2 placeholders (%s); asyncpg numbers them ($1).
+    position = count(1)
+    return re.sub(r"%s|%%", lambda match: "${}".format(next(position)) if match.group() == "%s" else "%", sql)
+
+def asyncpg_rows(rows):
+    # psycopg2 leaves the feed's ISO dates to Postgres to cast; asyncpg wants
+    # datetime objects for timestamp parameters. A date that does not parse
+    # falls back to now like "undefined" does in ms_upsert_rows, since one
+    # NULL would abort the whole batch on the NOT NULL column.
+    for row in rows.values():
+        if isinstance(row["published_date"], str):
+            published_date = parse_published_date(row["published_date"])
+            if published_date is None:
+                LOGERR_IF_ENABLED("[e] Unparseable published date {!r} for {}, using the current time".format(
+                    row["published_date"], row["cve_number"]))
+                published_date = datetime.utcnow()
+            row["published_date"] = published_date
+    return rows
+
+def asyncpg_connect():
+    return asyncpg.connect(
+        database=pg_database, user=pg_user, password=pg_password, host=pg_host, port=int(pg_port))
+
+
+async def fetch_page(session, url, page_number, from_date, to_date=None, recorder=None):
+    # One feed page as raw bytes, retried on connection errors and on the
+    # statuses msbulletin_session retries, with the same backoff.
+    headers, query = msbulletin_request(from_date, to_date, page_number, fetch_page_size)
+    attempt = 0
+    while True:
+        try:
+            async with session.post(url, headers=headers, data=json.dumps(query)) as response:
+                if response.status in RETRY_STATUSES and attempt < fetch_retries:
+                    raise aiohttp.ClientResponseError(
+                        response.request_info, response.history, status=response.status)
+                response.raise_for_status()
+                content = await response.read()
+            break
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            if attempt >= fetch_retries or (
+                    isinstance(ex, aiohttp.ClientResponseError) and ex.status not in RETRY_STATUSES):
+                raise
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+            attempt += 1
+    add_counter("bytes_downloaded", len(content))
+    if recorder is not None:
+        write_cached_response(content, recorder, page_number)
+    return content
+
+async def fetch_stage(session, url, from_date, pages, meta, recorder=None):
+    # Page 1 gives the total count, then fetch_concurrency workers fetch the
+    # rest and queue the pages in the order they arrive. Failed pages are
+    # logged and listed in meta["failed_pages"], as in iter_msbulletin_pages.
+    meta["failed_pages"] = []
+    try:
+        first_page = json.loads(await fetch_page(session, url, 1, from_date, recorder=recorder))
+    except Exception as ex:
+        LOGERR_IF_ENABLED("[e] Get an exception with MSBulletin download: {}".format(ex))
+        meta["failed_pages"].append(1)
+        await pages.put(STAGE_DONE)
+        return
+    meta["count"] = first_page.get("count", 0)
+    await pages.put(first_page)
+    page_numbers = iter(range(2, (meta["count"] + fetch_page_size - 1) // fetch_page_size + 1))
+
+    async def fetch_worker():
+        for page_number in page_numbers:
+            try:
+                content = await fetch_page(session, url, page_number, from_date, recorder=recorder)
+            except Exception as ex:
+                LOGERR_IF_ENABLED("[e] Get an exception with MSBulletin page {} download: {}".format(page_number, ex))
+                meta["failed_pages"].append(page_number)
+                continue
+            await pages.put(content)
+
+    await asyncio.gather(*[fetch_worker() for _ in range(fetch_concurrency)])
+    await pages.put(STAGE_DONE)
+
+async def normalize_stage(pages, batches, meta, snapshot, update_existing, stats):
+    # Parse, normalize and (with a snapshot) diff each page, then queue its
+    # records for the writer in write_batch_size batches. This is CPU work on
+    # the event loop: a page at a time, so fetches and writes are only held
+    # up for one page's worth of it.
+    while True:
+        page = await pages.get()
+        if page is STAGE_DONE:
+            break
+        with measure_stage("normalize"):
+            if not isinstance(page, dict):
+                page = json.loads(page)
+            details = list(track_published_date(page.get("details", []), meta))
+            records = normalize_ms_items(details)
+        add_rows("fetch", len(details))
+        add_rows("normalize", len(records))
+        if snapshot is not None:
+            with measure_stage("diff", len(records)):
+                inserts, updates, unchanged = diff_ms_snapshot(records, snapshot)
+            stats.add("skipped", len(unchanged), (record.cve_number for record in unchanged))
+            if update_existing:
+                records = inserts + updates
+            else:
+                stats.add("skipped", len(updates), (record.cve_number for record in updates))
+                records = inserts
+        for batch in chunked(records, write_batch_size):
+            await batches.put(batch)
+    await batches.put(STAGE_DONE)
+
+async def write_stage(connection, batches, update_existing, stats, sync_id=None):
+    # Upsert each batch with the statements upsert_ms_items_in_postgres sends
+    # (change log included), in transactions of at least commit_batch_size
+    # rows. An error or a cancel rolls back the open transaction.
+    max_rows = max(1, ASYNCPG_MAX_PARAMETERS // len(MS._meta.sorted_fields))
+    transaction = None
+    pending = 0
+    try:
+        while True:
+            batch = await batches.get()
+            if batch is STAGE_DONE:
+                break
+            rows = ms_upsert_rows(batch)
+            stats.add("skipped", len(batch) - len(rows))
+            if not rows:
+                continue
+            if transaction is None:
+                transaction = connection.transaction()
+                await transaction.start()
+            for part in chunked(list(rows.items()), max_rows):
+                part = asyncpg_rows(dict(part))
+                old_rows = dict()
+                if ms_partitioned or (change_log_enabled and update_existing):
+                    sql, params = ms_change_probe_query(part).sql()
+                    old_rows = dict(
+                        (tuple(row[:len(MS_KEY_COLUMNS)]), tuple(row))
+                        for row in await connection.fetch(asyncpg_sql(sql), *params))
+                    add_counter("db_round_trips", 1)
+                    if ms_partitioned:
+                        keep_published_dates(part, old_rows)
+                sql, params = ms_upsert_query(part, update_existing).sql()
+                returned = [tuple(row) for row in await connection.fetch(asyncpg_sql(sql), *params)]
+                add_counter("db_round_trips", 1)
+                if ms_partitioned:
+                    returned = mark_created_rows(returned, old_rows)
+                add_upsert_outcomes(part, returned, stats)
+                if change_log_enabled and returned:
+                    sql, params = MSChange.insert_many(ms_changes(sync_id, part, old_rows, returned)).sql()
+                    await connection.execute(asyncpg_sql(sql), *params)
+                    add_counter("db_round_trips", 1)
+            add_rows("write", len(rows))
+            pending += len(rows)
+            if pending >= commit_batch_size:
+                await transaction.commit()
+                transaction = None
+                pending = 0
+                invalidate_ms_cache()
+        if transaction is not None:
+            await transaction.commit()
+            transaction = None
+            invalidate_ms_cache()
+    finally:
+        if transaction is not None and not connection.is_closed():
+            await transaction.rollback()
+
+async def run_stages(*stages):
+    # Run the stages together; when one fails the others are cancelled so
+    # none is left waiting on a queue, and the error is raised.
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def sync_ms_vulners_async(from_date, recorder=None, update_existing=True):
+    # fetch -> parse/normalize/diff -> write over bounded queues, with
+    # aiohttp for the feed and an asyncpg connection for the writes, so the
+    # network and the database work at the same time. Returns the feed meta
+    # update_ms_vulners returns.
+    feed_meta = dict()
+    stats = SyncStats(outcome_sample_size)
+    snapshot = None
+    if sync_mode == "snapshot":
+        with measure_stage("snapshot"):
+            snapshot = load_ms_snapshot()
+    pages = asyncio.Queue(maxsize=async_queue_size)
+    batches = asyncio.Queue(maxsize=async_queue_size)
+    connection = await asyncpg_connect()
+    try:
+        timeout = aiohttp.ClientTimeout(total=fetch_timeout)
+        connector = aiohttp.TCPConnector(limit=fetch_concurrency)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            await run_stages(
+                fetch_stage(session, msparser.SOURCE_FILE, from_date, pages, feed_meta, recorder),
+                normalize_stage(pages, batches, feed_meta, snapshot, update_existing, stats),
+                write_stage(connection, batches, update_existing, stats, current_sync_id()))
+    finally:
+        await connection.close()
+
+    feed_meta.update(created=stats.created, modified=stats.modified, skipped=stats.skipped)
+    LOGINFO_IF_ENABLED("[+] Create {} vulnerabilities".format(stats.created))
+    LOGINFO_IF_ENABLED("[+] Modify {} vulnerabilities".format(stats.modified))
+    LOGINFO_IF_ENABLED("[+] Skip   {} vulnerabilities".format(stats.skipped))
+    if stats.samples is not None:
+        for outcome in SyncStats.OUTCOMES:
+            LOGVAR_IF_ENABLED("[+] {} sample: {}".format(outcome.capitalize(), list(stats.samples[outcome])))
+    LOGINFO_IF_ENABLED("[+] Get {} vulnerabilities from MS database".format(
+        feed_meta.get("count", feed_meta.get("fetched", 0))))
+    if not feed_meta.get("fetched"):
+        LOGERR_IF_ENABLED("[e] Get empty data set from MS source")
+    return feed_meta
+
+def update_ms_vulners_async(from_date=FULL_SYNC_FROM_DATE, recorder=None, rebuild=False, checkpoint=None,
+                            force_rebuild=False):
+    # Drop-in for update_ms_vulners in run(). Rebuilds keep the COPY path,
+    # which already streams the feed into the staging table. The writer
+    # commits on its own connection, so runs are not checkpointed.
+    if rebuild:
+        return update_ms_vulners(from_date, recorder, rebuild, force_rebuild=force_rebuild)
+    if aiohttp is None or asyncpg is None:
+        raise RuntimeError("The asyncio pipeline needs the aiohttp and asyncpg packages")
+    # Time the stages spend waiting on each other goes to "pipeline".
+    with measure_stage("pipeline"):
+        return asyncio.run(sync_ms_vulners_async(from_date, recorder))
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync Microsoft security guidance into Postgres with asyncio")
+    parser.add_argument("--full", action="store_true", help="ignore the stored watermark and resync everything")
+    parser.add_argument("--force-rebuild", action="store_true",
+                        help="swap a rebuild in even when it has far fewer rows than the current table")
+    parser.add_argument("--profile", metavar="STAGE", default=profile_stage,
+                        help="profile one stage (snapshot, normalize, diff, pipeline, commit)")
+    parser.add_argument("--profile-mode", choices=PROFILE_MODES, default=profile_mode)
+    args = parser.parse_args()
+    report = run(full_sync=args.full or not incremental_sync, profile_stage=args.profile, profile_mode=args.profile_mode,
+                 update_vulners=update_ms_vulners_async, force_rebuild=args.force_rebuild)
+    if report["status"] != "success":
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
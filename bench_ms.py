@@ -0,0 +1,482 @@
+import sys
+import json
+import time
+import codecs
+import random
+import resource
+import argparse
+import platform
+import subprocess
+import tracemalloc
+import multiprocessing
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from copy_ms import rebuild_ms_table
+from model_ms import database, ms_fingerprint
+from msparser import SyncSession, FULL_SYNC_FROM_DATE, chunked, create_ms_table, diff_ms_snapshot, fetch_timeout, \
+    iter_json_field_items, load_ms_snapshot, msbulletin_request, msbulletin_session, normalize_ms_item, \
+    stream_chunk_size, undefined, upsert_ms_items_in_postgres, write_batch_size
+
+PRODUCTS = (
+    ("Windows", "Windows 10 Version 1803 for x64-based Systems", ""),
+    ("Windows", "Windows Server 2016", "Server Core installation"),
+    ("Browser", "Internet Explorer 11", "Windows 7 for 32-bit Systems Service Pack 1"),
+    ("Microsoft Office", "Microsoft Office 2016 (64-bit edition)", None),
+    ("Developer Tools", "Microsoft .NET Framework 4.7.2", "Windows 8.1 for x64-based systems"),
+    ("ESU", "Windows Server 2008 R2 for x64-based Systems Service Pack 1", ""),
+)
+
+IMPACTS = (
+    (1, "Remote Code Execution"),
+    (2, "Elevation of Privilege"),
+    (3, "Information Disclosure"),
+    (4, "Security Feature Bypass"),
+    (5, "Denial of Service"),
+)
+
+SEVERITIES = ((1, "Critical"), (2, "Important"), (3, "Moderate"), (4, "Low"), (None, ""))
+
+
+def make_details(count, seed=0):
+    return list(iter_details(count, seed))
+
+def iter_details(count, seed=0, start=0):
+    # Synthetic security-guidance details[] records with the same shape and
+    # roughly the same mix of empty, null and filled slots as the real feed.
+    rnd = random.Random(seed)
+    for position in range(start, start + count):
+        family, name, platform = rnd.choice(PRODUCTS)
+        impact_id, impact = rnd.choice(IMPACTS)
+        severity_id, severity = rnd.choice(SEVERITIES)
+        year = 2016 + position % 5
+        cve_number = "CVE-{}-{:05d}".format(year, position // 4)
+        knowledge_base_id = str(4000000 + position // 2)
+        item_in_details = {
+            "publishedDate": "{}-{:02d}-{:02d}T07:00:00".format(year, 1 + position % 12, 1 + position % 28),
+            "cveNumber": cve_number,
+            "cveUrl": "https://portal.msrc.microsoft.com/en-US/security-guidance/advisory/" + cve_number,
+            "name": name,
+            "platform": platform,
+            "family": family,
+            "impactId": impact_id,
+            "impact": impact,
+            "severityId": severity_id,
+            "severity": severity,
+            "knowledgeBaseId": knowledge_base_id,
+            "knowledgeBaseUrl": "https://support.microsoft.com/help/" + knowledge_base_id,
+            "monthlyKnowledgeBaseId": rnd.choice(("", None, str(4100000 + position // 8))),
+            "monthlyKnowledgeBaseUrl": rnd.choice(("", None, "https://support.microsoft.com/help/41")),
+        }
+        for slot in range(1, 5):
+            if rnd.random() < 0.6 / slot:
+                item_in_details["articleTitle{}".format(slot)] = "Security Update for {}".format(name)
+                item_in_details["articleUrl{}".format(slot)] = "https://support.microsoft.com/help/{}".format(knowledge_base_id)
+            if rnd.random() < 0.5 / slot:
+                item_in_details["downloadTitle{}".format(slot)] = rnd.choice(("Security Update", "Monthly Rollup", ""))
+                item_in_details["downloadUrl{}".format(slot)] = rnd.choice((
+                    "https://catalog.update.microsoft.com/v7/site/Search.aspx?q=KB" + knowledge_base_id,
+                    "Security Update", None))
+        yield item_in_details
+
+def change_details(details, change_ratio=0.05, new_ratio=0.01, seed=0):
+    # The next version of a feed: change_ratio of the records get a new
+    # impact/severity and new_ratio * len(details) new records are appended.
+    rnd = random.Random(seed + 1)
+    changed = list(details)
+    for position in rnd.sample(range(len(changed)), int(len(changed) * change_ratio)):
+        impact_id, impact = rnd.choice(IMPACTS)
+        changed[position] = dict(changed[position], impactId=impact_id, impact=impact + " (revised)")
+    changed.extend(iter_details(int(len(details) * new_ratio), seed + 2, start=len(details)))
+    return changed
+
+
+# The hand-written normalization that MS_FIELD_MAP replaced, kept as the
+# baseline for bench_normalize (including its inverted download_title1 check).
+def legacy_normalize_ms_item(item_in_details):
+    item_in_json = dict()
+
+    item_in_json["published_date"] = item_in_details.get("publishedDate", undefined)
+
+    item_in_json["cve_number"] = item_in_details.get("cveNumber", undefined)
+
+    item_in_json["cve_url"] = item_in_details.get("cveUrl", undefined)
+
+    item_in_json["name"] = item_in_details.get("name", undefined)
+
+    item_in_json["platform"] = item_in_details.get("platform", None)
+    if item_in_json["platform"] is None:
+        item_in_json["platform"] = undefined
+
+    item_in_json["family"] = item_in_details.get("family", None)
+    if item_in_json["family"] is None or item_in_json["family"] == "":
+        item_in_json["family"] = undefined
+
+    item_in_json["impact_id"] = item_in_details.get("impactId", None)
+    if item_in_json["impact_id"] is None or item_in_json["impact_id"] == "":
+        item_in_json["impact_id"] = undefined
+
+    item_in_json["impact"] = item_in_details.get("impact", None)
+    if item_in_json["impact"] is None or item_in_json["impact"] == "":
+        item_in_json["impact"] = undefined
+
+    item_in_json["severity_id"] = item_in_details.get("severityId", None)
+    if item_in_json["severity_id"] is None or item_in_json["severity_id"] == "":
+        item_in_json["severity_id"] = undefined
+
+    item_in_json["severity"] = item_in_details.get("severity", None)
+    if item_in_json["severity"] is None or item_in_json["severity"] == "":
+        item_in_json["severity"] = undefined
+
+    item_in_json["knowledge_base_id"] = item_in_details.get("knowledgeBaseId", None)
+    if item_in_json["knowledge_base_id"] is None or item_in_json["knowledge_base_id"] == "":
+        item_in_json["knowledge_base_id"] = undefined
+
+    item_in_json["knowledge_base_url"] = item_in_details.get("knowledgeBaseUrl", None)
+    if item_in_json["knowledge_base_url"] is None or ' ' in item_in_json["knowledge_base_url"]:
+        item_in_json["knowledge_base_url"] = undefined
+
+    item_in_json["monthly_knowledge_base_id"] = item_in_details.get("monthlyKnowledgeBaseId", None)
+    if item_in_json["monthly_knowledge_base_id"] is None or item_in_json["monthly_knowledge_base_id"] == "":
+        item_in_json["monthly_knowledge_base_id"] = undefined
+
+    item_in_json["monthly_knowledge_base_url"] = item_in_details.get("monthlyKnowledgeBaseUrl", None)
+    if item_in_json["monthly_knowledge_base_url"] is None or ' 'in item_in_json["monthly_knowledge_base_url"]:
+        item_in_json["monthly_knowledge_base_url"] = undefined
+
+    item_in_json["article_title1"] = item_in_details.get("articleTitle1", None)
+    if item_in_json["article_title1"] is None or item_in_json["article_title1"] == "":
+        item_in_json["article_title1"] = undefined
+
+    item_in_json["article_url1"] = item_in_details.get("articleUrl1", None)
+    if item_in_json["article_url1"] is None or ' ' in item_in_json["article_url1"]:
+        item_in_json["article_url1"] = undefined
+
+    item_in_json["article_title2"] = item_in_details.get("articleTitle2", None)
+    if item_in_json["article_title2"] is None or item_in_json["article_title2"] == "":
+        item_in_json["article_title2"] = undefined
+
+    item_in_json["article_url2"] = item_in_details.get("articleUrl2", None)
+    if item_in_json["article_url2"] is None or ' ' in item_in_json["article_url2"]:
+        item_in_json["article_url2"] = undefined
+
+    item_in_json["article_title3"] = item_in_details.get("articleTitle3", None)
+    if item_in_json["article_title3"] is None or item_in_json["article_title3"] == "":
+        item_in_json["article_title3"] = undefined
+
+    item_in_json["article_url3"] = item_in_details.get("articleUrl3", None)
+    if item_in_json["article_url3"] is None or ' ' in item_in_json["article_url3"]:
+        item_in_json["article_url3"] = undefined
+
+    item_in_json["article_title4"] = item_in_details.get("articleTitle4", None)
+    if item_in_json["article_title4"] is None or item_in_json["article_title4"] == "":
+        item_in_json["article_title4"] = undefined
+
+    item_in_json["article_url4"] = item_in_details.get("articleUrl4", None)
+    if item_in_json["article_url4"] is None or ' ' in item_in_json["article_url4"]:
+        item_in_json["article_url4"] = undefined
+
+    item_in_json["download_title1"] = item_in_details.get("downloadTitle1", None)
+    if item_in_json["download_title1"] is None or item_in_json["download_title1"]:
+        item_in_json["download_title1"] = undefined
+
+    item_in_json["download_url1"] = item_in_details.get("downloadUrl1", None)
+    if item_in_json["download_url1"] is None or ' ' in item_in_json["download_url1"]:
+        item_in_json["download_url1"] = undefined
+
+    item_in_json["download_title2"] = item_in_details.get("downloadTitle2", None)
+    if item_in_json["download_title2"] is None or item_in_json["download_title2"] == "":
+        item_in_json["download_title2"] = undefined
+
+    item_in_json["download_url2"] = item_in_details.get("downloadUrl2", None)
+    if item_in_json["download_url2"] is None or ' ' in item_in_json["download_url2"]:
+        item_in_json["download_url2"] = undefined
+
+    item_in_json["download_title3"] = item_in_details.get("downloadTitle3", None)
+    if item_in_json["download_title3"] is None or item_in_json["download_title3"] == "":
+        item_in_json["download_title3"] = undefined
+
+    item_in_json["download_url3"] = item_in_details.get("downloadUrl3", None)
+    if item_in_json["download_url3"] is None or ' ' in item_in_json["download_url3"]:
+        item_in_json["download_url3"] = undefined
+
+    item_in_json["download_title4"] = item_in_details.get("downloadTitle4", None)
+    if item_in_json["download_title4"] is None or item_in_json["download_title4"] == "":
+        item_in_json["download_title4"] = undefined
+
+    item_in_json["download_url4"] = item_in_details.get("downloadUrl4", None)
+    if item_in_json["download_url4"] is None or ' ' in item_in_json["download_url4"]:
+        item_in_json["download_url4"] = undefined
+
+    return item_in_json
+
+
+def legacy_normalize_with_fingerprint(item_in_details):
+    item_in_json = legacy_normalize_ms_item(item_in_details)
+    item_in_json["fingerprint"] = ms_fingerprint(item_in_json)
+    return item_in_json
+
+def bench_normalize(details, repeat=3):
+    # Records/sec of the legacy normalizer (plus ms_fingerprint, so both
+    # produce the same record) against the compiled MS_FIELD_MAP.
+    results = dict()
+    for name, function in (
+            ("legacy", legacy_normalize_with_fingerprint),
+            ("compiled", normalize_ms_item)):
+        elapsed = time_call(lambda: [function(item_in_details) for item_in_details in details], repeat)
+        results[name] = {"seconds": round(elapsed, 4), "records_per_sec": int(len(details) / elapsed)}
+    return results
+
+def time_call(function, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    # Answers security-guidance queries like the MSRC portal: pageNumber and
+    # pageSize pick a slice of details, count is the full feed size.
+    details = []
+
+    def do_POST(self):
+        query = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        page_number = int(query.get("pageNumber", 1))
+        page_size = int(query.get("pageSize", 50000))
+        body = json.dumps({
+            "count": len(self.details),
+            "details": self.details[(page_number - 1) * page_size:page_number * page_size],
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve_feed(count, seed, change_ratio, new_ratio, ports):
+    FeedHandler.details = change_details(make_details(count, seed), change_ratio, new_ratio, seed)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FeedHandler)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+def start_feed_server(count, seed, change_ratio, new_ratio):
+    # The stand-in runs in its own process so serving pages does not compete
+    # with the measured phases for the GIL or show up in their memory.
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve_feed, args=(count, seed, change_ratio, new_ratio, ports), daemon=True)
+    process.start()
+    return process, "http://127.0.0.1:{}/".format(ports.get(timeout=600))
+
+def fetch_feed(url, page_size, concurrency):
+    # Raw page bodies, page 1 first to learn the count.
+    session = msbulletin_session(concurrency)
+
+    def get_page(page_number):
+        headers, query = msbulletin_request(FULL_SYNC_FROM_DATE, None, page_number, page_size)
+        post = session.post(url, headers=headers, data=json.dumps(query), timeout=fetch_timeout)
+        post.raise_for_status()
+        return post.content
+
+    first_page = get_page(1)
+    pages = (json.loads(first_page)["count"] + page_size - 1) // page_size
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return [first_page] + list(executor.map(get_page, range(2, pages + 1)))
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0), 1)
+
+
+def parse_pages(pages):
+    return [item for page in pages for item in json.loads(page)["details"]]
+
+def parse_pages_stream(pages):
+    parsed = 0
+    for page in pages:
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        chunks = (decoder.decode(page[offset:offset + stream_chunk_size])
+                  for offset in range(0, len(page), stream_chunk_size))
+        parsed += sum(1 for _ in iter_json_field_items(chunks, "details"))
+    return parsed
+
+
+class PhaseTimer(object):
+    # Collects {phase: {seconds, records, records_per_sec, rss_growth_mb, process_peak_rss_mb, ...}}.
+    # ru_maxrss only ever grows, so rss_growth_mb is how far the phase raised the
+    # process high-water mark (0 when an earlier phase already peaked higher) and
+    # process_peak_rss_mb is that mark once the phase is done.
+    # With trace_memory the Python heap peak of each phase is added as well.
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.phases = dict()
+
+    def run(self, name, function, records=None, **extra):
+        if self.trace_memory:
+            tracemalloc.start()
+        rss_before = peak_rss_mb()
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        phase = {"seconds": round(elapsed, 4)}
+        if self.trace_memory:
+            phase["peak_traced_mb"] = round(tracemalloc.get_traced_memory()[1] / 1e6, 1)
+            tracemalloc.stop()
+        count = records(result) if callable(records) else records
+        if count is not None:
+            phase["records"] = count
+            phase["records_per_sec"] = int(count / elapsed) if elapsed else None
+        phase["process_peak_rss_mb"] = peak_rss_mb()
+        phase["rss_growth_mb"] = round(phase["process_peak_rss_mb"] - rss_before, 1)
+        phase.update(extra)
+        self.phases[name] = phase
+        return result
+
+def bench_pipeline(count, change_ratio=0.05, new_ratio=0.01, seed=0, page_size=1000, concurrency=4,
+                   use_database=True, trace_memory=False):
+    # One run of the sync phases against a local feed stand-in:
+    #   rebuild   - COPY the baseline feed into vilnerabilities_ms
+    #   fetch     - download the changed feed page by page
+    #   parse     - json.loads of every page (the paged path)
+    #   parse_stream - the same pages through iter_json_field_items
+    #   normalize - normalize_ms_item over every record
+    #   snapshot  - load_ms_snapshot of the baseline table
+    #   diff      - diff_ms_snapshot in write_batch_size chunks
+    #   write     - upsert the inserts and updates in one SyncSession
+    timer = PhaseTimer(trace_memory)
+    process, url = start_feed_server(count, seed, change_ratio, new_ratio)
+    try:
+        if use_database:
+            # The tables the write phase needs besides MS itself (the change
+            # log, lookup tables), as a sync run creates them.
+            create_ms_table()
+            baseline = [normalize_ms_item(item_in_details) for item_in_details in iter_details(count, seed)]
+            timer.run("rebuild", partial(rebuild_ms_table, iter(baseline), min_ratio=0), records=len(baseline))
+            del baseline
+        pages = timer.run("fetch", partial(fetch_feed, url, page_size, concurrency), records=None)
+        timer.phases["fetch"]["bytes"] = sum(len(page) for page in pages)
+        timer.phases["fetch"]["pages"] = len(pages)
+    finally:
+        process.terminate()
+
+    # Inputs are bound with partial rather than closed over so that the del
+    # below actually releases them before the next phase is measured.
+    details = timer.run("parse", partial(parse_pages, pages), records=len)
+    timer.run("parse_stream", partial(parse_pages_stream, pages), records=lambda parsed: parsed)
+    del pages
+    records = timer.run("normalize", partial(list, map(normalize_ms_item, details)), records=len)
+    del details
+    if not use_database:
+        return timer.phases
+
+    snapshot = timer.run("snapshot", load_ms_snapshot, records=len)
+
+    def diff():
+        chunks = []
+        unchanged = 0
+        for chunk in chunked(records, write_batch_size):
+            inserts, updates, same = diff_ms_snapshot(chunk, snapshot)
+            unchanged += len(same)
+            chunks.append((inserts, updates))
+        return chunks, unchanged
+
+    chunks, unchanged = timer.run("diff", diff, records=len(records))
+    inserts = sum(len(chunk_inserts) for chunk_inserts, _ in chunks)
+    updates = sum(len(chunk_updates) for _, chunk_updates in chunks)
+    timer.phases["diff"].update(inserts=inserts, updates=updates, unchanged=unchanged)
+
+    def write():
+        created = modified = 0
+        with SyncSession() as session:
+            for chunk_inserts, chunk_updates in chunks:
+                if chunk_inserts or chunk_updates:
+                    chunk_created, chunk_modified, _ = upsert_ms_items_in_postgres(chunk_inserts + chunk_updates)
+                    created += chunk_created
+                    modified += chunk_modified
+            session.commit()
+        return created, modified
+
+    created, modified = timer.run("write", write, records=inserts + updates)
+    timer.phases["write"].update(created=created, modified=modified)
+    return timer.phases
+
+def source_version():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(previous, current):
+    # seconds(current) / seconds(previous) per run size and phase; above 1 is
+    # slower than before.
+    previous_runs = dict((run["records"], run["phases"]) for run in previous.get("runs", []))
+    ratios = dict()
+    for run in current["runs"]:
+        before = previous_runs.get(run["records"])
+        if before is None:
+            continue
+        ratios[str(run["records"])] = dict(
+            (name, round(phase["seconds"] / before[name]["seconds"], 3))
+            for name, phase in run["phases"].items()
+            if before.get(name, {}).get("seconds"))
+    return ratios
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the MS sync pipeline")
+    parser.add_argument("--records", type=int, nargs="+", default=[10000],
+                        help="feed sizes to run, e.g. 10000 100000 1000000")
+    parser.add_argument("--change-ratio", type=float, default=0.05, help="share of records changed between runs")
+    parser.add_argument("--new-ratio", type=float, default=0.01, help="share of new records between runs")
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3, help="repeats of the normalize micro-benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--database", help="Postgres database for the rebuild/snapshot/diff/write phases; "
+                                           "its vilnerabilities_ms table is replaced. Without it only the "
+                                           "fetch, parse and normalize phases run")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="record the Python heap peak of each phase (slows every phase down)")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--compare", help="results file of an earlier run to compare against")
+    args = parser.parse_args()
+    if args.database:
+        database.init(args.database)
+
+    results = {
+        "version": source_version(),
+        "python": platform.python_version(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {
+            "change_ratio": args.change_ratio, "new_ratio": args.new_ratio, "page_size": args.page_size,
+            "concurrency": args.concurrency, "seed": args.seed, "write_batch_size": write_batch_size,
+            "database": bool(args.database), "trace_memory": args.trace_memory,
+        },
+        "runs": [],
+    }
+    for count in args.records:
+        results["runs"].append({"records": count, "phases": bench_pipeline(
+            count, args.change_ratio, args.new_ratio, args.seed, args.page_size, args.concurrency,
+            use_database=bool(args.database), trace_memory=args.trace_memory)})
+    results["normalize"] = bench_normalize(make_details(min(args.records), args.seed), args.repeat)
+    if args.compare:
+        with open(args.compare) as previous_file:
+            results["compare"] = compare_results(json.load(previous_file), results)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
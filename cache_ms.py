@@ -0,0 +1,122 @@
+import os
+import json
+import gzip
+import time
+import uuid
+import hashlib
+from datetime import datetime
+
+from settings import SETTINGS
+
+CURRENT_PATH = os.path.dirname(os.path.realpath(__file__))
+
+CACHE = SETTINGS.get("cache", {})
+
+cache_enabled = bool(CACHE.get("enabled", True))
+cache_directory = CACHE.get("directory", os.path.join(CURRENT_PATH, "cache"))
+cache_max_age_days = float(CACHE.get("max_age_days", 7))
+cache_compress_level = int(CACHE.get("compress_level", 6))
+
+RESPONSES_DIRECTORY = "responses"
+SNAPSHOTS_DIRECTORY = "snapshots"
+
+
+def response_path(key):
+    return os.path.join(cache_directory, RESPONSES_DIRECTORY, key[:2], key + ".json.gz")
+
+def open_cached_response(key):
+    path = response_path(key)
+    if not os.path.exists(path):
+        raise FileNotFoundError("No cached response {} in {}".format(key, cache_directory))
+    return gzip.open(path, "rb")
+
+def tee_to_cache(chunks, recorder=None, order=0):
+    # Yield raw response chunks unchanged while writing them to the cache
+    # under the sha256 of the body. The entry only becomes visible once the
+    # whole body has been written; identical bodies share one file.
+    directory = os.path.join(cache_directory, RESPONSES_DIRECTORY)
+    os.makedirs(directory, exist_ok=True)
+    temporary_path = os.path.join(directory, uuid.uuid4().hex + ".tmp")
+    content_hash = hashlib.sha256()
+    try:
+        with gzip.open(temporary_path, "wb", compresslevel=cache_compress_level) as cached:
+            for chunk in chunks:
+                content_hash.update(chunk)
+                cached.write(chunk)
+                yield chunk
+        key = content_hash.hexdigest()
+        path = response_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            os.replace(temporary_path, path)
+        if recorder is not None:
+            recorder.add(order, key)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+def write_cached_response(content, recorder=None, order=0):
+    for _ in tee_to_cache([content], recorder, order):
+        pass
+
+
+class SnapshotRecorder(object):
+    # Collects the cache keys fetched during one run so the run can be
+    # replayed later from the cache alone.
+
+    def __init__(self):
+        self.entries = []
+
+    def add(self, order, key):
+        self.entries.append((order, key))
+
+    def save(self, **meta):
+        directory = os.path.join(cache_directory, SNAPSHOTS_DIRECTORY)
+        os.makedirs(directory, exist_ok=True)
+        name = datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+        manifest = dict(meta)
+        manifest["name"] = name
+        manifest["entries"] = [key for _, key in sorted(self.entries)]
+        temporary_path = os.path.join(directory, name + ".json.tmp")
+        with open(temporary_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(temporary_path, os.path.join(directory, name + ".json"))
+        return name
+
+
+def list_snapshots():
+    directory = os.path.join(cache_directory, SNAPSHOTS_DIRECTORY)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(filename[:-len(".json")] for filename in os.listdir(directory) if filename.endswith(".json"))
+
+def load_snapshot(name=None):
+    # The newest snapshot when no name is given.
+    snapshots = list_snapshots()
+    if not snapshots:
+        raise FileNotFoundError("No cached snapshots in {}".format(cache_directory))
+    if name is None:
+        name = snapshots[-1]
+    elif name not in snapshots:
+        raise FileNotFoundError("No cached snapshot {} in {}".format(name, cache_directory))
+    with open(os.path.join(cache_directory, SNAPSHOTS_DIRECTORY, name + ".json")) as manifest_file:
+        return json.load(manifest_file)
+
+def evict_cache(max_age_days=cache_max_age_days):
+    # Remove responses and snapshots older than max_age_days.
+    # Returns the number of files removed.
+    deadline = time.time() - max_age_days * 86400
+    removed = 0
+    for directory in (RESPONSES_DIRECTORY, SNAPSHOTS_DIRECTORY):
+        for root, _, filenames in os.walk(os.path.join(cache_directory, directory)):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                try:
+                    if os.path.getmtime(path) < deadline:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+    return removed
@@ -0,0 +1,249 @@
+from datetime import datetime
+
+from settings import SETTINGS
+
+from model_ms import MS, MSChange, CHANGE_COLUMNS, LOOKUP_REFS, MS_KEY_COLUMNS, add_search_vector, create_ms_lookup_tables, \
+    create_search_index, database, ms_partitioned, ms_row, search_index_name
+
+from partition_ms import create_brin_index, create_ms_partitions, is_partitioned, list_partitions, rename_partitions, \
+    split_default_partition
+
+undefined = SETTINGS.get("undefined", "undefined")
+
+# A rebuild that stages no rows, or fewer than this share of the live
+# table's rows, is not swapped in (0 swaps in whatever was staged).
+rebuild_min_ratio = float(SETTINGS.get("rebuild_min_ratio", 0.5))
+
+STAGING_SUFFIX = "_staging"
+
+# Backslash escapes of the COPY text format.
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+class RebuildRefusedError(Exception):
+    pass
+
+
+def array_literal(values):
+    # Postgres text[] input syntax, every element quoted.
+    elements = []
+    for value in values:
+        if value is None:
+            elements.append("NULL")
+        else:
+            elements.append('"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"')
+    return "{" + ",".join(elements) + "}"
+
+def copy_value(value):
+    if value is None:
+        return "\\N"
+    if isinstance(value, (list, tuple)):
+        value = array_literal(value)
+    elif isinstance(value, datetime):
+        value = value.isoformat()
+    elif not isinstance(value, str):
+        value = str(value)
+    # Most values need no escaping and the substring checks are much cheaper
+    # than translate.
+    if "\\" in value or "\t" in value or "\n" in value or "\r" in value:
+        return value.translate(COPY_ESCAPES)
+    return value
+
+
+class CopyReader(object):
+    # File-like object over an iterator of COPY lines, read by
+    # cursor.copy_expert in blocks so the feed is never held in memory.
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.pending = ""
+
+    def read(self, size=-1):
+        parts = [self.pending]
+        length = len(self.pending)
+        for line in self.lines:
+            parts.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
+        data = "".join(parts)
+        if size < 0:
+            self.pending = ""
+            return data
+        self.pending = data[size:]
+        return data[:size]
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def staging_model(table_name):
+    # MS under another table name. Same fields and layout; the indexes are
+    # generated with the staging model's name and renamed at swap time.
+    Meta = type("Meta", (object, ), {"table_name": table_name})
+    return type("MSStaging", (MS, ), {"Meta": Meta, "__module__": __name__})
+
+def copy_lines(records, columns, counter):
+    # One COPY text line per record; counter[0] counts them. Columns the
+    # records do not carry (modified_date) get the field default.
+    now = datetime.utcnow()
+    defaults = dict()
+    for field in MS._meta.sorted_fields:
+        if field.default is not None:
+            defaults[field.column_name] = field.default() if callable(field.default) else field.default
+    for record in records:
+        row = dict(defaults)
+        row.update(ms_row(record._asdict()))
+        if row["published_date"] == undefined:
+            row["published_date"] = now
+        counter[0] += 1
+        yield "\t".join([copy_value(row[column]) for column in columns]) + "\n"
+
+def carry_modified_dates(staging_table, table):
+    # Rows whose fingerprint did not change keep the live table's
+    # modified_date, so "changed since" exports after a rebuild stay small.
+    columns = set(column.name for column in database.get_columns(table))
+    if "modified_date" not in columns or "fingerprint" not in columns:
+        return
+    database.execute_sql(
+        "UPDATE {0} AS s SET modified_date = l.modified_date FROM {1} AS l "
+        "WHERE {2} AND s.fingerprint = l.fingerprint".format(
+            staging_table, table, " AND ".join("s.{0} = l.{0}".format(key) for key in MS_KEY_COLUMNS)))
+
+def rebuild_comparison(staging_table, table):
+    # Staging rows left joined with the live rows of the same natural key:
+    # with no live row (l.id IS NULL) a row is created, with another
+    # fingerprint it is modified. Returns (FROM clause, key match).
+    key_match = " AND ".join("s.{0} = l.{0}".format(key) for key in MS_KEY_COLUMNS)
+    return "FROM {} AS s LEFT JOIN {} AS l ON {}".format(staging_table, table, key_match), key_match
+
+def count_rebuild_changes(staging_table, table):
+    # The comparison of log_rebuild_changes without writing MSChange entries.
+    # Returns (created, modified, removed).
+    if not MS.table_exists():
+        return database.execute_sql("SELECT count(*) FROM {}".format(staging_table)).fetchone()[0], 0, 0
+    comparison, key_match = rebuild_comparison(staging_table, table)
+    created, modified = database.execute_sql(
+        "SELECT count(*) FILTER (WHERE l.id IS NULL), "
+        "count(*) FILTER (WHERE l.id IS NOT NULL AND s.fingerprint IS DISTINCT FROM l.fingerprint) " +
+        comparison).fetchone()
+    removed = database.execute_sql(
+        "SELECT count(*) FROM {0} AS l WHERE NOT EXISTS (SELECT 1 FROM {1} AS s WHERE {2})".format(
+            table, staging_table, key_match)).fetchone()[0]
+    return created, modified, removed
+
+def log_rebuild_changes(staging_table, table, sync_id=None):
+    # MSChange entries for a rebuild, against the live table it replaces:
+    # staging rows without a live row were created, rows with another
+    # fingerprint were modified (with the columns that differ), live rows
+    # without a staging row are removed by the swap. ms_id is the row's id in
+    # the table it is in after the swap (in the live table for removals).
+    # Returns (created, modified, removed).
+    change_table = MSChange._meta.table_name
+    insert = "INSERT INTO {} (sync_id, ms_id, cve_number, change, columns, changed) ".format(change_table)
+    if not MS.table_exists():
+        cursor = database.execute_sql(
+            insert + "SELECT %s, id, cve_number, 'created', '{{}}', now() FROM {} ORDER BY id".format(staging_table),
+            (sync_id, ))
+        return cursor.rowcount, 0, 0
+    live_columns = set(column.name for column in database.get_columns(table))
+    comparison, key_match = rebuild_comparison(staging_table, table)
+    differences = ", ".join(
+        "CASE WHEN s.{0} IS DISTINCT FROM l.{0} THEN '{1}' END".format(column, LOOKUP_REFS.get(column, column))
+        for column in CHANGE_COLUMNS if column in live_columns)
+    # The counts come back from the insert itself.
+    created, modified = database.execute_sql(
+        "WITH changes AS (" + insert +
+        "SELECT %s, s.id, s.cve_number, CASE WHEN l.id IS NULL THEN 'created' ELSE 'modified' END, "
+        "CASE WHEN l.id IS NULL THEN '{{}}'::TEXT[] ELSE array_remove(ARRAY[{0}]::TEXT[], NULL) END, now() "
+        "{1} WHERE l.id IS NULL OR s.fingerprint IS DISTINCT FROM l.fingerprint ORDER BY s.id RETURNING change) "
+        "SELECT count(*) FILTER (WHERE change = 'created'), count(*) FILTER (WHERE change = 'modified') "
+        "FROM changes".format(differences, comparison),
+        (sync_id, )).fetchone()
+    cursor = database.execute_sql(
+        insert + "SELECT %s, l.id, l.cve_number, 'removed', '{{}}', now() FROM {0} AS l "
+                 "WHERE NOT EXISTS (SELECT 1 FROM {1} AS s WHERE {2}) ORDER BY l.id".format(
+                     table, staging_table, key_match),
+        (sync_id, ))
+    return created, modified, cursor.rowcount
+
+def rebuild_ms_table(records, complete=None, change_log=False, sync_id=None, min_ratio=rebuild_min_ratio):
+    # Full rebuild of MS: COPY the records into a staging table, drop natural
+    # key duplicates (the last one in the feed wins, as with the upsert),
+    # build the indexes, then swap the staging table in under the live name in
+    # one transaction. Readers see the old table until the swap commits. A
+    # partitioned staging table starts with the live table's partitions; rows
+    # outside them are split out of its default partition after the load.
+    # complete() is asked once the records are loaded; when it returns False
+    # the staging table is dropped and the live one kept. With change_log the
+    # differences go to MSChange in the swap transaction. A staging table
+    # with no rows or with fewer than min_ratio times the live table's rows
+    # is dropped and RebuildRefusedError raised. Returns (loaded,
+    # duplicates, (created, modified, removed)) against the table it
+    # replaced, or None when nothing was swapped in.
+    table = MS._meta.table_name
+    staging_table = table + STAGING_SUFFIX
+    Staging = staging_model(staging_table)
+    columns = [field.column_name for field in MS._meta.sorted_fields if field.name != "id"]
+    counter = [0]
+
+    create_ms_lookup_tables()
+    database.execute_sql("DROP TABLE IF EXISTS {}".format(staging_table))
+    try:
+        # The serial primary key is kept during the load: ids arrive in
+        # order, so it only ever appends to its index.
+        Staging._schema.create_table(safe=False)
+        add_search_vector(staging_table)
+        if ms_partitioned:
+            live_starts = [start for _, start in list_partitions(table)] if is_partitioned(table) else []
+            create_ms_partitions(staging_table, live_starts)
+        with database.atomic():
+            cursor = database.cursor()
+            cursor.copy_expert(
+                "COPY {} ({}) FROM STDIN".format(staging_table, ", ".join(columns)),
+                CopyReader(copy_lines(records, columns, counter)))
+        if complete is not None and not complete():
+            database.execute_sql("DROP TABLE {}".format(staging_table))
+            return None
+        cursor = database.execute_sql(
+            "DELETE FROM {0} WHERE id IN (SELECT id FROM (SELECT id, row_number() OVER "
+            "(PARTITION BY {1} ORDER BY id DESC) AS position FROM {0}) AS ranked WHERE position > 1)".format(
+                staging_table, ", ".join(MS_KEY_COLUMNS)))
+        duplicates = cursor.rowcount
+        if min_ratio > 0:
+            staged = counter[0] - duplicates
+            live = database.execute_sql("SELECT count(*) FROM {}".format(table)).fetchone()[0] if MS.table_exists() else 0
+            if staged == 0 or staged < live * min_ratio:
+                raise RebuildRefusedError("Staged {} rows against {} in {}, keep the current table".format(
+                    staged, live, table))
+        if ms_partitioned:
+            split_default_partition(staging_table)
+        if MS.table_exists():
+            carry_modified_dates(staging_table, table)
+        Staging._schema.create_indexes(safe=False)
+        create_search_index(staging_table)
+        if ms_partitioned:
+            create_brin_index(staging_table)
+        database.execute_sql("ANALYZE {}".format(staging_table))
+        sequence = database.execute_sql(
+            "SELECT pg_get_serial_sequence(%s, 'id')", (staging_table, )).fetchone()[0]
+
+        with database.atomic():
+            if change_log:
+                changes = log_rebuild_changes(staging_table, table, sync_id)
+            else:
+                changes = count_rebuild_changes(staging_table, table)
+            database.execute_sql("DROP TABLE IF EXISTS {}".format(table))
+            database.execute_sql("ALTER TABLE {} RENAME TO {}".format(staging_table, table))
+            database.execute_sql("ALTER TABLE {0} RENAME CONSTRAINT {1}_pkey TO {0}_pkey".format(table, staging_table))
+            database.execute_sql("ALTER SEQUENCE {} RENAME TO {}_id_seq".format(sequence, table))
+            for staging_index, index in zip(Staging._meta.fields_to_index(), MS._meta.fields_to_index()):
+                database.execute_sql("ALTER INDEX {} RENAME TO {}".format(staging_index._name, index._name))
+            database.execute_sql("ALTER INDEX {} RENAME TO {}".format(
+                search_index_name(staging_table), search_index_name(table)))
+            if ms_partitioned:
+                rename_partitions(table, staging_table)
+    except Exception:
+        database.execute_sql("DROP TABLE IF EXISTS {}".format(staging_table))
+        raise
+    return counter[0], duplicates, changes
@@ -0,0 +1,279 @@
+import re
+import sys
+import argparse
+import threading
+from queue import Empty, Queue
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from bs4 import BeautifulSoup
+
+# Optional: only the browser fallback needs it.
+try:
+    from selenium import webdriver
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait
+except ImportError:
+    webdriver = None
+
+from settings import SETTINGS
+
+from model_ms import MS, MSEnrichment, database
+
+from msparser import LOGERR_IF_ENABLED, LOGINFO_IF_ENABLED, LOGVAR_IF_ENABLED, chunked, connect_database, \
+    disconnect_database, msbulletin_session
+
+ENRICH = SETTINGS.get("enrich", {})
+
+enrich_detail_url = ENRICH.get("detail_url", "https://portal.msrc.microsoft.com/en-US/security-guidance/advisory/{}")
+enrich_concurrency = int(ENRICH.get("concurrency", 8))
+# Advisories checked more recently than this are not requested again.
+enrich_refresh_hours = float(ENRICH.get("refresh_hours", 24))
+enrich_timeout = float(ENRICH.get("timeout", 30))
+# Fall back to headless Chrome for pages that only render with JavaScript.
+enrich_browser = bool(ENRICH.get("browser", False))
+enrich_browser_pool_size = int(ENRICH.get("browser_pool_size", 2))
+enrich_eula_url = ENRICH.get("eula_url", "https://portal.msrc.microsoft.com/en-US/eula")
+
+ENRICH_WRITE_BATCH_SIZE = 100
+
+ENRICH_FIELDS = ("title", "published", "last_updated", "faq", "acknowledgements", "disclaimer")
+
+# Page headings and the field the text under them goes to.
+SECTION_HEADINGS = {
+    "faq": "faq",
+    "frequently asked questions": "faq",
+    "acknowledgements": "acknowledgements",
+    "acknowledgments": "acknowledgements",
+    "disclaimer": "disclaimer",
+}
+HEADING_TAGS = ("h1", "h2", "h3", "h4")
+
+PAGE_DATE = r"\s*:?\s*([A-Z][a-z]{2,8}\.? \d{1,2}, \d{4}|\d{4}-\d{2}-\d{2}|\d{1,2}/\d{1,2}/\d{4})"
+PUBLISHED_PATTERN = re.compile(r"(?:Released|Published)" + PAGE_DATE)
+LAST_UPDATED_PATTERN = re.compile(r"(?:Last updated|Last modified|Updated)" + PAGE_DATE, re.IGNORECASE)
+
+
+def clear(message):
+    return re.sub(r"\s+", " ", message).strip()
+
+def parse_advisory_html(html):
+    # Advisory details from a rendered page: the first h1 is the title (a
+    # page without one has not been rendered, see enrich_advisory),
+    # FAQ / Acknowledgements / Disclaimer are the text between that heading
+    # and the next one, the dates are read from the page text. Missing parts
+    # are left empty.
+    soup = BeautifulSoup(html, "html.parser")
+    details = dict((field, "") for field in ENRICH_FIELDS)
+    title = soup.find("h1")
+    if title is not None:
+        details["title"] = clear(title.get_text(" "))
+    for heading in soup.find_all(HEADING_TAGS):
+        field = SECTION_HEADINGS.get(clear(heading.get_text(" ")).rstrip(":").lower())
+        if field is None or details[field]:
+            continue
+        parts = []
+        for sibling in heading.find_next_siblings():
+            if sibling.name in HEADING_TAGS:
+                break
+            parts.append(sibling.get_text(" "))
+        details[field] = clear(" ".join(parts))
+    text = clear(soup.get_text(" "))
+    for field, pattern in (("published", PUBLISHED_PATTERN), ("last_updated", LAST_UPDATED_PATTERN)):
+        match = pattern.search(text)
+        if match:
+            details[field] = match.group(1)
+    return details
+
+
+class BrowserPool(object):
+    # Up to `size` headless Chrome sessions shared by the enrichment workers.
+    # A session is started on first use, accepts the EULA once and is then
+    # reused for every page it is handed; pages are awaited by their h1
+    # rather than by fixed sleeps.
+
+    def __init__(self, size=enrich_browser_pool_size, timeout=enrich_timeout):
+        if webdriver is None:
+            raise RuntimeError("The browser fallback needs the selenium package")
+        self.size = size
+        self.timeout = timeout
+        self.idle = Queue()
+        self.drivers = []
+        self.started = 0
+        self.lock = threading.Lock()
+
+    def new_driver(self):
+        options = webdriver.ChromeOptions()
+        options.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
+        options.add_argument("--headless")
+        driver = webdriver.Chrome(options=options)
+        driver.set_page_load_timeout(self.timeout)
+        driver.get(enrich_eula_url)
+        wait = WebDriverWait(driver, self.timeout)
+        wait.until(EC.element_to_be_clickable((By.CSS_SELECTOR, "input[type=checkbox]"))).click()
+        wait.until(EC.element_to_be_clickable((By.CSS_SELECTOR, "input[type=submit], button[type=submit]"))).click()
+        return driver
+
+    @contextmanager
+    def session(self):
+        try:
+            driver = self.idle.get_nowait()
+        except Empty:
+            with self.lock:
+                start = self.started < self.size
+                if start:
+                    self.started += 1
+            if not start:
+                driver = self.idle.get()
+            else:
+                try:
+                    driver = self.new_driver()
+                except Exception:
+                    with self.lock:
+                        self.started -= 1
+                    raise
+                self.drivers.append(driver)
+        try:
+            yield driver
+        finally:
+            self.idle.put(driver)
+
+    def page_source(self, url):
+        with self.session() as driver:
+            driver.get(url)
+            WebDriverWait(driver, self.timeout).until(EC.presence_of_element_located((By.TAG_NAME, "h1")))
+            return driver.page_source
+
+    def close(self):
+        for driver in self.drivers:
+            driver.quit()
+        self.drivers = []
+        self.started = 0
+
+
+def enrich_advisory(advisory_id, stored, session, browser=None, detail_url=enrich_detail_url):
+    # Fetch one advisory. The stored row's Last-Modified is sent as
+    # If-Modified-Since; a 304, or a page whose Last-Modified or "last
+    # updated" date matches the stored one, counts as unchanged and returns
+    # None. Pages the plain request does not yield a title for are rendered
+    # through the browser pool when there is one.
+    url = detail_url.format(advisory_id)
+    headers = dict()
+    if stored is not None and stored.last_modified:
+        headers["If-Modified-Since"] = stored.last_modified
+    response = session.get(url, headers=headers, timeout=enrich_timeout)
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()
+    last_modified = response.headers.get("Last-Modified", "")
+    if stored is not None and last_modified and last_modified == stored.last_modified:
+        return None
+    details = parse_advisory_html(response.text)
+    details["source"] = "http"
+    if not details["title"] and browser is not None:
+        details = parse_advisory_html(browser.page_source(url))
+        details["source"] = "browser"
+    if stored is not None and not last_modified and details["last_updated"] and \
+            details["last_updated"] == stored.last_updated:
+        return None
+    details.update(advisory_id=advisory_id, last_modified=last_modified)
+    return details
+
+def advisories_to_enrich(advisory_ids=None, refresh_hours=enrich_refresh_hours, limit=None):
+    # (advisory id, stored MSEnrichment or None) for the given ids, or for
+    # every MS.cve_number, leaving out those checked within refresh_hours.
+    if advisory_ids is None:
+        advisory_ids = [row[0] for row in MS.select(MS.cve_number).distinct().order_by(MS.cve_number).tuples()]
+    stored = dict()
+    for chunk in chunked(advisory_ids, 1000):
+        for enrichment in MSEnrichment.select().where(MSEnrichment.advisory_id.in_(chunk)):
+            stored[enrichment.advisory_id] = enrichment
+    fresh_after = datetime.now() - timedelta(hours=refresh_hours)
+    pending = [
+        (advisory_id, stored.get(advisory_id)) for advisory_id in advisory_ids
+        if advisory_id not in stored or stored[advisory_id].checked < fresh_after
+    ]
+    return pending[:limit] if limit else pending
+
+def save_enrichments(rows, checked_ids):
+    # Upsert changed advisories and mark the unchanged ones as checked.
+    now = datetime.now()
+    with database.atomic():
+        if rows:
+            for row in rows:
+                row.update(checked=now, changed=now)
+            MSEnrichment.insert_many(rows).on_conflict(
+                conflict_target=[MSEnrichment.advisory_id],
+                preserve=[getattr(MSEnrichment, field) for field in rows[0] if field != "advisory_id"]
+            ).execute()
+        if checked_ids:
+            MSEnrichment.update(checked=now).where(MSEnrichment.advisory_id.in_(checked_ids)).execute()
+
+def enrich_ms(advisory_ids=None, limit=None, concurrency=enrich_concurrency, use_browser=enrich_browser,
+              detail_url=enrich_detail_url, refresh_hours=enrich_refresh_hours):
+    # Enrich advisories with concurrency workers over one pooled HTTP session
+    # (and a browser pool when use_browser is set), writing the results in
+    # batches as they arrive. Returns (changed, unchanged, failed).
+    connect_database()
+    MSEnrichment.create_table(safe=True)
+    pending = advisories_to_enrich(advisory_ids, refresh_hours, limit)
+    LOGINFO_IF_ENABLED("[+] Enrich {} advisories".format(len(pending)))
+    session = msbulletin_session(concurrency)
+    browser = BrowserPool() if use_browser else None
+    changed = []
+    unchanged = []
+    totals = dict(changed=0, unchanged=0, failed=0)
+
+    def flush():
+        save_enrichments(changed, unchanged)
+        totals["changed"] += len(changed)
+        totals["unchanged"] += len(unchanged)
+        del changed[:], unchanged[:]
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = dict(
+                (executor.submit(enrich_advisory, advisory_id, stored, session, browser, detail_url), advisory_id)
+                for advisory_id, stored in pending)
+            for future in as_completed(futures):
+                try:
+                    details = future.result()
+                except Exception as ex:
+                    LOGERR_IF_ENABLED("[e] Get an exception with advisory {} enrichment: {}".format(futures[future], ex))
+                    totals["failed"] += 1
+                    continue
+                if details is None:
+                    unchanged.append(futures[future])
+                else:
+                    changed.append(details)
+                if len(changed) + len(unchanged) >= ENRICH_WRITE_BATCH_SIZE:
+                    flush()
+        flush()
+    finally:
+        if browser is not None:
+            browser.close()
+        disconnect_database()
+    LOGINFO_IF_ENABLED("[+] Enrich: {changed} changed, {unchanged} unchanged, {failed} failed".format(**totals))
+    return totals["changed"], totals["unchanged"], totals["failed"]
+
+def main():
+    parser = argparse.ArgumentParser(description="Collect advisory page details for vilnerabilities_ms")
+    parser.add_argument("advisory_ids", nargs="*", help="advisories to enrich (default: every MS cve_number)")
+    parser.add_argument("--limit", type=int, help="enrich at most this many advisories")
+    parser.add_argument("--concurrency", type=int, default=enrich_concurrency)
+    parser.add_argument("--browser", action="store_true", default=enrich_browser,
+                        help="render pages without a title through headless Chrome")
+    parser.add_argument("--detail-url", default=enrich_detail_url, help="advisory page URL template")
+    parser.add_argument("--refresh-hours", type=float, default=enrich_refresh_hours)
+    args = parser.parse_args()
+    changed, unchanged, failed = enrich_ms(
+        args.advisory_ids or None, args.limit, args.concurrency, args.browser, args.detail_url, args.refresh_hours)
+    LOGVAR_IF_ENABLED("[+] Enriched {} advisories".format(changed + unchanged))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import os
+import io
+import csv
+import sys
+import gzip
+import json
+import argparse
+from datetime import datetime, timedelta
+
+from settings import SETTINGS
+
+from query_ms import get_ms_change_cursor, get_ms_changes
+
+from model_ms import MS, FINGERPRINT_FIELDS, database, ms_column_sql
+
+EXPORT = SETTINGS.get("export", {})
+
+export_batch_size = int(EXPORT.get("batch_size", 5000))
+# Without --output exports go to <basename>.jsonl.gz or <basename>.csv.gz.
+export_basename = EXPORT.get("basename", "vilnerabilities_ms")
+# Without the change log, --state exports go by modified_date and re-read
+# this much before the stored one: parallel writers commit rows out of
+# modified_date order.
+export_since_overlap_seconds = float(EXPORT.get("since_overlap_seconds", 3600))
+
+CHANGE_LOG = SETTINGS.get("change_log", {})
+
+change_log_enabled = bool(CHANGE_LOG.get("enabled", True))
+
+# Logical columns, the same whichever slot storage MS uses.
+EXPORT_COLUMNS = ("id", "published_date") + FINGERPRINT_FIELDS + ("fingerprint", "modified_date")
+EXPORT_FORMATS = ("jsonl", "csv")
+
+SINCE_FORMATS = ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d")
+
+
+def parse_since(value):
+    for since_format in SINCE_FORMATS:
+        try:
+            return datetime.strptime(value, since_format)
+        except ValueError:
+            pass
+    raise ValueError("Cannot parse {!r}, expected one of {!r}".format(value, SINCE_FORMATS))
+
+def iter_ms_rows(since=None, batch_size=export_batch_size):
+    # Yield export rows as tuples in EXPORT_COLUMNS order. Pages are read by
+    # keyset: id for a full export, (modified_date, id) for rows changed
+    # after `since`; both are index scans, so every page costs the same and
+    # no transaction is held open across the export.
+    select = "SELECT {} FROM {}".format(
+        ", ".join(ms_column_sql(column) for column in EXPORT_COLUMNS), MS._meta.table_name)
+    modified_position = EXPORT_COLUMNS.index("modified_date")
+    last = None
+    while True:
+        if since is None:
+            if last is None:
+                sql, params = select + " ORDER BY id LIMIT %s", (batch_size, )
+            else:
+                sql, params = select + " WHERE id > %s ORDER BY id LIMIT %s", (last[0], batch_size)
+        elif last is None:
+            sql, params = select + " WHERE modified_date > %s ORDER BY modified_date, id LIMIT %s", (since, batch_size)
+        else:
+            sql = select + " WHERE (modified_date, id) > (%s, %s) ORDER BY modified_date, id LIMIT %s"
+            params = (last[modified_position], last[0], batch_size)
+        rows = database.execute_sql(sql, params).fetchall()
+        for row in rows:
+            yield row
+        if len(rows) < batch_size:
+            return
+        last = rows[-1]
+
+def iter_changed_ms_rows(cursor, batch_size=export_batch_size, position=None):
+    # Yield export rows for the MS ids of the change log entries after cursor
+    # (an MSChange id), a page of the log at a time through get_ms_changes,
+    # which holds back a running sync's entries until all of them are
+    # committed. Removed rows are gone from the table and left out; a row
+    # changed again in a later page is exported again. position[0] follows
+    # the last entry read.
+    select = "SELECT {} FROM {}".format(
+        ", ".join(ms_column_sql(column) for column in EXPORT_COLUMNS), MS._meta.table_name)
+    position = position if position is not None else [cursor]
+    position[0] = cursor
+    while True:
+        changes, position[0] = get_ms_changes(position[0], batch_size)
+        ids = sorted(set(change["ms_id"] for change in changes if change["change"] != "removed"))
+        if ids:
+            for row in database.execute_sql(select + " WHERE id = ANY(%s) ORDER BY id", (ids, )).fetchall():
+                yield row
+        if len(changes) < batch_size:
+            return
+
+def export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def write_jsonl(rows, output):
+    for row in rows:
+        output.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), default=export_value))
+        output.write("\n")
+
+def write_csv(rows, output):
+    writer = csv.writer(output)
+    writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        writer.writerow([export_value(value) for value in row])
+
+def export_ms(path, export_format="jsonl", since=None, batch_size=export_batch_size, after_change=None):
+    # Write MS (or the rows modified after `since`, or the rows of the change
+    # log entries after the after_change cursor) to path, gzip-compressed
+    # when it ends with .gz. The file appears under its name only once it is
+    # complete. Returns (rows, highest modified_date exported), or with
+    # after_change (rows, change cursor to pass next time).
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format {!r}, expected one of {!r}".format(export_format, EXPORT_FORMATS))
+    modified_position = EXPORT_COLUMNS.index("modified_date")
+    exported = [0, since]
+    position = [after_change]
+
+    def counted(rows):
+        for row in rows:
+            exported[0] += 1
+            if exported[1] is None or row[modified_position] > exported[1]:
+                exported[1] = row[modified_position]
+            yield row
+
+    temporary_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        if path.endswith(".gz"):
+            output = gzip.open(temporary_path, "wt", encoding="utf-8", newline="")
+        else:
+            output = io.open(temporary_path, "w", encoding="utf-8", newline="")
+        with output:
+            if after_change is not None:
+                rows = counted(iter_changed_ms_rows(after_change, batch_size, position))
+            else:
+                rows = counted(iter_ms_rows(since, batch_size))
+            if export_format == "jsonl":
+                write_jsonl(rows, output)
+            else:
+                write_csv(rows, output)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    if after_change is not None:
+        return exported[0], position[0]
+    return exported[0], exported[1]
+
+def read_export_state(path):
+    # {"change_id": cursor} or, from exports without the change log,
+    # {"modified_date": ISO time}; empty before the first export.
+    if not os.path.exists(path):
+        return dict()
+    with open(path) as state_file:
+        return json.load(state_file)
+
+def write_export_state(path, **state):
+    temporary_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary_path, "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(temporary_path, path)
+
+def default_export_path(export_format):
+    return "{}.{}.gz".format(export_basename, export_format)
+
+def main():
+    parser = argparse.ArgumentParser(description="Export vilnerabilities_ms to JSON Lines or CSV")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="jsonl")
+    parser.add_argument("--output", help="target file, gzip-compressed when it ends with .gz "
+                                         "(default: export.basename as .jsonl.gz / .csv.gz)")
+    parser.add_argument("--since", help="only rows whose modified_date is after this time (YYYY-MM-DD[THH:MM:SS])")
+    parser.add_argument("--after-change", type=int, metavar="ID",
+                        help="only rows of the change log entries after this MSChange id")
+    parser.add_argument("--state", help="file holding the change log cursor (or, without the change log, the "
+                                        "last exported modified_date): exports after it when present and is "
+                                        "advanced after a successful export")
+    parser.add_argument("--batch-size", type=int, default=export_batch_size)
+    args = parser.parse_args()
+
+    since = parse_since(args.since) if args.since else None
+    after_change = args.after_change
+    if args.state and since is None and after_change is None:
+        state = read_export_state(args.state)
+        after_change = state.get("change_id")
+        if after_change is None and state.get("modified_date"):
+            since = parse_since(state["modified_date"]) - timedelta(seconds=export_since_overlap_seconds)
+    # Taken before a full or modified_date export, so no change committed
+    # during it is missed by the next one.
+    cursor = get_ms_change_cursor() if args.state and change_log_enabled and after_change is None else None
+    path = args.output or default_export_path(args.format)
+    rows, last = export_ms(path, args.format, since, args.batch_size, after_change)
+    if args.state:
+        if after_change is not None:
+            write_export_state(args.state, change_id=last)
+        elif cursor is not None:
+            write_export_state(args.state, change_id=cursor)
+        elif last is not None:
+            write_export_state(args.state, modified_date=last.isoformat())
+    sys.stderr.write("Exported {} rows to {}\n".format(rows, path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import resource
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+from settings import SETTINGS
+
+from model_ms import database
+
+CURRENT_PATH = os.path.dirname(os.path.realpath(__file__))
+
+METRICS = SETTINGS.get("metrics", {})
+
+metrics_enabled = bool(METRICS.get("enabled", True))
+metrics_json_file = METRICS.get("json_file", os.path.join(CURRENT_PATH, "metrics", "msbulletin_sync.json"))
+# node_exporter textfile collector target, e.g.
+# /var/lib/node_exporter/textfile_collector/msbulletin_sync.prom; empty to skip.
+metrics_textfile = METRICS.get("textfile", "")
+profile_stage = METRICS.get("profile_stage", None)
+profile_mode = METRICS.get("profile_mode", "cprofile")
+profile_directory = METRICS.get("profile_directory", os.path.join(CURRENT_PATH, "metrics", "profiles"))
+
+PROFILE_MODES = ("cprofile", "tracemalloc")
+PROMETHEUS_PREFIX = "msbulletin_sync"
+
+# The SyncMetrics of the run in progress; the helpers below do nothing
+# while it is None.
+active_metrics = None
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class SyncMetrics(object):
+    # Wall time, rows, DB round trips and RSS growth per pipeline stage.
+    # Stages are timed exclusively: when one stage pulls records from another
+    # (normalize from fetch, write from normalize) the time goes to the stage
+    # doing the work. Only the thread that runs the pipeline is timed; bytes
+    # and round trips are counted from any thread.
+    #
+    # With profile_stage set, that stage alone runs under cProfile, or under
+    # tracemalloc for its allocation peak and the top allocation sites.
+    # cProfile only sees the pipeline thread, not the page fetch workers.
+    #
+    # RSS growth is how far the process peak RSS rose while the stage ran,
+    # so the stages add up to the growth of the whole run instead of each
+    # reporting the process-wide peak.
+
+    def __init__(self, source, profile_stage=profile_stage, profile_mode=profile_mode):
+        if profile_stage and profile_mode not in PROFILE_MODES:
+            raise ValueError("Unknown profile mode {!r}, expected one of {!r}".format(profile_mode, PROFILE_MODES))
+        self.source = source
+        self.stages = dict()
+        self.counters = dict(bytes_downloaded=0, db_round_trips=0)
+        self.stack = []
+        self.mark = None
+        self.started = None
+        self.finished = None
+        self.lock = threading.Lock()
+        self.thread = None
+        self.profile_stage = profile_stage
+        self.profile_mode = profile_mode
+        self.profiler = None
+        self.profile_peak = 0
+        self.profile_snapshot_peak = 0
+        self.profile_files = []
+        self.rss_mark = 0
+
+    def __enter__(self):
+        global active_metrics
+        self.started = time.time()
+        self.thread = threading.current_thread()
+        self.mark = time.perf_counter()
+        execute_sql = database.execute_sql
+
+        def counting_execute_sql(*args, **kwargs):
+            self.round_trip()
+            return execute_sql(*args, **kwargs)
+
+        database.execute_sql = counting_execute_sql
+        active_metrics = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global active_metrics
+        active_metrics = None
+        del database.execute_sql
+        while self.stack:
+            self.exit()
+        self.finished = time.time()
+        if self.profile_stage:
+            self.save_profile()
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = dict(seconds=0.0, rows=0, db_round_trips=0, rss_growth_bytes=0)
+        return self.stages[name]
+
+    def enter(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            self.pause(self.stack[-1], now)
+        else:
+            self.rss_mark = peak_rss_bytes()
+        self.stack.append(name)
+        self.resume(name, now)
+
+    def exit(self):
+        now = time.perf_counter()
+        self.pause(self.stack.pop(), now)
+        if self.stack:
+            self.resume(self.stack[-1], now)
+
+    def pause(self, name, now):
+        stage = self.stage(name)
+        stage["seconds"] += now - self.mark
+        # Sampled on every pause, not throttled: growth left unsampled would
+        # go to whichever stage pauses next. getrusage is under a microsecond.
+        peak = peak_rss_bytes()
+        stage["rss_growth_bytes"] += peak - self.rss_mark
+        self.rss_mark = peak
+        if name == self.profile_stage:
+            self.stop_profile()
+
+    def resume(self, name, now):
+        self.mark = now
+        if name == self.profile_stage:
+            self.start_profile()
+
+    def add_rows(self, name, rows):
+        self.stage(name)["rows"] += rows
+
+    def add_counter(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def round_trip(self):
+        with self.lock:
+            self.counters["db_round_trips"] += 1
+            if self.stack and threading.current_thread() is self.thread:
+                self.stage(self.stack[-1])["db_round_trips"] += 1
+
+    def start_profile(self):
+        if self.profile_mode == "cprofile":
+            if self.profiler is None:
+                self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+
+    def stop_profile(self):
+        if self.profile_mode == "cprofile":
+            self.profiler.disable()
+            return
+        # The allocation sites are snapshotted whenever the stage's peak has
+        # grown by a tenth, so the saved one is close to its high-water mark
+        # without a snapshot per call.
+        self.profile_peak = max(self.profile_peak, tracemalloc.get_traced_memory()[1])
+        if self.profile_peak > self.profile_snapshot_peak * 1.1:
+            self.profiler = tracemalloc.take_snapshot()
+            self.profile_snapshot_peak = self.profile_peak
+
+    def save_profile(self):
+        # <stage>-<timestamp>.prof (pstats) plus a .txt summary for cProfile,
+        # a .txt of the top allocation sites for tracemalloc.
+        if self.profiler is None:
+            return
+        os.makedirs(profile_directory, exist_ok=True)
+        name = os.path.join(profile_directory, "{}-{}".format(
+            self.profile_stage, time.strftime("%Y%m%dT%H%M%S", time.gmtime(self.started))))
+        if self.profile_mode == "cprofile":
+            self.profiler.dump_stats(name + ".prof")
+            with open(name + ".txt", "w") as summary:
+                pstats.Stats(self.profiler, stream=summary).sort_stats("cumulative").print_stats(40)
+            self.profile_files = [name + ".prof", name + ".txt"]
+        else:
+            tracemalloc.stop()
+            with open(name + ".txt", "w") as summary:
+                summary.write("peak traced memory in {}: {} bytes; allocations live near that peak:\n".format(
+                    self.profile_stage, self.profile_peak))
+                for statistic in self.profiler.statistics("lineno")[:40]:
+                    summary.write("{}\n".format(statistic))
+            self.profile_files = [name + ".txt"]
+
+    def to_json(self, **result):
+        stages = dict()
+        for name, stage in self.stages.items():
+            stages[name] = dict(stage)
+            stages[name]["seconds"] = round(stage["seconds"], 4)
+            stages[name]["rows_per_sec"] = round(stage["rows"] / stage["seconds"], 1) if stage["seconds"] else 0.0
+        data = dict(
+            source=self.source,
+            started=self.started,
+            finished=self.finished,
+            seconds=round((self.finished or time.time()) - self.started, 4),
+            peak_rss_bytes=peak_rss_bytes(),
+            stages=stages)
+        data.update(self.counters)
+        data.update(result)
+        if self.profile_files:
+            data["profile"] = dict(stage=self.profile_stage, mode=self.profile_mode, files=self.profile_files)
+        return data
+
+
+@contextmanager
+def measure_stage(name, rows=0):
+    metrics = active_metrics
+    if metrics is None:
+        yield
+        return
+    metrics.enter(name)
+    try:
+        yield
+    finally:
+        metrics.exit()
+        metrics.add_rows(name, rows)
+
+def measure_iter(name, iterable, count=None):
+    # Time spent producing each item goes to `name`; one row per item, or
+    # count(item) rows.
+    metrics = active_metrics
+    if metrics is None:
+        for item in iterable:
+            yield item
+        return
+    iterator = iter(iterable)
+    while True:
+        metrics.enter(name)
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            metrics.exit()
+        metrics.add_rows(name, 1 if count is None else count(item))
+        yield item
+
+def add_rows(name, rows):
+    if active_metrics is not None:
+        active_metrics.add_rows(name, rows)
+
+def add_counter(name, value):
+    if active_metrics is not None:
+        active_metrics.add_counter(name, value)
+
+
+def write_file(path, content):
+    # Write through a temporary file so readers (node_exporter) never see a
+    # partial file.
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary_path, "w") as output:
+        output.write(content)
+    os.replace(temporary_path, path)
+
+def prometheus_text(data):
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append("# HELP {}_{} {}".format(PROMETHEUS_PREFIX, name, help_text))
+        lines.append("# TYPE {}_{} {}".format(PROMETHEUS_PREFIX, name, kind))
+        for labels, value in samples:
+            label_text = ",".join('{}="{}"'.format(key, label) for key, label in sorted(labels.items()))
+            lines.append("{}_{}{} {}".format(
+                PROMETHEUS_PREFIX, name, "{" + label_text + "}" if label_text else "", value))
+
+    source = dict(source=data["source"])
+    metric("last_run_timestamp_seconds", "gauge", "Unix time the last sync finished.",
+           [(source, data["finished"] or data["started"])])
+    metric("success", "gauge", "1 when the last sync succeeded.", [(source, 1 if data.get("status") == "success" else 0)])
+    metric("duration_seconds", "gauge", "Wall time of the last sync.", [(source, data["seconds"])])
+    metric("bytes_downloaded", "gauge", "Response bytes read by the last sync.", [(source, data["bytes_downloaded"])])
+    metric("db_round_trips", "gauge", "Statements sent to Postgres by the last sync.", [(source, data["db_round_trips"])])
+    metric("peak_rss_bytes", "gauge", "Peak resident set size of the last sync.", [(source, data["peak_rss_bytes"])])
+    metric("records", "gauge", "Records of the last sync by outcome.", [
+        (dict(source, outcome=outcome), data.get(outcome, 0)) for outcome in ("fetched", "created", "modified", "skipped")])
+    stages = sorted(data["stages"].items())
+    for field, help_text in (
+            ("seconds", "Wall time spent in each stage of the last sync."),
+            ("rows", "Rows handled by each stage of the last sync."),
+            ("rows_per_sec", "Rows per second of each stage of the last sync."),
+            ("db_round_trips", "Statements sent to Postgres from each stage of the last sync."),
+            ("rss_growth_bytes", "Growth of the peak resident set size while each stage of the last sync ran.")):
+        metric("stage_" + field, "gauge", help_text, [(dict(source, stage=name), stage[field]) for name, stage in stages])
+    return "\n".join(lines) + "\n"
+
+def write_metrics(metrics, **result):
+    # Returns the JSON document that was written.
+    data = metrics.to_json(**result)
+    if metrics_json_file:
+        write_file(metrics_json_file, json.dumps(data, indent=2, default=str) + "\n")
+    if metrics_textfile:
+        write_file(metrics_textfile, prometheus_text(data))
+    return data
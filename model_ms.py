@@ -1,7 +1,11 @@
 import os
+import hashlib
+import threading
 import peewee
+from playhouse.pool import PooledPostgresqlDatabase
 from playhouse.postgres_ext import ArrayField
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from settings import SETTINGS
 
@@ -15,58 +19,209 @@ pg_default_port = POSTGRES.get("port", "5432")
 
 pg_drop_before = bool(POSTGRES.get("drop_pg_before", True))
 
+PG_POOL = POSTGRES.get("pool", {})
+
+pg_pool_enabled = bool(PG_POOL.get("enabled", False))
+pg_pool_max_connections = int(PG_POOL.get("max_connections", 8))
+pg_pool_stale_timeout = int(PG_POOL.get("stale_timeout", 300))
+
 pg_database = os.environ.get("PG_DATABASE", pg_default_database)
 pg_user = os.environ.get("PG_USER", pg_default_user)
 pg_password = os.environ.get("PG_PASS", pg_default_password)
 pg_host = os.environ.get("PG_HOST", pg_default_host)
 pg_port = os.environ.get("PG_PORT", pg_default_port)
 
-database = peewee.PostgresqlDatabase(
-    database=pg_database,
-    user=pg_user,
-    password=pg_password,
-    host=pg_host,
-    port=pg_port
+# Columns that identify one advisory row in the MSRC feed: a CVE fixed by a KB
+# for one product/platform pair. Used as the conflict target for upserts.
+NATURAL_KEY = ("cve_number", "knowledge_base_id", "name", "platform")
+
+# Columns hashed into MS.fingerprint. published_date is left out so that a
+# missing date (stored as the load time) does not register as a change.
+FINGERPRINT_FIELDS = (
+    "cve_number", "cve_url", "name", "platform", "family",
+    "impact_id", "impact", "severity_id", "severity",
+    "knowledge_base_id", "knowledge_base_url",
+    "monthly_knowledge_base_id", "monthly_knowledge_base_url",
+    "download_url1", "download_title1", "download_url2", "download_title2",
+    "download_url3", "download_title3", "download_url4", "download_title4",
+    "article_title1", "article_url1", "article_title2", "article_url2",
+    "article_title3", "article_url3", "article_title4", "article_url4",
 )
 
+FINGERPRINT_SEPARATOR = "\x1f"
+
+undefined = SETTINGS.get("undefined", "undefined")
+
+# "columns" keeps the four download/article slots as numbered text columns
+# (download_url1..4, ...); "arrays" stores each group as one text[] column
+# with trailing "undefined" slots dropped. The numbered attributes and
+# MS.to_json look the same either way.
+ms_slot_storage = SETTINGS.get("ms_slot_storage", "columns")
+
+SLOT_COUNT = 4
+SLOT_GROUPS = (
+    ("download_urls", "download_url"),
+    ("download_titles", "download_title"),
+    ("article_titles", "article_title"),
+    ("article_urls", "article_url"),
+)
+SLOT_COLUMNS = dict(
+    ("{}{}".format(prefix, position + 1), (array_name, position))
+    for array_name, prefix in SLOT_GROUPS
+    for position in range(SLOT_COUNT)
+)
+
+# "text" keeps the low-cardinality columns below as text on every row;
+# "lookup" stores each distinct value once in a lookup table of its own and
+# keeps its integer id in MS (family -> family_ref). The logical attributes,
+# MS.to_json and the natural key values look the same either way.
+ms_lookup_storage = SETTINGS.get("ms_lookup_storage", "text")
+
+LOOKUP_COLUMNS = ("platform", "family", "impact_id", "impact", "severity_id", "severity")
+
+
+def lookup_ref(column):
+    return column + "_ref"
+
+def ms_storage_column(column):
+    # MS table column holding a logical column in the configured layout.
+    if ms_lookup_storage == "lookup" and column in LOOKUP_COLUMNS:
+        return lookup_ref(column)
+    return column
+
+# NATURAL_KEY as stored: the key of upsert rows.
+MS_KEY_COLUMNS = tuple(ms_storage_column(column) for column in NATURAL_KEY)
+
+PARTITIONING = SETTINGS.get("partitioning", {})
+
+# Create MS as a table partitioned by published_date range (see
+# partition_ms). Unique indexes of a partitioned table must include
+# published_date, so it is added to the primary key and to the natural key
+# index; the upsert keeps the stored published_date of existing rows.
+ms_partitioned = bool(PARTITIONING.get("enabled", False))
+# Index on published_date of a partitioned table: "brin" (tiny, enough for
+# partitions filled roughly in date order) or "btree".
+ms_published_index = PARTITIONING.get("published_date_index", "brin") if ms_partitioned else "btree"
+
+# Columns of the unique index, the upsert conflict target.
+MS_UNIQUE_COLUMNS = MS_KEY_COLUMNS + ("published_date", ) if ms_partitioned else MS_KEY_COLUMNS
+
+if pg_pool_enabled:
+    database = PooledPostgresqlDatabase(
+        database=pg_database,
+        user=pg_user,
+        password=pg_password,
+        host=pg_host,
+        port=pg_port,
+        max_connections=pg_pool_max_connections,
+        stale_timeout=pg_pool_stale_timeout
+    )
+else:
+    database = peewee.PostgresqlDatabase(
+        database=pg_database,
+        user=pg_user,
+        password=pg_password,
+        host=pg_host,
+        port=pg_port
+    )
+
+
+def lookup_model(column):
+    # One lookup table per column: vilnerabilities_ms_lookup_<column>.
+    Meta = type("Meta", (object, ), {"database": database, "table_name": "vilnerabilities_ms_lookup_" + column})
+    return type("MSLookup" + column.title().replace("_", ""), (peewee.Model, ), {
+        "Meta": Meta,
+        "__module__": __name__,
+        "id": peewee.PrimaryKeyField(null=False),
+        "value": peewee.TextField(unique=True),
+    })
+
+LOOKUP_MODELS = dict((column, lookup_model(column)) for column in LOOKUP_COLUMNS)
+
+# Change records name the logical column, not its lookup reference.
+LOOKUP_REFS = dict((lookup_ref(column), column) for column in LOOKUP_COLUMNS)
+
+class PartitionedAutoField(peewee.AutoField):
+    # SERIAL id without a primary key of its own: a partitioned table has
+    # PRIMARY KEY (id, published_date) as a table constraint.
+    def ddl(self, ctx):
+        return peewee.NodeList((peewee.Entity(self.column_name), self.ddl_datatype(ctx), peewee.SQL("NOT NULL")))
+
+def lookup_field(column):
+    # Not indexed on its own: platform is in the natural key index and family
+    # in (family, published_date); the rest are too unselective to pay for.
+    return peewee.ForeignKeyField(LOOKUP_MODELS[column], column_name=lookup_ref(column), lazy_load=False, index=False)
+
 
 class MS(peewee.Model):
     class Meta:
         database = database
-        ordering = ("ms_id", )
         table_name = "vilnerabilities_ms"
+        indexes = (
+            (MS_UNIQUE_COLUMNS, True),
+            (("knowledge_base_id", ), False),
+            ((ms_storage_column("family"), "published_date"), False),
+            (("name", "published_date"), False),
+            (("modified_date", "id"), False),
+        )
+        if ms_published_index == "btree":
+            indexes += ((("published_date", ), False), )
+        if ms_partitioned:
+            # The BRIN index and the partitions are made by partition_ms.
+            constraints = [peewee.SQL("PRIMARY KEY (id, published_date)")]
+            table_settings = ["PARTITION BY RANGE (published_date)"]
 
-    id = peewee.PrimaryKeyField(null=False)
+    if ms_partitioned:
+        id = PartitionedAutoField()
+    else:
+        id = peewee.PrimaryKeyField(null=False)
     published_date = peewee.DateTimeField(default=datetime.now, verbose_name="Published date")
     cve_number = peewee.TextField(default="")
     cve_url = peewee.TextField(default="")
     name = peewee.TextField(default="")
-    platform = peewee.TextField(default="")
-    family = peewee.TextField(default="")
-    impact_id = peewee.TextField(default="")
-    impact = peewee.TextField(default="")
-    severity_id = peewee.TextField(default="")
-    severity = peewee.TextField(default="")
+    if ms_lookup_storage == "lookup":
+        platform_ref = lookup_field("platform")
+        family_ref = lookup_field("family")
+        impact_id_ref = lookup_field("impact_id")
+        impact_ref = lookup_field("impact")
+        severity_id_ref = lookup_field("severity_id")
+        severity_ref = lookup_field("severity")
+    else:
+        platform = peewee.TextField(default="")
+        family = peewee.TextField(default="")
+        impact_id = peewee.TextField(default="")
+        impact = peewee.TextField(default="")
+        severity_id = peewee.TextField(default="")
+        severity = peewee.TextField(default="")
     knowledge_base_id = peewee.TextField(default="")
     knowledge_base_url = peewee.TextField(default="")
     monthly_knowledge_base_id = peewee.TextField(default="")
     monthly_knowledge_base_url = peewee.TextField(default="")
-    download_url1 = peewee.TextField(default="")
-    download_title1 = peewee.TextField(default="")
-    download_url2 = peewee.TextField(default="")
-    download_title2 = peewee.TextField(default="")
-    download_url3 = peewee.TextField(default="")
-    download_title3 = peewee.TextField(default="")
-    download_url4 = peewee.TextField(default="")
-    download_title4 = peewee.TextField(default="")
-    article_title1 = peewee.TextField(default="")
-    article_url1 = peewee.TextField(default="")
-    article_title2 = peewee.TextField(default="")
-    article_url2 = peewee.TextField(default="")
-    article_title3 = peewee.TextField(default="")
-    article_url3 = peewee.TextField(default="")
-    article_title4 = peewee.TextField(default="")
-    article_url4 = peewee.TextField(default="")
+    if ms_slot_storage == "arrays":
+        # ArrayField is GIN-indexed by default; nothing looks rows up by slot.
+        download_urls = ArrayField(peewee.TextField, default=list, index=False)
+        download_titles = ArrayField(peewee.TextField, default=list, index=False)
+        article_titles = ArrayField(peewee.TextField, default=list, index=False)
+        article_urls = ArrayField(peewee.TextField, default=list, index=False)
+    else:
+        download_url1 = peewee.TextField(default="")
+        download_title1 = peewee.TextField(default="")
+        download_url2 = peewee.TextField(default="")
+        download_title2 = peewee.TextField(default="")
+        download_url3 = peewee.TextField(default="")
+        download_title3 = peewee.TextField(default="")
+        download_url4 = peewee.TextField(default="")
+        download_title4 = peewee.TextField(default="")
+        article_title1 = peewee.TextField(default="")
+        article_url1 = peewee.TextField(default="")
+        article_title2 = peewee.TextField(default="")
+        article_url2 = peewee.TextField(default="")
+        article_title3 = peewee.TextField(default="")
+        article_url3 = peewee.TextField(default="")
+        article_title4 = peewee.TextField(default="")
+        article_url4 = peewee.TextField(default="")
+    fingerprint = peewee.CharField(max_length=32, default="")
+    modified_date = peewee.DateTimeField(default=datetime.now, verbose_name="Created or last changed")
 
     def __unicode__(self):
         return "ms"
@@ -74,38 +229,302 @@ class MS(peewee.Model):
     def __str__(self):
         return str(self.cve_number)
 
+    @property
+    def to_json(self):
+        data = dict(id=self.id, published_date=self.published_date)
+        for field in FINGERPRINT_FIELDS:
+            data[field] = getattr(self, field)
+        data["modified_date"] = self.modified_date
+        return data
+
+
+def slot_property(array_name, position):
+    # download_url1 & co. on top of the array columns.
+    def getter(self):
+        values = getattr(self, array_name) or []
+        return values[position] if position < len(values) else undefined
+
+    def setter(self, value):
+        values = list(getattr(self, array_name) or [])
+        values.extend([undefined] * (position + 1 - len(values)))
+        values[position] = value
+        while values and values[-1] == undefined:
+            values.pop()
+        setattr(self, array_name, values)
+
+    return property(getter, setter)
+
+if ms_slot_storage == "arrays":
+    for slot_column, (slot_array, slot_position) in SLOT_COLUMNS.items():
+        setattr(MS, slot_column, slot_property(slot_array, slot_position))
+
+
+def read_lookup(column):
+    Lookup = LOOKUP_MODELS[column]
+    with database.connection_context():
+        return list(Lookup.select(Lookup.id, Lookup.value).tuples())
+
+def insert_lookup_value(column, value):
+    Lookup = LOOKUP_MODELS[column]
+    with database.connection_context():
+        Lookup.insert(value=value).on_conflict_ignore().execute()
+        return Lookup.select(Lookup.id).where(Lookup.value == value).scalar()
+
+
+class LookupCache(object):
+    # value <-> id of the lookup tables, read once per process and extended
+    # as new values turn up, so encoding a row costs no query. Reads and
+    # inserts run on a thread of their own: a new value is committed on its
+    # own connection, which also works while the caller's connection is in
+    # the middle of a COPY or an open sync transaction.
+
+    def __init__(self):
+        self.ids = dict((column, dict()) for column in LOOKUP_COLUMNS)
+        self.values = dict((column, dict()) for column in LOOKUP_COLUMNS)
+        self.loaded = set()
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def run(self, function, *args):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        return self.executor.submit(function, *args).result()
+
+    def add(self, column, lookup_id, value):
+        self.ids[column][value] = lookup_id
+        self.values[column][lookup_id] = value
+
+    def load(self, column):
+        for lookup_id, value in self.run(read_lookup, column):
+            self.add(column, lookup_id, value)
+        self.loaded.add(column)
+
+    def id(self, column, value):
+        # Values are stored as text, as the text layout does.
+        value = str(value)
+        lookup_id = self.ids[column].get(value)
+        if lookup_id is not None:
+            return lookup_id
+        with self.lock:
+            if column not in self.loaded:
+                self.load(column)
+            lookup_id = self.ids[column].get(value)
+            if lookup_id is None:
+                lookup_id = self.run(insert_lookup_value, column, value)
+                self.add(column, lookup_id, value)
+            return lookup_id
+
+    def value(self, column, lookup_id):
+        if lookup_id is None:
+            return ""
+        value = self.values[column].get(lookup_id)
+        if value is None:
+            # Added by another process since the table was read.
+            with self.lock:
+                self.load(column)
+            value = self.values[column][lookup_id]
+        return value
+
+lookup_cache = LookupCache()
+
+
+def lookup_property(column):
+    # family & co. on top of the lookup references.
+    ref = lookup_ref(column)
+
+    def getter(self):
+        return lookup_cache.value(column, getattr(self, ref))
+
+    def setter(self, value):
+        setattr(self, ref, lookup_cache.id(column, value))
+
+    return property(getter, setter)
+
+if ms_lookup_storage == "lookup":
+    for lookup_column in LOOKUP_COLUMNS:
+        setattr(MS, lookup_column, lookup_property(lookup_column))
+
+
+def create_ms_lookup_tables():
+    if ms_lookup_storage == "lookup":
+        for Lookup in LOOKUP_MODELS.values():
+            Lookup.create_table(safe=True)
+
+
+def ms_row(item_in_json):
+    # Column values for a normalized record in the configured storage layout.
+    row = dict(item_in_json)
+    if ms_slot_storage == "arrays":
+        for array_name, prefix in SLOT_GROUPS:
+            values = [row.pop("{}{}".format(prefix, position + 1)) for position in range(SLOT_COUNT)]
+            while values and values[-1] == undefined:
+                values.pop()
+            row[array_name] = values
+    if ms_lookup_storage == "lookup":
+        for column in LOOKUP_COLUMNS:
+            row[lookup_ref(column)] = lookup_cache.id(column, row.pop(column))
+    return row
+
+def ms_column_sql(column):
+    # SQL expression reading a logical MS column in the configured layout.
+    if ms_slot_storage == "arrays" and column in SLOT_COLUMNS:
+        array_name, position = SLOT_COLUMNS[column]
+        return "coalesce({}[{}], '{}')".format(array_name, position + 1, undefined)
+    if ms_lookup_storage == "lookup" and column in LOOKUP_COLUMNS:
+        return "(SELECT lookup.value FROM {} AS lookup WHERE lookup.id = {})".format(
+            LOOKUP_MODELS[column]._meta.table_name, lookup_ref(column))
+    return column
+
+def ms_column(column):
+    # A logical MS column for select and order_by clauses.
+    if column in MS._meta.fields:
+        return getattr(MS, column)
+    return peewee.SQL(ms_column_sql(column))
+
+def ms_column_equals(column, value):
+    # WHERE condition on a logical MS column; with lookup storage the value
+    # is looked up once and the reference (indexed) compared.
+    if ms_lookup_storage == "lookup" and column in LOOKUP_COLUMNS:
+        Lookup = LOOKUP_MODELS[column]
+        return getattr(MS, lookup_ref(column)) == Lookup.select(Lookup.id).where(Lookup.value == value)
+    return getattr(MS, column) == value
+
+
+# Words of name and of the article/download titles, weighted A, B and C, in
+# a generated tsvector column kept up to date by Postgres. It is not a peewee
+# field: inserts, updates and COPY leave it out and the sync never writes it.
+SEARCH_COLUMN = "search_vector"
+# No stemming or stop words: product names and versions are matched as
+# written, by word prefix.
+SEARCH_CONFIG = "simple"
+SEARCH_GROUPS = (
+    ("A", ("name", )),
+    ("B", tuple("article_title{}".format(position + 1) for position in range(SLOT_COUNT))),
+    ("C", tuple("download_title{}".format(position + 1) for position in range(SLOT_COUNT))),
+)
+
+def search_vector_sql():
+    # Generation expression of SEARCH_COLUMN in the configured layout;
+    # undefined slots are left out.
+    vectors = []
+    for weight, columns in SEARCH_GROUPS:
+        text = " || ' ' || ".join(
+            "coalesce(nullif({}, '{}'), '')".format(ms_column_sql(column), undefined) for column in columns)
+        vectors.append("setweight(to_tsvector('{}', {}), '{}')".format(SEARCH_CONFIG, text, weight))
+    return " || ".join(vectors)
+
+def search_index_name(table):
+    return "{}_{}".format(table, SEARCH_COLUMN)
+
+def add_search_vector(table=MS._meta.table_name):
+    database.execute_sql("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} TSVECTOR GENERATED ALWAYS AS ({}) STORED".format(
+        table, SEARCH_COLUMN, search_vector_sql()))
+
+def create_search_index(table=MS._meta.table_name):
+    database.execute_sql("CREATE INDEX IF NOT EXISTS {} ON {} USING gin ({})".format(
+        search_index_name(table), table, SEARCH_COLUMN))
+
+
+class SyncState(peewee.Model):
+    class Meta:
+        database = database
+        table_name = "sync_state"
+
+    id = peewee.PrimaryKeyField(null=False)
+    source = peewee.TextField(default="", index=True)
+    mode = peewee.TextField(default="incremental")
+    status = peewee.TextField(default="running")
+    from_date = peewee.TextField(default="")
+    watermark = peewee.DateTimeField(null=True, verbose_name="Highest published date seen")
+    started = peewee.DateTimeField(default=datetime.now)
+    finished = peewee.DateTimeField(null=True)
+    fetched = peewee.IntegerField(default=0)
+    created = peewee.IntegerField(default=0)
+    modified = peewee.IntegerField(default=0)
+    skipped = peewee.IntegerField(default=0)
+    # JSON progress of the run (see msparser.SyncCheckpoint), saved with the
+    # rows it covers; an interrupted run is resumed from it.
+    checkpoint = peewee.TextField(default="")
+    resumed_from = peewee.IntegerField(null=True)
+
+    def __unicode__(self):
+        return "sync_state"
+
+    def __str__(self):
+        return "{} {} {}".format(self.source, self.mode, self.status)
+
+
+class MSChange(peewee.Model):
+    # One row per MS row a sync created, modified or (on a rebuild) removed.
+    # ids only grow, so consumers poll with the last id they saw as cursor.
+    class Meta:
+        database = database
+        table_name = "vilnerabilities_ms_changes"
+
+    id = peewee.BigAutoField()
+    sync_id = peewee.IntegerField(null=True, index=True, verbose_name="SyncState id of the run")
+    ms_id = peewee.IntegerField(verbose_name="MS row id")
+    cve_number = peewee.TextField(default="")
+    change = peewee.CharField(max_length=8)
+    columns = ArrayField(peewee.TextField, default=list, index=False, verbose_name="Columns a modification changed")
+    changed = peewee.DateTimeField(default=datetime.now)
+
+    def __unicode__(self):
+        return "ms_change"
+
+    def __str__(self):
+        return "{} {}".format(self.change, self.ms_id)
+
+    @property
+    def to_json(self):
+        return dict(id=self.id, sync_id=self.sync_id, ms_id=self.ms_id, cve_number=self.cve_number,
+                    change=self.change, columns=self.columns, changed=self.changed)
+
+
+# MS columns a change record compares; the natural key never changes on a
+# row, published_date is kept by updates and the rest is bookkeeping.
+CHANGE_COLUMNS = tuple(
+    field.column_name for field in MS._meta.sorted_fields
+    if field.column_name not in MS_KEY_COLUMNS and
+    field.name not in ("id", "published_date", "fingerprint", "modified_date"))
+
+
+class MSEnrichment(peewee.Model):
+    # Advisory page details collected by enrich_ms, one row per advisory
+    # (CVE or ADV number, the MS.cve_number it enriches).
+    class Meta:
+        database = database
+        table_name = "vilnerabilities_ms_enrichment"
+
+    id = peewee.PrimaryKeyField(null=False)
+    advisory_id = peewee.TextField(unique=True)
+    title = peewee.TextField(default="")
+    published = peewee.TextField(default="")
+    last_updated = peewee.TextField(default="", verbose_name="Last updated date shown on the page")
+    last_modified = peewee.TextField(default="", verbose_name="Last-Modified header of the page")
+    faq = peewee.TextField(default="")
+    acknowledgements = peewee.TextField(default="")
+    disclaimer = peewee.TextField(default="")
+    source = peewee.TextField(default="http")
+    checked = peewee.DateTimeField(default=datetime.now)
+    changed = peewee.DateTimeField(default=datetime.now)
+
+    def __unicode__(self):
+        return "ms_enrichment"
+
+    def __str__(self):
+        return str(self.advisory_id)
+
     @property
     def to_json(self):
         return dict(
-            id=self.id,
-            published_date=self.published_date,
-            cve_number=self.cve_number,
-            cve_url=self.cve_url,
-            name=self.name,
-            platform=self.platform,
-            family=self.family,
-            impact_id=self.impact_id,
-            impact=self.impact,
-            severity_id=self.severity_id,
-            severity=self.severity,
-            knowledge_base_id=self.knowledge_base_id,
-            knowledge_base_url=self.knowledge_base_url,
-            monthly_knowledge_base_id=self.monthly_knowledge_base_id,
-            monthly_knowledge_base_url=self.monthly_knowledge_base_url,
-            download_url1=self.download_url1,
-            download_title1=self.download_title1,
-            download_url2=self.download_url2,
-            download_title2=self.download_title2,
-            download_url3=self.download_url3,
-            download_title3=self.download_title3,
-            download_url4=self.download_url4,
-            download_title4=self.download_title4,
-            article_title1=self.article_title1,
-            article_url1=self.article_url1,
-            article_title2=self.article_title2,
-            article_url2=self.article_url2,
-            article_title3=self.article_title3,
-            article_url3=self.article_url3,
-            article_title4=self.article_title4,
-            article_url4=self.article_url4,
-        )
\ No newline at end of file
+            advisory_id=self.advisory_id, title=self.title, published=self.published,
+            last_updated=self.last_updated, faq=self.faq, acknowledgements=self.acknowledgements,
+            disclaimer=self.disclaimer, checked=self.checked, changed=self.changed)
+
+
+def ms_fingerprint(item_in_json):
+    # Same value as md5(concat_ws(FINGERPRINT_SEPARATOR, ...)) in Postgres,
+    # which is what the table migration uses to backfill existing rows.
+    content = FINGERPRINT_SEPARATOR.join(str(item_in_json[field]) for field in FINGERPRINT_FIELDS)
+    return hashlib.md5(content.encode("utf-8")).hexdigest()
\ No newline at end of file
@@ -1,15 +1,46 @@
 import os
+import re
 import sys
+import csv
+import gzip
 import json
+import time
+import codecs
+import hashlib
+import argparse
+import zlib
 import peewee
 import logging
 import requests
-
-from datetime import datetime
+import threading
+
+from itertools import chain, islice
+from collections import deque, namedtuple
+from operator import attrgetter, itemgetter
+from contextlib import closing, contextmanager, nullcontext
+from queue import Queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import datetime, timedelta, timezone
 
 from settings import SETTINGS
 
-from model_ms import MS
+from cache_ms import SnapshotRecorder, cache_enabled, evict_cache, load_snapshot, open_cached_response, tee_to_cache, write_cached_response
+
+from copy_ms import RebuildRefusedError, rebuild_min_ratio, rebuild_ms_table
+
+from metrics_ms import PROFILE_MODES, SyncMetrics, add_counter, add_rows, measure_iter, measure_stage, metrics_enabled, \
+    profile_mode, profile_stage, write_metrics
+
+from partition_ms import create_ms_partitions, is_partitioned, maintain_partitions, partition_starts, rename_partitions
+
+from query_ms import invalidate_ms_cache
+
+from model_ms import MS, MSChange, SyncState, CHANGE_COLUMNS, NATURAL_KEY, FINGERPRINT_FIELDS, FINGERPRINT_SEPARATOR, SLOT_COLUMNS, SLOT_COUNT, \
+    SLOT_GROUPS, LOOKUP_COLUMNS, LOOKUP_MODELS, LOOKUP_REFS, MS_KEY_COLUMNS, create_ms_lookup_tables, database, lookup_cache, \
+    MS_UNIQUE_COLUMNS, lookup_ref, ms_column_sql, ms_lookup_storage, ms_partitioned, ms_row, ms_slot_storage, \
+    SEARCH_COLUMN, add_search_vector, create_search_index
 
 logging.basicConfig(format='%(name)s >> [%(asctime)s] :: %(message)s', level=logging.DEBUG)
 logger = logging.getLogger(__file__)
@@ -19,39 +50,85 @@ debug = bool(SETTINGS.get("debug", True))
 
 undefined = SETTINGS.get("undefined", "undefined")
 
-json_filename = SETTINGS.get("json_filename", "snyk.json")
-
 enable_extra_logging = SETTINGS.get("enable_extra_logging", False)
 enable_results_logging = SETTINGS.get("enable_results_logging", False)
 enable_exception_logging = SETTINGS.get("enable_exception_logging", True)
 
 drop_ms_table_before = SETTINGS.get("drop_ms_table_before", False)
 
-POSTGRES = SETTINGS.get("postgres", {})
-
-pg_default_database = POSTGRES.get("database", "updater_db")
-pg_default_user = POSTGRES.get("user", "admin")
-pg_default_password = POSTGRES.get("password", "123")
-pg_default_host = POSTGRES.get("host", "localhost")
-pg_default_port = POSTGRES.get("port", "5432")
-
-pg_drop_before = bool(POSTGRES.get("drop_pg_before", True))
-
-pg_database = os.environ.get("PG_DATABASE", pg_default_database)
-pg_user = os.environ.get("PG_USER", pg_default_user)
-pg_password = os.environ.get("PG_PASS", pg_default_password)
-pg_host = os.environ.get("PG_HOST", pg_default_host)
-pg_port = os.environ.get("PG_PORT", pg_default_port)
-
-database = peewee.PostgresqlDatabase(
-    database=pg_database,
-    user=pg_user,
-    password=pg_password,
-    host=pg_host,
-    port=pg_port
-)
+write_batch_size = int(SETTINGS.get("write_batch_size", 1000))
+commit_batch_size = int(SETTINGS.get("commit_batch_size", 10000))
+
+# How many CVE numbers per outcome (created/modified/skipped) a sync keeps for
+# the results log; 0 keeps counters only.
+outcome_sample_size = int(SETTINGS.get("outcome_sample_size", 10))
+
+# "snapshot": diff the feed against the table in memory and write only the
+# delta; "upsert": send every record through upsert_ms_items_in_postgres.
+sync_mode = SETTINGS.get("sync_mode", "snapshot")
+
+# Full syncs with drop_ms_table_before rebuild the table through COPY into a
+# staging table that is swapped in at the end, instead of dropping it first.
+bulk_rebuild = bool(SETTINGS.get("bulk_rebuild", True))
+# The live feed does not carry the pre-portal bulletins: a rebuild loads the
+# imported legacy archive again (under the feed's rows) so they are kept.
+rebuild_keep_legacy = bool(SETTINGS.get("rebuild_keep_legacy", True))
+
+# Parse details[] from the response stream instead of loading the whole body.
+stream_feed = bool(SETTINGS.get("stream_feed", True))
+stream_chunk_size = int(SETTINGS.get("stream_chunk_size", 65536))
+
+# Fetch the feed as pages over a keep-alive session, several at a time.
+fetch_pages = bool(SETTINGS.get("fetch_pages", True))
+fetch_page_size = int(SETTINGS.get("fetch_page_size", 1000))
+fetch_concurrency = int(SETTINGS.get("fetch_concurrency", 4))
+fetch_timeout = float(SETTINGS.get("fetch_timeout", 60))
+fetch_retries = int(SETTINGS.get("fetch_retries", 3))
+
+# Incremental runs fetch from the last successful run's highest
+# published_date minus the overlap; full runs fetch everything.
+incremental_sync = bool(SETTINGS.get("incremental_sync", True))
+incremental_overlap_days = int(SETTINGS.get("incremental_overlap_days", 3))
+
+FULL_SYNC_FROM_DATE = '01/01/1900'
+
+# Paged, non-rebuild, serial runs checkpoint the feed pages they committed;
+# a run that did not finish is resumed from there by the next one. Runs
+# failing on a database error are retried (resumed) up to run_attempts
+# times, connections up to db_retries times, with exponential backoff. After
+# breaker_failures page fetches in a row fail the rest fail fast for
+# breaker_reset_seconds.
+RESUME = SETTINGS.get("resume", {})
+
+resume_enabled = bool(RESUME.get("enabled", True))
+run_attempts = int(RESUME.get("run_attempts", 3))
+db_retries = int(RESUME.get("db_retries", 3))
+retry_backoff_seconds = float(RESUME.get("backoff_seconds", 1.0))
+breaker_failures = int(RESUME.get("breaker_failures", 5))
+breaker_reset_seconds = float(RESUME.get("breaker_reset_seconds", 60))
+
+# Parallel sync: normalize chunks in normalize_processes worker processes
+# (0 = one per core) and write through writer_connections threads, each with
+# its own connection and a disjoint share of the natural keys. With the pool
+# enabled, pool.max_connections must leave room for the writers.
+PARALLEL = SETTINGS.get("parallel", {})
+
+parallel_sync = bool(PARALLEL.get("enabled", False))
+normalize_processes = int(PARALLEL.get("normalize_processes", 0)) or os.cpu_count() or 1
+writer_connections = int(PARALLEL.get("writer_connections", 4))
+
+# Record every row a sync creates or modifies in MSChange.
+CHANGE_LOG = SETTINGS.get("change_log", {})
+
+change_log_enabled = bool(CHANGE_LOG.get("enabled", True))
+
+# sync_sessions.session is set while a SyncSession is open in that thread:
+# helpers then share its connection instead of opening and closing one per
+# call.
+sync_sessions = threading.local()
 
 SOURCE_NAME = "msbulletin"
+LEGACY_SOURCE_NAME = "legacy"
 SOURCE_FILE = "https://portal.msrc.microsoft.com/api/security-guidance/en-us/"
 CURRENT_PATH = os.path.dirname(os.path.realpath(__file__))
 GZIP_FILE = os.path.join(CURRENT_PATH, "../data/old_Microsoft_bulletins.gz")
@@ -74,20 +151,158 @@ def LOGVAR_IF_ENABLED(message="\n"):
         logger.info(message)
 
 
-def set_default(obj):
-    if isinstance(obj, set):
-        return list(obj)
-    raise TypeError
-
-def progress_bar(iteration, total, barLength=50, title="Processing: "):
-    percent = int(round((iteration / total) * 100))
-    nb_bar_fill = int(round((barLength * percent) / 100))
-    bar_fill = '#' * nb_bar_fill
-    bar_empty = ' ' * (barLength - nb_bar_fill)
-    sys.stdout.write(title + "\r  [{0}] {1}%".format(str(bar_fill + bar_empty), percent))
-    sys.stdout.flush()
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# Characters that can still extend a number token ("1" -> "1.5e-3").
+JSON_NUMBER_TAIL = re.compile(r'[0-9.eE+\-]*')
+json_decoder = json.JSONDecoder()
+
+class JSONStream(object):
+    # Minimal pull parser over an iterable of text chunks. Only the values we
+    # ask for are decoded, so memory is bounded by the largest single value.
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ""
+        self.position = 0
+
+    def fill(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
 
-def get_msbulletin(url, from_date='01/01/1900', to_date=None):
+    def peek(self):
+        while True:
+            self.position = JSON_WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                return ""
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError("Unexpected {!r} in JSON stream, expected one of {!r}".format(char, chars))
+        self.position += 1
+        return char
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = json_decoder.raw_decode(self.buffer, self.position)
+            except ValueError:
+                if self.fill():
+                    continue
+                raise
+            # A number running into the end of the buffer, even through a
+            # partial fraction or exponent ("1." or "1.5e"), may continue in
+            # the next chunk.
+            if isinstance(value, (int, float)) and \
+                    JSON_NUMBER_TAIL.match(self.buffer, end).end() == len(self.buffer) and self.fill():
+                continue
+            self.position = end
+            return value
+
+def iter_json_field_items(chunks, field, meta=None):
+    # Yield the elements of the array stored under `field` of a top-level JSON
+    # object one at a time. Other top-level values are stored in `meta`.
+    stream = JSONStream(chunks)
+    stream.expect("{")
+    if stream.peek() == "}":
+        return
+    while True:
+        key = stream.decode()
+        stream.expect(":")
+        if key == field and stream.peek() == "[":
+            stream.expect("[")
+            if stream.peek() == "]":
+                stream.expect("]")
+            else:
+                while True:
+                    yield stream.decode()
+                    if stream.expect(",]") == "]":
+                        break
+        else:
+            value = stream.decode()
+            if meta is not None:
+                meta[key] = value
+        if stream.expect(",}") == "}":
+            return
+
+def iter_json_array_items(chunks):
+    # Yield the elements of a top-level JSON array one at a time.
+    stream = JSONStream(chunks)
+    stream.expect("[")
+    if stream.peek() == "]":
+        return
+    while True:
+        yield stream.decode()
+        if stream.expect(",]") == "]":
+            return
+
+def retry_call(function, retries=db_retries, backoff=retry_backoff_seconds, exceptions=(peewee.OperationalError, )):
+    for attempt in range(retries + 1):
+        try:
+            return function()
+        except exceptions as ex:
+            if attempt == retries:
+                raise
+            LOGERR_IF_ENABLED("[e] Retry in {}s after: {}".format(backoff * 2 ** attempt, ex))
+            time.sleep(backoff * 2 ** attempt)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    # Once `failures` calls in a row have failed, further calls fail with
+    # CircuitOpenError until reset_seconds have passed; then one call is let
+    # through and closes the breaker again if it succeeds.
+
+    def __init__(self, name, failures=breaker_failures, reset_seconds=breaker_reset_seconds):
+        self.name = name
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.failed = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def call(self, function, *args, **kwargs):
+        with self.lock:
+            if self.opened is not None:
+                if time.monotonic() - self.opened < self.reset_seconds:
+                    raise CircuitOpenError("{} circuit open after {} failures".format(self.name, self.failed))
+                self.opened = time.monotonic()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            with self.lock:
+                self.failed += 1
+                if self.failed >= self.failures:
+                    self.opened = time.monotonic()
+            raise
+        with self.lock:
+            self.failed = 0
+            self.opened = None
+        return result
+
+
+feed_breaker = CircuitBreaker("MSBulletin feed")
+
+
+def msbulletin_request(from_date='01/01/1900', to_date=None, page_number=1, page_size=50000):
     headers = {
         'Accept': "application/json, text/plain, */*",
         'Content-Type': 'application/json;charset=utf-8',
@@ -99,8 +314,8 @@ def get_msbulletin(url, from_date='01/01/1900', to_date=None):
         'productIds': [],
         'severityIds': [],
         'impactIds': [],
-        'pageNumber': 1,
-        'pageSize': 50000,
+        'pageNumber': page_number,
+        'pageSize': page_size,
         'includeCveNumber': True,
         'includeSeverity': True,
         'includeImpact': True,
@@ -117,21 +332,163 @@ def get_msbulletin(url, from_date='01/01/1900', to_date=None):
     if to_date:
         query['toPublishedDate'] = to_date
 
+    return headers, query
+
+def get_msbulletin(url, from_date='01/01/1900', to_date=None, recorder=None):
+    # Errors are logged and raised: a failed download must not look like an
+    # empty feed.
+    headers, query = msbulletin_request(from_date, to_date)
+
     try:
-        post = requests.post(url, headers=headers, data=json.dumps(query))
-        if post:
-            return post.json()
-        else:
-            return {}
+        post = feed_breaker.call(
+            msbulletin_session(1).post, url, headers=headers, data=json.dumps(query), timeout=fetch_timeout)
+        add_counter("bytes_downloaded", len(post.content))
+        post.raise_for_status()
+        if recorder is not None:
+            write_cached_response(post.content, recorder)
+        return post.json()
+    except Exception as ex:
+        LOGERR_IF_ENABLED("[e] Get an exception with MSBulletin download: {}".format(ex))
+        raise
+
+def count_downloaded(chunks):
+    for chunk in chunks:
+        add_counter("bytes_downloaded", len(chunk))
+        yield chunk
+
+def iter_msbulletin(url, from_date='01/01/1900', to_date=None, meta=None, recorder=None):
+    # Streaming variant of get_msbulletin: yields details[] records as they
+    # are parsed from the response; "count" ends up in `meta`. Errors are
+    # logged and raised, as in get_msbulletin.
+    headers, query = msbulletin_request(from_date, to_date)
+
+    def open_stream():
+        post = msbulletin_session(1).post(url, headers=headers, data=json.dumps(query), timeout=fetch_timeout, stream=True)
+        if not post:
+            post.close()
+            post.raise_for_status()
+        return post
+
+    try:
+        post = feed_breaker.call(open_stream)
     except Exception as ex:
         LOGERR_IF_ENABLED("[e] Get an exception with MSBulletin download: {}".format(ex))
-        return {}
+        raise
+    with closing(post):
+        raw_chunks = count_downloaded(post.iter_content(stream_chunk_size))
+        if recorder is not None:
+            raw_chunks = tee_to_cache(raw_chunks, recorder)
+        decoder = codecs.getincrementaldecoder(post.encoding or "utf-8")()
+        chunks = (decoder.decode(chunk) for chunk in raw_chunks)
+        for item_in_details in iter_json_field_items(chunks, "details", meta):
+            yield item_in_details
+        # Read whatever follows the closing brace so the cache entry completes.
+        for _ in chunks:
+            pass
+
+def iter_msbulletin_replay(snapshot=None, meta=None, manifest=None):
+    # Yield the records of a cached snapshot (the newest one by default, or
+    # the already loaded manifest) without touching the network.
+    manifest = manifest or load_snapshot(snapshot)
+    LOGINFO_IF_ENABLED("[+] Replay snapshot {} ({} responses)".format(manifest["name"], len(manifest["entries"])))
+    for key in manifest["entries"]:
+        with open_cached_response(key) as cached:
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            chunks = (decoder.decode(chunk) for chunk in iter(lambda: cached.read(stream_chunk_size), b""))
+            for item_in_details in iter_json_field_items(chunks, "details", meta):
+                yield item_in_details
+
+def msbulletin_session(pool_size=fetch_concurrency):
+    retry = Retry(
+        total=fetch_retries,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def get_msbulletin_page(session, url, page_number, page_size=fetch_page_size, from_date='01/01/1900', to_date=None,
+                        recorder=None):
+    headers, query = msbulletin_request(from_date, to_date, page_number, page_size)
+    post = session.post(url, headers=headers, data=json.dumps(query), timeout=fetch_timeout)
+    post.raise_for_status()
+    add_counter("bytes_downloaded", len(post.content))
+    if recorder is not None:
+        write_cached_response(post.content, recorder, page_number)
+    return post.json()
+
+def iter_msbulletin_pages(url, from_date='01/01/1900', to_date=None, meta=None,
+                          page_size=fetch_page_size, concurrency=fetch_concurrency, session=None, recorder=None,
+                          skip_pages=(), skip_count=None):
+    # Page 1 is fetched first to learn the total count; the remaining pages
+    # are fetched by `concurrency` workers and their records yielded in the
+    # order the pages arrive. At most 2 * concurrency pages are in flight so
+    # a slow consumer does not make us buffer the whole feed.
+    # Each page number goes to meta["pages_done"] once the consumer has
+    # taken all of its records. skip_pages (a resumed run's finished pages)
+    # are not yielded, unless the feed no longer has skip_count records: then
+    # the pages have shifted and everything is yielded again.
+    meta = meta if meta is not None else dict()
+    meta["failed_pages"] = []
+    meta.setdefault("pages_done", [])
+    session = session or msbulletin_session(concurrency)
+    try:
+        first_page = feed_breaker.call(get_msbulletin_page, session, url, 1, page_size, from_date, to_date, recorder)
+    except Exception as ex:
+        LOGERR_IF_ENABLED("[e] Get an exception with MSBulletin download: {}".format(ex))
+        meta["failed_pages"].append(1)
+        return
+    count = first_page.get("count", 0)
+    meta["count"] = count
+    if skip_pages and count != skip_count:
+        LOGINFO_IF_ENABLED("[+] Feed has {} records instead of {}, not skipping finished pages".format(
+            count, skip_count))
+        skip_pages = ()
+        del meta["pages_done"][:]
+    skip_pages = set(skip_pages)
+    if 1 not in skip_pages:
+        for item_in_details in first_page.get("details", []):
+            yield item_in_details
+        meta["pages_done"].append(1)
+    del first_page
+
+    pages = (count + page_size - 1) // page_size
+    page_numbers = iter([page_number for page_number in range(2, pages + 1) if page_number not in skip_pages])
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = dict()
+
+        def submit(numbers):
+            for page_number in numbers:
+                future = executor.submit(
+                    feed_breaker.call, get_msbulletin_page, session, url, page_number, page_size, from_date, to_date,
+                    recorder)
+                pending[future] = page_number
+
+        submit(islice(page_numbers, concurrency * 2))
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                page_number = pending.pop(future)
+                submit(islice(page_numbers, 1))
+                try:
+                    page = future.result()
+                except Exception as ex:
+                    LOGERR_IF_ENABLED("[e] Get an exception with MSBulletin page {} download: {}".format(page_number, ex))
+                    meta["failed_pages"].append(page_number)
+                    continue
+                for item_in_details in page.get("details", []):
+                    yield item_in_details
+                meta["pages_done"].append(page_number)
 
 def connect_database():
     try:
         peewee.logger.disabled = True
         if database.is_closed():
-            database.connect()
+            retry_call(database.connect)
         else:
             pass
         LOGVAR_IF_ENABLED("[+] Connect Postgres database")
@@ -141,7 +498,12 @@ def connect_database():
     return False
 
 
+def current_sync_session():
+    return getattr(sync_sessions, "session", None)
+
 def disconnect_database():
+    if current_sync_session() is not None:
+        return True
     try:
         if database.is_closed():
             pass
@@ -155,6 +517,70 @@ def disconnect_database():
     peewee.logger.disabled = False
     return False
 
+class SyncSession(object):
+    # One connection for the whole run. Writes are grouped into transactions
+    # of at least commit_batch_size rows; the transaction is opened lazily on
+    # the first write so the download does not hold it idle.
+
+    def __init__(self, commit_batch_size=commit_batch_size, sync_id=None):
+        self.commit_batch_size = commit_batch_size
+        # SyncState id the change log entries written in this session refer to.
+        self.sync_id = sync_id
+        self.transaction = None
+        self.pending = 0
+        # Called inside the transaction just before it commits.
+        self.before_commit = None
+
+    def __enter__(self):
+        connect_database()
+        sync_sessions.session = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if self.transaction is not None:
+                self.transaction.__exit__(exc_type, exc_value, traceback)
+                self.transaction = None
+        finally:
+            sync_sessions.session = None
+            disconnect_database()
+
+    def begin(self):
+        if self.transaction is None:
+            self.transaction = database.transaction()
+            self.transaction.__enter__()
+
+    def commit(self):
+        if self.transaction is not None:
+            if self.before_commit is not None:
+                self.before_commit()
+            self.transaction.__exit__(None, None, None)
+            self.transaction = None
+            invalidate_ms_cache()
+        self.pending = 0
+
+    def rollback(self):
+        if self.transaction is not None:
+            self.transaction.rollback()
+            self.transaction.__exit__(None, None, None)
+            self.transaction = None
+        self.pending = 0
+
+    def rows_written(self, count):
+        self.pending += count
+        if self.pending >= self.commit_batch_size:
+            self.commit()
+
+def begin_sync_write():
+    session = current_sync_session()
+    if session is not None:
+        session.begin()
+
+def end_sync_write(count):
+    session = current_sync_session()
+    if session is not None:
+        session.rows_written(count)
+
 def drop_ms_table():
     connect_database()
     if MS.table_exists():
@@ -163,351 +589,1045 @@ def drop_ms_table():
 
 def create_ms_table():
     connect_database()
-    if not MS.table_exists():
-        MS.create_table()
+    create_ms_lookup_tables()
+    if MS.table_exists():
+        migrate_ms_table()
+    MS.create_table(safe=True)
+    add_search_vector()
+    create_search_index()
+    create_ms_change_table()
+    maintain_ms_partitions()
     disconnect_database()
 
-def count_ms_table():
+def create_ms_change_table():
+    if change_log_enabled:
+        MSChange.create_table(safe=True)
+        # Made by tables created before columns was unindexed.
+        database.execute_sql("DROP INDEX IF EXISTS {}_columns".format(MSChange._meta.name))
+
+def current_sync_id():
+    session = current_sync_session()
+    return session.sync_id if session is not None else None
+
+def migrate_ms_table():
+    # Bring a table created before the natural key and fingerprint existed up
+    # to date: move the download/article slots and the lookup columns to the
+    # configured layout, add modified_date (existing rows count as changed
+    # now), add and backfill the fingerprint column, drop duplicate natural
+    # keys (keeping the newest row) so the unique index can be built, and
+    # partition the table (or not) as configured. Each step only runs when
+    # the table lacks what it adds, so an up-to-date table costs a few
+    # catalog reads.
+    table = MS._meta.table_name
+    migrate_ms_slot_storage()
+    migrate_ms_lookup_storage()
+    columns = set(column.name for column in database.get_columns(table))
+    if "modified_date" not in columns:
+        database.execute_sql(
+            "ALTER TABLE {0} ADD COLUMN modified_date TIMESTAMP NOT NULL DEFAULT now()".format(table))
+    if "fingerprint" not in columns:
+        with database.atomic():
+            database.execute_sql("ALTER TABLE {0} ADD COLUMN fingerprint VARCHAR(32) NOT NULL DEFAULT ''".format(table))
+            database.execute_sql(
+                "UPDATE {0} SET fingerprint = md5(concat_ws(%s, {1}))".format(
+                    table, ", ".join(ms_column_sql(field) for field in FINGERPRINT_FIELDS)),
+                (FINGERPRINT_SEPARATOR, ))
+    # Postgres truncates index names to 63 characters.
+    unique_index = next(index for index in MS._meta.fields_to_index() if index._unique)._name[:63]
+    if not database.execute_sql(
+            "SELECT 1 FROM pg_indexes WHERE tablename = %s AND indexname = %s", (table, unique_index)).fetchone():
+        database.execute_sql(
+            "DELETE FROM {0} AS a USING {0} AS b WHERE a.id < b.id AND {1}".format(
+                table, " AND ".join("a.{0} = b.{0}".format(key) for key in MS_KEY_COLUMNS)))
+    migrate_ms_partitioning()
+
+def migrate_ms_slot_storage():
+    # Convert the download/article slots between numbered columns and text[]
+    # columns, whichever way ms_slot_storage asks for, in one transaction.
+    # The search vector is generated from the slots: it is dropped here and
+    # added back over the new columns by create_ms_table.
+    table = MS._meta.table_name
+    columns = set(column.name for column in database.get_columns(table))
+    with database.atomic():
+        if ms_slot_storage == "arrays" and set(SLOT_COLUMNS) <= columns:
+            LOGINFO_IF_ENABLED("[+] Migrate {} download/article slots to arrays".format(table))
+            database.execute_sql("ALTER TABLE {} DROP COLUMN IF EXISTS {}".format(table, SEARCH_COLUMN))
+            assignments = []
+            for array_name, prefix in SLOT_GROUPS:
+                database.execute_sql(
+                    "ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} TEXT[] NOT NULL DEFAULT '{{}}'".format(table, array_name))
+                slots = ["{}{}".format(prefix, position + 1) for position in range(SLOT_COUNT)]
+                # Keep slots up to the last one that is not undefined.
+                cases = " ".join(
+                    "WHEN {} <> %s THEN ARRAY[{}]".format(slots[last], ", ".join(slots[:last + 1]))
+                    for last in reversed(range(SLOT_COUNT)))
+                assignments.append("{} = CASE {} ELSE '{{}}'::TEXT[] END".format(array_name, cases))
+            database.execute_sql(
+                "UPDATE {} SET {}".format(table, ", ".join(assignments)),
+                (undefined, ) * SLOT_COUNT * len(SLOT_GROUPS))
+            for slot_column in SLOT_COLUMNS:
+                database.execute_sql("ALTER TABLE {} DROP COLUMN {}".format(table, slot_column))
+        elif ms_slot_storage != "arrays" and set(array_name for array_name, _ in SLOT_GROUPS) <= columns:
+            LOGINFO_IF_ENABLED("[+] Migrate {} download/article slots to columns".format(table))
+            database.execute_sql("ALTER TABLE {} DROP COLUMN IF EXISTS {}".format(table, SEARCH_COLUMN))
+            for slot_column, (array_name, position) in SLOT_COLUMNS.items():
+                database.execute_sql(
+                    "ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} TEXT NOT NULL DEFAULT ''".format(table, slot_column))
+            database.execute_sql("UPDATE {} SET {}".format(table, ", ".join(
+                "{} = coalesce({}[{}], %s)".format(slot_column, array_name, position + 1)
+                for slot_column, (array_name, position) in SLOT_COLUMNS.items())),
+                (undefined, ) * len(SLOT_COLUMNS))
+            for array_name, _ in SLOT_GROUPS:
+                database.execute_sql("ALTER TABLE {} DROP COLUMN {}".format(table, array_name))
+        # Tables made in arrays layout before the slots were created unindexed.
+        for array_name, _ in SLOT_GROUPS:
+            database.execute_sql("DROP INDEX IF EXISTS {}_{}".format(MS._meta.name, array_name))
+
+def migrate_ms_lookup_storage():
+    # Convert the lookup columns between text and lookup references,
+    # whichever way ms_lookup_storage asks for, in one transaction. Indexes
+    # on the dropped columns go with them and are rebuilt by create_table.
+    table = MS._meta.table_name
+    columns = set(column.name for column in database.get_columns(table))
+    with database.atomic():
+        if ms_lookup_storage == "lookup" and set(LOOKUP_COLUMNS) <= columns:
+            LOGINFO_IF_ENABLED("[+] Migrate {} {} to lookup tables".format(table, ", ".join(LOOKUP_COLUMNS)))
+            for column in LOOKUP_COLUMNS:
+                lookup_table = LOOKUP_MODELS[column]._meta.table_name
+                ref = lookup_ref(column)
+                database.execute_sql(
+                    "INSERT INTO {0} (value) SELECT DISTINCT {1} FROM {2} ON CONFLICT DO NOTHING".format(
+                        lookup_table, column, table))
+                database.execute_sql(
+                    "ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} INTEGER REFERENCES {} (id)".format(table, ref, lookup_table))
+                database.execute_sql(
+                    "UPDATE {0} AS m SET {1} = lookup.id FROM {2} AS lookup WHERE lookup.value = m.{3}".format(
+                        table, ref, lookup_table, column))
+                database.execute_sql("ALTER TABLE {} ALTER COLUMN {} SET NOT NULL".format(table, ref))
+                database.execute_sql("ALTER TABLE {} DROP COLUMN {}".format(table, column))
+        elif ms_lookup_storage != "lookup" and set(LOOKUP_REFS) <= columns:
+            LOGINFO_IF_ENABLED("[+] Migrate {} {} to text columns".format(table, ", ".join(LOOKUP_COLUMNS)))
+            for column in LOOKUP_COLUMNS:
+                ref = lookup_ref(column)
+                database.execute_sql(
+                    "ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} TEXT NOT NULL DEFAULT ''".format(table, column))
+                database.execute_sql(
+                    "UPDATE {0} AS m SET {1} = lookup.value FROM {2} AS lookup WHERE lookup.id = m.{3}".format(
+                        table, column, LOOKUP_MODELS[column]._meta.table_name, ref))
+                database.execute_sql("ALTER TABLE {} DROP COLUMN {}".format(table, ref))
+
+def migrate_ms_partitioning():
+    # Recreate the table partitioned or plain, whichever ms_partitioned asks
+    # for, and copy the rows (and the id sequence) over in one transaction.
+    # The indexes are built by create_table once the old table is gone.
+    table = MS._meta.table_name
+    if is_partitioned(table) == ms_partitioned:
+        return
+    LOGINFO_IF_ENABLED("[+] Migrate {} to a {} table".format(table, "partitioned" if ms_partitioned else "plain"))
+    old_table = table + "_migrating"
+    columns = ", ".join(field.column_name for field in MS._meta.sorted_fields)
+    with database.atomic():
+        sequence = database.execute_sql("SELECT pg_get_serial_sequence(%s, 'id')", (table, )).fetchone()[0]
+        database.execute_sql("ALTER TABLE {} RENAME TO {}".format(table, old_table))
+        database.execute_sql("ALTER TABLE {0} RENAME CONSTRAINT {1}_pkey TO {0}_pkey".format(old_table, table))
+        database.execute_sql("ALTER SEQUENCE {} RENAME TO {}_id_seq".format(sequence, old_table))
+        rename_partitions(old_table, table)
+        MS._schema.create_table(safe=False)
+        add_search_vector()
+        if ms_partitioned:
+            create_ms_partitions(table, partition_starts(old_table))
+        database.execute_sql("INSERT INTO {0} ({1}) SELECT {1} FROM {2}".format(table, columns, old_table))
+        database.execute_sql(
+            "SELECT setval(pg_get_serial_sequence(%s, 'id'), coalesce(max(id), 0) + 1, false) FROM {}".format(table),
+            (table, ))
+        database.execute_sql("DROP TABLE {}".format(old_table))
+
+def maintain_ms_partitions():
+    # Partition housekeeping of a partitioned MS (partition_ms), before the
+    # sync writes and once it has committed.
+    if not ms_partitioned:
+        return
+    created, dropped = maintain_partitions(change_log=change_log_enabled, sync_id=current_sync_id())
+    if created:
+        LOGINFO_IF_ENABLED("[+] Create partitions {}".format(", ".join(created)))
+    if dropped:
+        LOGINFO_IF_ENABLED("[+] Drop expired partitions {}".format(", ".join(dropped)))
+
+def create_sync_state_table():
     connect_database()
-    count = MS.select().count()
-    if count:
-        disconnect_database()
-        return count
+    if SyncState.table_exists():
+        table = SyncState._meta.table_name
+        database.execute_sql("ALTER TABLE {} ADD COLUMN IF NOT EXISTS checkpoint TEXT NOT NULL DEFAULT ''".format(table))
+        database.execute_sql("ALTER TABLE {} ADD COLUMN IF NOT EXISTS resumed_from INTEGER".format(table))
+    SyncState.create_table(safe=True)
     disconnect_database()
-    return 0
 
-def check_if_ms_exists_in_postgres(item_in_json):
+def interrupted_sync_state():
+    # The latest run when it did not succeed but left a checkpoint.
     connect_database()
-    sid = -1
-    if "cve_number" in item_in_json:
-        cve_number = item_in_json.get("cve_number")
-        knowledge_base_id = item_in_json.get("knowledge_base_id")
-        name = item_in_json.get("name")
-        family = item_in_json.get("family")
-        severity = item_in_json.get("severity")
-        impact_id = item_in_json.get("impact_id")
-        article_title1 = item_in_json.get("article_title1")
-        download_title1 = item_in_json.get("download_title1")
-        article_title2 = item_in_json.get("article_title2")
-        download_title2 = item_in_json.get("download_title2")
-        article_title3 = item_in_json.get("article_title3")
-        download_title3 = item_in_json.get("download_title3")
-        article_title4 = item_in_json.get("article_title4")
-        download_title4 = item_in_json.get("download_title4")
-        knowledge_base_id = item_in_json.get("knowledge_base_id")
-        monthly_knowledge_base_id = item_in_json.get("monthly_knowledge_base_id")
-        if cve_number != "undefined":
-            mss = list(
-                MS.select().where(
-                    (MS.cve_number == cve_number) &
-                    (MS.knowledge_base_id == knowledge_base_id) &
-                    (MS.name == name) &
-                    (MS.family == family) &
-                    (MS.severity == severity) &
-                    (MS.impact_id == impact_id) &
-                    (MS.article_title1 == article_title1) &
-                    (MS.article_title2 == article_title2) &
-                    (MS.article_title3 == article_title3) &
-                    (MS.article_title4 == article_title4) &
-                    (MS.download_title1 == download_title1) &
-                    (MS.download_title2 == download_title2) &
-                    (MS.download_title3 == download_title3) &
-                    (MS.download_title4 == download_title4) &
-                    (MS.knowledge_base_id == knowledge_base_id) &
-                    (MS.monthly_knowledge_base_id == monthly_knowledge_base_id)
-                )
-            )
-            disconnect_database()
-            if len(mss) == 0:
-                return False, sid
-            else:
-                return True, mss[0].to_json["id"]
+    state = SyncState.select().where(SyncState.source == SOURCE_NAME).order_by(SyncState.id.desc()).first()
+    disconnect_database()
+    if state is None or state.status == "success" or not state.checkpoint:
+        return None
+    return state
 
-def create_ms_item_in_postgres(item_in_json):
-    sid = -1
+def last_sync_state():
     connect_database()
-    item_in_json["published_date"] = datetime.utcnow() if item_in_json["published_date"] == "undefined" else item_in_json["published_date"]
-
-    ms = MS(
-        published_date=item_in_json["published_date"],
-        cve_number=item_in_json["cve_number"],
-        cve_url=item_in_json["cve_url"],
-        name=item_in_json["name"],
-        platform=item_in_json["platform"],
-        family=item_in_json["family"],
-        impact_id=item_in_json["impact_id"],
-        impact=item_in_json["impact"],
-        severity_id=item_in_json["severity_id"],
-        severity=item_in_json["severity"],
-        knowledge_base_id=item_in_json["knowledge_base_id"],
-        knowledge_base_url=item_in_json["knowledge_base_url"],
-        monthly_knowledge_base_id=item_in_json["monthly_knowledge_base_id"],
-        monthly_knowledge_base_url=item_in_json["monthly_knowledge_base_url"],
-        download_url1=item_in_json["download_url1"],
-        download_title1=item_in_json["download_title1"],
-        download_url2=item_in_json["download_url2"],
-        download_title2=item_in_json["download_title2"],
-        download_url3=item_in_json["download_url3"],
-        download_title3=item_in_json["download_title3"],
-        download_url4=item_in_json["download_url4"],
-        download_title4=item_in_json["download_title4"],
-        article_title1=item_in_json["article_title1"],
-        article_url1=item_in_json["article_url1"],
-        article_title2=item_in_json["article_title2"],
-        article_url2=item_in_json["article_url2"],
-        article_title3=item_in_json["article_title3"],
-        article_url3=item_in_json["article_url3"],
-        article_title4=item_in_json["article_title4"],
-        article_url4=item_in_json["article_url4"],
-    )
-    ms.save()
+    state = SyncState.select().where(
+        (SyncState.source == SOURCE_NAME) &
+        (SyncState.status == "success")
+    ).order_by(SyncState.id.desc()).first()
+    disconnect_database()
+    return state
 
+def start_sync_state(mode, from_date, interrupted=None):
+    # A resumed run starts from the interrupted run's checkpoint, so its
+    # progress survives this run failing before it commits anything.
+    connect_database()
+    if interrupted is None:
+        state = SyncState.create(source=SOURCE_NAME, mode=mode, from_date=from_date)
+    else:
+        state = SyncState.create(source=SOURCE_NAME, mode=mode, from_date=from_date,
+                                 checkpoint=interrupted.checkpoint, resumed_from=interrupted.id)
     disconnect_database()
-    return sid
+    return state
+
+
+class SyncCheckpoint(object):
+    # Progress of a paged sync kept on its SyncState row: the feed pages
+    # whose records are all committed, the feed count and page size those
+    # page numbers refer to, and the highest published date among them. It is
+    # saved from SyncSession.before_commit, inside the transaction that
+    # commits the rows it describes.
+
+    def __init__(self, state):
+        self.state = state
+        self.data = json.loads(state.checkpoint) if state.checkpoint else dict()
+
+    def resume(self, feed_meta):
+        # Seed feed_meta from the checkpoint; returns the pages to skip.
+        if self.data.get("page_size") != fetch_page_size:
+            return ()
+        pages = self.data.get("pages", [])
+        feed_meta["pages_done"] = list(pages)
+        if self.data.get("watermark"):
+            feed_meta["watermark"] = datetime.strptime(self.data["watermark"], "%Y-%m-%dT%H:%M:%S")
+        return pages
+
+    def save(self, feed_meta):
+        watermark = feed_meta.get("watermark")
+        self.data = dict(
+            count=feed_meta.get("count"), page_size=fetch_page_size, pages=sorted(set(feed_meta.get("pages_done", []))),
+            watermark=watermark.strftime("%Y-%m-%dT%H:%M:%S") if watermark is not None else None)
+        self.state.checkpoint = json.dumps(self.data)
+        self.state.save(only=[SyncState.checkpoint])
+
+def finish_sync_state(state, result=None, previous=None):
+    # result is what update_ms_vulners returned; None marks the run as failed.
+    # A run that fetched nothing keeps the previous watermark. The checkpoint
+    # is left alone: only SyncCheckpoint.save writes it, in the transaction
+    # of the rows it covers, and the in-memory one may belong to a commit
+    # that failed.
+    connect_database()
+    state.finished = datetime.now()
+    if result is None or result.get("failed_pages"):
+        state.status = "failed"
+    else:
+        state.status = "success"
+    if result is not None:
+        state.fetched = result.get("fetched", 0)
+        state.created = result.get("created", 0)
+        state.modified = result.get("modified", 0)
+        state.skipped = result.get("skipped", 0)
+        state.watermark = result.get("watermark")
+    if state.watermark is None and previous is not None:
+        state.watermark = previous.watermark
+    state.save(only=[SyncState.finished, SyncState.status, SyncState.fetched, SyncState.created, SyncState.modified,
+                     SyncState.skipped, SyncState.watermark])
+    disconnect_database()
+    return state
 
-def update_ms_item_in_postgres(item_in_json, sid):
+def parse_published_date(published_date):
+    # The whole ISO 8601 value, fractional seconds included; one with a UTC
+    # offset is converted to naive UTC, as utcnow() fills in missing dates.
+    try:
+        parsed = datetime.fromisoformat(published_date.replace("Z", "+00:00"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def track_published_date(details, feed_meta):
+    # Pass records through while recording the count and the highest
+    # published date seen, which becomes the next incremental watermark.
+    feed_meta.setdefault("fetched", 0)
+    for item_in_details in details:
+        feed_meta["fetched"] += 1
+        published_date = parse_published_date(item_in_details.get("publishedDate"))
+        if published_date is not None and \
+                (feed_meta.get("watermark") is None or published_date > feed_meta["watermark"]):
+            feed_meta["watermark"] = published_date
+        yield item_in_details
+
+def load_ms_snapshot():
+    # NATURAL_KEY -> (id, fingerprint) for every stored row, read as plain
+    # tuples in one query so no model instances are built. Lookup references
+    # in the key are decoded through the lookup cache.
     connect_database()
-    modified = False
-
-    ms = MS.get_by_id(sid)
-
-    if ms.cve_number != item_in_json["cve_number"] or \
-        ms.cve_url != item_in_json["cve_url"] or \
-        ms.name != item_in_json["name"] or \
-        ms.platform != item_in_json["platform"] or \
-        ms.family != item_in_json["family"] or \
-        ms.impact_id != item_in_json["impact_id"] or \
-        ms.impact != item_in_json["impact"] or \
-        ms.severity_id != item_in_json["severity_id"] or \
-        ms.severity != item_in_json["severity"] or \
-        ms.knowledge_base_id != item_in_json["knowledge_base_id"] or \
-        ms.knowledge_base_url != item_in_json["knowledge_base_url"] or \
-        ms.monthly_knowledge_base_id != item_in_json["monthly_knowledge_base_id"] or \
-        ms.monthly_knowledge_base_url != item_in_json["monthly_knowledge_base_url"] or \
-        ms.download_url1 != item_in_json["download_url1"] or \
-        ms.download_title1 != item_in_json["download_title1"] or \
-        ms.download_url2 != item_in_json["download_url2"] or \
-        ms.download_title2 != item_in_json["download_title2"] or \
-        ms.download_url3 != item_in_json["download_url3"] or \
-        ms.download_title3 != item_in_json["download_title3"] or \
-        ms.download_url4 != item_in_json["download_url4"] or \
-        ms.download_title4 != item_in_json["download_title4"] or \
-        ms.article_url1 != item_in_json["article_url1"] or \
-        ms.article_title1 != item_in_json["article_title1"] or \
-        ms.article_url2 != item_in_json["article_url2"] or \
-        ms.article_title2 != item_in_json["article_title2"] or \
-        ms.article_url3 != item_in_json["article_url3"] or \
-        ms.article_title3 != item_in_json["article_title3"] or \
-        ms.article_url4 != item_in_json["article_url4"] or \
-            ms.article_title4 != item_in_json["article_title4"]:
-        modified = True
-
-    if modified:
-        item_in_json["published_date"] = datetime.utcnow() if item_in_json["published_date"] == "undefined" else item_in_json["published_date"]
-        ms.cve_number = item_in_json["cve_number"]
-        ms.cve_url = item_in_json["cve_url"]
-        ms.name = item_in_json["name"]
-        ms.platform = item_in_json["platform"]
-        ms.family = item_in_json["family"]
-        ms.impact_id = item_in_json["impact_id"]
-        ms.impact = item_in_json["impact"]
-        ms.severity_id = item_in_json["severity_id"]
-        ms.severity = item_in_json["severity"]
-        ms.knowledge_base_id = item_in_json["knowledge_base_id"]
-        ms.knowledge_base_url = item_in_json["knowledge_base_url"]
-        ms.monthly_knowledge_base_id = item_in_json["monthly_knowledge_base_id"]
-        ms.monthly_knowledge_base_url = item_in_json["monthly_knowledge_base_url"]
-        ms.download_url1 = item_in_json["download_url1"]
-        ms.download_title1 = item_in_json["download_title1"]
-        ms.download_url2 = item_in_json["download_url2"]
-        ms.download_title2 = item_in_json["download_title2"]
-        ms.download_url3 = item_in_json["download_url3"]
-        ms.download_title3 = item_in_json["download_title3"]
-        ms.download_url4 = item_in_json["download_url4"]
-        ms.download_title4 = item_in_json["download_title4"]
-        ms.article_url1 = item_in_json["article_url1"]
-        ms.article_title1 = item_in_json["article_title1"]
-        ms.article_url2 = item_in_json["article_url2"]
-        ms.article_title2 = item_in_json["article_title2"]
-        ms.article_url3 = item_in_json["article_url3"]
-        ms.article_title3 = item_in_json["article_title3"]
-        ms.article_url4 = item_in_json["article_url4"]
-        ms.article_title4 = item_in_json["article_title4"]
-        ms.save()
+    snapshot = dict()
+    query = MS.select(*[getattr(MS, key) for key in MS_KEY_COLUMNS] + [MS.id, MS.fingerprint]).tuples()
+    lookups = [(position, column) for position, (column, key) in enumerate(zip(NATURAL_KEY, MS_KEY_COLUMNS)) if column != key]
+    for row in query.iterator():
+        key = row[:-2]
+        if lookups:
+            key = list(key)
+            for position, column in lookups:
+                key[position] = lookup_cache.value(column, key[position])
+            key = tuple(key)
+        snapshot[key] = row[-2:]
+    disconnect_database()
+    return snapshot
+
+def diff_ms_snapshot(records, snapshot):
+    # Split normalized records into rows to insert, rows to update and rows
+    # that are unchanged. The snapshot is updated as we go so repeated keys in
+    # the feed are only written once.
+    inserts = []
+    updates = []
+    unchanged = []
+    for record in records:
+        key = ms_natural_key(record)
+        stored = snapshot.get(key)
+        if stored is None:
+            inserts.append(record)
+        elif stored[1] != record.fingerprint:
+            updates.append(record)
+        else:
+            unchanged.append(record)
+            continue
+        snapshot[key] = (stored[0] if stored else None, record.fingerprint)
+    return inserts, updates, unchanged
+
+def ms_upsert_rows(records):
+    # MS rows keyed by their stored natural key (MS_KEY_COLUMNS); the last
+    # record of a repeated key wins.
+    rows = dict()
+    for record in records:
+        row = ms_row(record._asdict())
+        row["published_date"] = datetime.utcnow() if row["published_date"] == "undefined" else row["published_date"]
+        rows[ms_row_key(row)] = row
+    return rows
+
+def ms_upsert_query(rows, update_existing=True):
+    # One INSERT ... ON CONFLICT DO UPDATE for the rows; rows with an
+    # unchanged fingerprint are not touched and are not returned. xmax = 0
+    # marks a freshly inserted row (a partitioned table cannot return xmax,
+    # see mark_created_rows). With update_existing off existing keys are
+    # left alone (ON CONFLICT DO NOTHING).
+    # modified_date is not in the rows, so the insert default (now) is what
+    # an update preserves.
+    update_fields = [
+        field for field in MS._meta.sorted_fields
+        if field.column_name not in MS_KEY_COLUMNS and field.name not in ("id", "published_date")
+    ]
+    query = MS.insert_many(list(rows.values()))
+    if update_existing:
+        query = query.on_conflict(
+            conflict_target=[getattr(MS, key) for key in MS_UNIQUE_COLUMNS],
+            preserve=update_fields,
+            where=(MS.fingerprint != peewee.EXCLUDED.fingerprint))
+    else:
+        query = query.on_conflict_ignore()
+    created = peewee.SQL("NULL" if ms_partitioned else "(xmax = 0)")
+    return query.returning(*[getattr(MS, key) for key in MS_KEY_COLUMNS] + [MS.id, created])
+
+def mark_created_rows(returned, old_rows):
+    # Rows ms_upsert_query returned from a partitioned table, marked as
+    # created when their key was not there before the upsert (old_rows).
+    key_length = len(MS_KEY_COLUMNS)
+    return [tuple(row[:-1]) + (tuple(row[:key_length]) not in old_rows, ) for row in returned]
+
+def add_upsert_outcomes(rows, returned, stats=None):
+    # Sort the rows ms_upsert_query returned into created and modified; the
+    # other rows were skipped. Returns (created, modified, skipped).
+    created = []
+    modified = []
+    for returned_row in returned:
+        if returned_row[-1]:
+            created.append(tuple(returned_row[:len(MS_KEY_COLUMNS)]))
+        else:
+            modified.append(tuple(returned_row[:len(MS_KEY_COLUMNS)]))
+    skipped = len(rows) - len(created) - len(modified)
+    if stats is not None:
+        stats.add("created", len(created), (key[0] for key in created))
+        stats.add("modified", len(modified), (key[0] for key in modified))
+        if stats.samples is not None and skipped:
+            written = set(created).union(modified)
+            stats.add("skipped", skipped, (key[0] for key in rows if key not in written))
+        else:
+            stats.add("skipped", skipped)
+    return len(created), len(modified), skipped
+
+def ms_change_probe_query(rows):
+    # Current CHANGE_COLUMNS and published_date of the rows' keys, so a
+    # change record can tell which columns an update changed.
+    return MS.select(*[getattr(MS, key) for key in MS_KEY_COLUMNS + CHANGE_COLUMNS] + [MS.published_date]).where(
+        peewee.Tuple(*[getattr(MS, key) for key in MS_KEY_COLUMNS]).in_(list(rows))).tuples()
+
+def keep_published_dates(rows, old_rows):
+    # A partitioned MS is unique on the natural key plus published_date: rows
+    # that exist take their stored published_date (which an update keeps
+    # anyway) so the upsert conflicts with them instead of adding a row.
+    for key, old_row in old_rows.items():
+        rows[key]["published_date"] = old_row[-1]
+
+def ms_changes(sync_id, rows, old_rows, returned):
+    # MSChange rows for what an upsert returned: created rows, and modified
+    # rows with the columns whose stored value differs from old_rows (keyed
+    # like rows, as read by ms_change_probe_query).
+    now = datetime.now()
+    key_length = len(MS_KEY_COLUMNS)
+    changes = []
+    for returned_row in returned:
+        key = tuple(returned_row[:key_length])
+        columns = []
+        if not returned_row[-1]:
+            row = rows[key]
+            old_row = old_rows.get(key)
+            for position, column in enumerate(CHANGE_COLUMNS):
+                value = MS._meta.columns[column].db_value(row[column]) if column in row else None
+                if old_row is None or old_row[key_length + position] != value:
+                    columns.append(LOOKUP_REFS.get(column, column))
+        changes.append(dict(
+            sync_id=sync_id, ms_id=returned_row[key_length], cve_number=key[0],
+            change="created" if returned_row[-1] else "modified", columns=columns, changed=now))
+    return changes
+
+def upsert_ms_items_in_postgres(records, update_existing=True, stats=None):
+    # Write a chunk of records through ms_upsert_query, with its change log
+    # entries in the same transaction. Outcomes are also added to stats.
+    rows = ms_upsert_rows(records)
+    skipped = len(records) - len(rows)
+    if stats is not None:
+        stats.add("skipped", skipped)
+    if not rows:
+        return 0, 0, skipped
 
+    connect_database()
+    begin_sync_write()
+    old_rows = dict()
+    if ms_partitioned or (change_log_enabled and update_existing):
+        old_rows = dict((tuple(row[:len(MS_KEY_COLUMNS)]), row) for row in ms_change_probe_query(rows).execute())
+        if ms_partitioned:
+            keep_published_dates(rows, old_rows)
+    returned = list(ms_upsert_query(rows, update_existing).tuples().execute())
+    if ms_partitioned:
+        returned = mark_created_rows(returned, old_rows)
+    if change_log_enabled and returned:
+        MSChange.insert_many(ms_changes(current_sync_id(), rows, old_rows, returned)).execute()
+    end_sync_write(len(rows))
     disconnect_database()
-    if modified:
-        return "modified"
-    return "skipped"
-
-def create_of_update_ms_item_in_postgres(item_in_json):
-    exists, sid = check_if_ms_exists_in_postgres(item_in_json)
-    if exists and sid != -1:
-        result = update_ms_item_in_postgres(item_in_json, sid)
-        return result, sid
-    elif not exists and sid == -1:
-        sid = create_ms_item_in_postgres(item_in_json)
-        return "created", sid
-
-def update_ms_vulners():
-    data_json = get_msbulletin(SOURCE_FILE)
+    created, modified, skipped_rows = add_upsert_outcomes(rows, returned, stats)
+    return created, modified, skipped + skipped_rows
+
+# How each MS column is filled from a security-guidance details[] record.
+# Rules:
+#   "keep"  - the value as sent, undefined when the key is missing
+#   "none"  - undefined when missing or null
+#   "empty" - undefined when missing, null or ""
+#   "url"   - undefined when missing, null or containing a space
+MS_FIELD_MAP = (
+    ("published_date", "publishedDate", "keep"),
+    ("cve_number", "cveNumber", "keep"),
+    ("cve_url", "cveUrl", "keep"),
+    ("name", "name", "keep"),
+    ("platform", "platform", "none"),
+    ("family", "family", "empty"),
+    ("impact_id", "impactId", "empty"),
+    ("impact", "impact", "empty"),
+    ("severity_id", "severityId", "empty"),
+    ("severity", "severity", "empty"),
+    ("knowledge_base_id", "knowledgeBaseId", "empty"),
+    ("knowledge_base_url", "knowledgeBaseUrl", "url"),
+    ("monthly_knowledge_base_id", "monthlyKnowledgeBaseId", "empty"),
+    ("monthly_knowledge_base_url", "monthlyKnowledgeBaseUrl", "url"),
+    ("article_title1", "articleTitle1", "empty"),
+    ("article_url1", "articleUrl1", "url"),
+    ("article_title2", "articleTitle2", "empty"),
+    ("article_url2", "articleUrl2", "url"),
+    ("article_title3", "articleTitle3", "empty"),
+    ("article_url3", "articleUrl3", "url"),
+    ("article_title4", "articleTitle4", "empty"),
+    ("article_url4", "articleUrl4", "url"),
+    ("download_title1", "downloadTitle1", "empty"),
+    ("download_url1", "downloadUrl1", "url"),
+    ("download_title2", "downloadTitle2", "empty"),
+    ("download_url2", "downloadUrl2", "url"),
+    ("download_title3", "downloadTitle3", "empty"),
+    ("download_url3", "downloadUrl3", "url"),
+    ("download_title4", "downloadTitle4", "empty"),
+    ("download_url4", "downloadUrl4", "url"),
+)
+
+MS_COLUMNS = tuple(column for column, _, _ in MS_FIELD_MAP) + ("fingerprint", )
+
+NORMALIZE_RULES = {
+    "none": "{0} is None",
+    "empty": "{0} is None or {0} == ''",
+    "url": "{0} is None or ' ' in {0}",
+}
+
+def compile_ms_normalizer(field_map=MS_FIELD_MAP, fingerprint_fields=FINGERPRINT_FIELDS):
+    # Turn the field map into the source of a single function that reads each
+    # key once, hashes the values with one %-format (the same value
+    # ms_fingerprint computes) and packs them into a fixed-field record tuple,
+    # then compile it. The record type is kept on the function as record_type.
+    lines = ["def normalize_ms_item(item_in_details):", "    get = item_in_details.get"]
+    columns = dict()
+    for position, (column, source_key, rule) in enumerate(field_map):
+        value = "v{}".format(position)
+        columns[column] = value
+        if rule == "keep":
+            lines.append("    {} = get({!r}, undefined)".format(value, source_key))
+            continue
+        if rule not in NORMALIZE_RULES:
+            raise ValueError("Unknown normalize rule {!r} for {}".format(rule, column))
+        lines.append("    {} = get({!r})".format(value, source_key))
+        lines.append("    if {}:".format(NORMALIZE_RULES[rule].format(value)))
+        lines.append("        {} = undefined".format(value))
+    values = list(columns.values())
+    if fingerprint_fields:
+        fingerprint_format = FINGERPRINT_SEPARATOR.join(["%s"] * len(fingerprint_fields))
+        lines.append("    fingerprint = md5(({!r} % ({},)).encode('utf-8')).hexdigest()".format(
+            fingerprint_format, ", ".join(columns[field] for field in fingerprint_fields)))
+        values.append("fingerprint")
+    record_type = namedtuple("MSRecord", list(columns) + (["fingerprint"] if fingerprint_fields else []))
+    lines.append("    return new(MSRecord, (" + ", ".join(values) + ",))")
+    namespace = {"undefined": undefined, "md5": hashlib.md5, "new": tuple.__new__, "MSRecord": record_type}
+    exec(compile("\n".join(lines), "<normalize_ms_item>", "exec"), namespace)
+    normalize = namespace["normalize_ms_item"]
+    normalize.record_type = record_type
+    return normalize
+
+normalize_ms_item = compile_ms_normalizer()
+
+# Normalized feed records travel between stages as MSRecord tuples (one slot
+# per MS_COLUMNS entry) rather than dicts; use record._asdict() where a
+# mapping is needed.
+MSRecord = normalize_ms_item.record_type
+ms_natural_key = attrgetter(*NATURAL_KEY)
+ms_row_key = itemgetter(*MS_KEY_COLUMNS)
+
+def normalize_ms_items(details):
+    return [normalize_ms_item(item_in_details) for item_in_details in details]
+
+class SyncStats(object):
+    # Outcome counters for one sync plus, when sample_size is set, the last
+    # sample_size CVE numbers seen for each outcome. Unpacks as
+    # (created, modified, skipped).
+    __slots__ = ("created", "modified", "skipped", "samples")
+
+    OUTCOMES = ("created", "modified", "skipped")
+
+    def __init__(self, sample_size=0):
+        self.created = 0
+        self.modified = 0
+        self.skipped = 0
+        self.samples = None
+        if sample_size > 0:
+            self.samples = dict((outcome, deque(maxlen=sample_size)) for outcome in self.OUTCOMES)
+
+    def add(self, outcome, count, ids=()):
+        setattr(self, outcome, getattr(self, outcome) + count)
+        if self.samples is not None:
+            self.samples[outcome].extend(ids)
+
+    def __iter__(self):
+        return iter((self.created, self.modified, self.skipped))
+
+    def merge(self, other):
+        for outcome in self.OUTCOMES:
+            self.add(outcome, getattr(other, outcome), other.samples[outcome] if other.samples else ())
+
+
+def iter_normalized_chunks(details, processes=normalize_processes, size=write_batch_size):
+    # normalize_ms_items over chunks of details in a process pool. Chunks come
+    # back in feed order and at most 2 * processes are in flight.
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        pending = deque()
+        for chunk in chunked(details, size):
+            pending.append(executor.submit(normalize_ms_items, chunk))
+            if len(pending) >= processes * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def ms_shard(record, shards):
+    key = FINGERPRINT_SEPARATOR.join(str(value) for value in ms_natural_key(record))
+    return zlib.crc32(key.encode("utf-8")) % shards
+
+SHARD_DONE = None
+SHARD_ABORT = "abort"
+
+def shard_writer(queue, update_existing, stats, errors, sync_id=None):
+    # Writer thread: its own SyncSession (and so its own connection and
+    # transactions) for the batches of one shard. After a failure it keeps
+    # draining the queue so the producer never blocks.
+    try:
+        with SyncSession(sync_id=sync_id) as session:
+            while True:
+                batch = queue.get()
+                if batch is SHARD_DONE:
+                    session.commit()
+                    break
+                if batch is SHARD_ABORT:
+                    session.rollback()
+                    break
+                upsert_ms_items_in_postgres(batch, update_existing, stats)
+    except Exception as ex:
+        errors.append(ex)
+        while queue.get() not in (SHARD_DONE, SHARD_ABORT):
+            pass
+
+
+class ShardedWriter(object):
+    # Spreads records over `connections` writer threads by crc32 of the
+    # natural key, so a key is always written by the same connection and no
+    # two writers touch the same row. Every chunk is split into one batch per
+    # shard and each shard writes its batches in feed order: the rows of a
+    # batch and the duplicates folded within it are the same as in a serial
+    # sync, so are the created/modified/skipped totals.
+
+    def __init__(self, connections=writer_connections, update_existing=True, sample_size=outcome_sample_size):
+        self.connections = connections
+        self.update_existing = update_existing
+        self.sync_id = current_sync_id()
+        self.queues = [Queue(maxsize=4) for _ in range(connections)]
+        self.stats = [SyncStats(sample_size) for _ in range(connections)]
+        self.errors = []
+        self.threads = []
+
+    def __enter__(self):
+        for queue, stats in zip(self.queues, self.stats):
+            thread = threading.Thread(target=shard_writer, args=(queue, self.update_existing, stats, self.errors, self.sync_id))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for queue in self.queues:
+            queue.put(SHARD_DONE if exc_type is None else SHARD_ABORT)
+        for thread in self.threads:
+            thread.join()
+        if exc_type is None and self.errors:
+            raise self.errors[0]
+
+    def write(self, records):
+        batches = [[] for _ in range(self.connections)]
+        for record in records:
+            batches[ms_shard(record, self.connections)].append(record)
+        for batch, queue in zip(batches, self.queues):
+            if batch:
+                queue.put(batch)
+        if self.errors:
+            raise self.errors[0]
+
+
+def sync_ms_items(details, update_existing=True, parallel=parallel_sync):
+    # parallel: normalize in a process pool and write through ShardedWriter.
+    stats = SyncStats(outcome_sample_size)
+    snapshot = None
+    if sync_mode == "snapshot":
+        with measure_stage("snapshot"):
+            snapshot = load_ms_snapshot()
+    if parallel:
+        chunks = measure_iter("normalize", iter_normalized_chunks(details), count=len)
+        writer = ShardedWriter(writer_connections, update_existing)
+    else:
+        chunks = chunked(measure_iter("normalize", map(normalize_ms_item, details)), write_batch_size)
+        writer = None
+    with writer or nullcontext():
+        write_ms_chunks(chunks, snapshot, update_existing, stats, writer)
+    if writer is not None:
+        for writer_stats in writer.stats:
+            stats.merge(writer_stats)
+
+    LOGINFO_IF_ENABLED("[+] Create {} vulnerabilities".format(stats.created))
+    LOGINFO_IF_ENABLED("[+] Modify {} vulnerabilities".format(stats.modified))
+    LOGINFO_IF_ENABLED("[+] Skip   {} vulnerabilities".format(stats.skipped))
+    if stats.samples is not None:
+        for outcome in SyncStats.OUTCOMES:
+            LOGVAR_IF_ENABLED("[+] {} sample: {}".format(outcome.capitalize(), list(stats.samples[outcome])))
+    return stats
+
+def write_ms_chunks(chunks, snapshot, update_existing, stats, writer=None):
+    for chunk in chunks:
+        if snapshot is not None:
+            with measure_stage("diff", len(chunk)):
+                inserts, updates, unchanged = diff_ms_snapshot(chunk, snapshot)
+            stats.add("skipped", len(unchanged), (record.cve_number for record in unchanged))
+            if update_existing:
+                chunk = inserts + updates
+            else:
+                stats.add("skipped", len(updates), (record.cve_number for record in updates))
+                chunk = inserts
+            if not chunk:
+                continue
+        with measure_stage("write", len(chunk)):
+            if writer is not None:
+                writer.write(chunk)
+            else:
+                upsert_ms_items_in_postgres(chunk, update_existing, stats)
+
+def load_ms_items(details, feed_meta=None, force_rebuild=False):
+    # Replace the whole table with details through rebuild_ms_table. A feed
+    # that lost pages is not swapped in, nor one much smaller than the table
+    # (RebuildRefusedError) unless force_rebuild is set. With
+    # rebuild_keep_legacy the imported legacy archive is loaded first, so
+    # its rows stay and the feed's rows win over them, as after an import.
+    stats = SyncStats()
+    create_ms_change_table()
+    # The swap compares the live table with the staging one column by
+    # column, so it is brought to the configured layout first.
+    if MS.table_exists():
+        migrate_ms_table()
+    with measure_stage("write"):
+        try:
+            result = rebuild_ms_table(
+                chain(legacy_ms_items(force_rebuild), measure_iter("normalize", map(normalize_ms_item, details))),
+                complete=lambda: not (feed_meta or {}).get("failed_pages"),
+                change_log=change_log_enabled, sync_id=current_sync_id(),
+                min_ratio=0 if force_rebuild else rebuild_min_ratio)
+        except RebuildRefusedError as ex:
+            LOGERR_IF_ENABLED("[e] {}".format(ex))
+            raise
+    if result is None:
+        LOGERR_IF_ENABLED("[e] Incomplete feed, keep the current {} table".format(MS._meta.table_name))
+        return stats
+    loaded, duplicates, (created, modified, removed) = result
+    invalidate_ms_cache()
+    add_rows("write", loaded)
+    # Outcomes against the replaced table, as a sync would count them:
+    # unchanged rows and dropped duplicates are skipped.
+    unchanged = loaded - duplicates - created - modified
+    stats.add("created", created)
+    stats.add("modified", modified)
+    stats.add("skipped", unchanged + duplicates)
+    LOGINFO_IF_ENABLED("[+] Load {} vulnerabilities: {} created, {} modified, {} unchanged, {} removed, "
+                       "{} duplicates dropped".format(loaded - duplicates, created, modified, unchanged, removed,
+                                                     duplicates))
+    return stats
+
+def update_ms_vulners(from_date=FULL_SYNC_FROM_DATE, recorder=None, rebuild=False, checkpoint=None, force_rebuild=False):
+    # With rebuild set the feed replaces the table (load_ms_items) instead of
+    # being synced into it. With a checkpoint, paged serial syncs skip the
+    # pages it lists and keep it up to date at every commit; rebuilds and
+    # parallel writers commit elsewhere and are not checkpointed.
+    feed_meta = dict()
+    skip_pages = ()
+    if rebuild:
+        write_ms_items = lambda details: load_ms_items(details, feed_meta, force_rebuild)
+    else:
+        write_ms_items = sync_ms_items
+        if checkpoint is not None and fetch_pages and not parallel_sync and current_sync_session() is not None:
+            skip_pages = checkpoint.resume(feed_meta)
+            if skip_pages:
+                LOGINFO_IF_ENABLED("[+] Resume: skip {} finished pages".format(len(skip_pages)))
+            current_sync_session().before_commit = lambda: checkpoint.save(feed_meta)
+    if fetch_pages or stream_feed:
+        if fetch_pages:
+            details = iter_msbulletin_pages(SOURCE_FILE, from_date=from_date, meta=feed_meta, recorder=recorder,
+                                            skip_pages=skip_pages, skip_count=checkpoint and checkpoint.data.get("count"))
+        else:
+            details = iter_msbulletin(SOURCE_FILE, from_date=from_date, meta=feed_meta, recorder=recorder)
+        details = measure_iter("fetch", details)
+        created, modified, skipped = write_ms_items(track_published_date(details, feed_meta))
+        feed_meta.update(created=created, modified=modified, skipped=skipped)
+        LOGINFO_IF_ENABLED("[+] Get {} vulnerabilities from MS database".format(
+            feed_meta.get("count", feed_meta["fetched"])))
+        if feed_meta["fetched"] == 0:
+            LOGERR_IF_ENABLED("[e] Get empty data set from MS source")
+        return feed_meta
+
+    with measure_stage("fetch"):
+        data_json = get_msbulletin(SOURCE_FILE, from_date=from_date, recorder=recorder)
     if isinstance(data_json, dict):
         count = data_json.get("count", 0)
         LOGINFO_IF_ENABLED("[+] Get {} vulnerabilities from MS database".format(count))
-        # with open("ms.json", "w") as mf:
-        #     json.dump(data_json, mf)
         if count > 0:
             details = data_json.get("details", [])
             if len(details) != 0:
-                created = []
-                modified = []
-                skipped = []
-                for item_in_details in details:
-
-                    item_in_json = dict()
-
-                    item_in_json["published_date"] = item_in_details.get("publishedDate", undefined)
-
-                    item_in_json["cve_number"] = item_in_details.get("cveNumber", undefined)
-
-                    item_in_json["cve_url"] = item_in_details.get("cveUrl", undefined)
-
-                    item_in_json["name"] = item_in_details.get("name", undefined)
-
-                    item_in_json["platform"] = item_in_details.get("platform", None)
-                    if item_in_json["platform"] is None:
-                        item_in_json["platform"] = undefined
-
-                    item_in_json["family"] = item_in_details.get("family", None)
-                    if item_in_json["family"] is None or item_in_json["family"] == "":
-                        item_in_json["family"] = undefined
-
-                    item_in_json["impact_id"] = item_in_details.get("impactId", None)
-                    if item_in_json["impact_id"] is None or item_in_json["impact_id"] == "":
-                        item_in_json["impact_id"] = undefined
-
-                    item_in_json["impact"] = item_in_details.get("impact", None)
-                    if item_in_json["impact"] is None or item_in_json["impact"] == "":
-                        item_in_json["impact"] = undefined
-
-                    item_in_json["severity_id"] = item_in_details.get("severityId", None)
-                    if item_in_json["severity_id"] is None or item_in_json["severity_id"] == "":
-                        item_in_json["severity_id"] = undefined
-
-                    item_in_json["severity"] = item_in_details.get("severity", None)
-                    if item_in_json["severity"] is None or item_in_json["severity"] == "":
-                        item_in_json["severity"] = undefined
-
-                    item_in_json["knowledge_base_id"] = item_in_details.get("knowledgeBaseId", None)
-                    if item_in_json["knowledge_base_id"] is None or item_in_json["knowledge_base_id"] == "":
-                        item_in_json["knowledge_base_id"] = undefined
-
-                    item_in_json["knowledge_base_url"] = item_in_details.get("knowledgeBaseUrl", None)
-                    if item_in_json["knowledge_base_url"] is None or ' ' in item_in_json["knowledge_base_url"]:
-                        item_in_json["knowledge_base_url"] = undefined
-
-                    item_in_json["monthly_knowledge_base_id"] = item_in_details.get("monthlyKnowledgeBaseId", None)
-                    if item_in_json["monthly_knowledge_base_id"] is None or item_in_json["monthly_knowledge_base_id"] == "":
-                        item_in_json["monthly_knowledge_base_id"] = undefined
-
-                    item_in_json["monthly_knowledge_base_url"] = item_in_details.get("monthlyKnowledgeBaseUrl", None)
-                    if item_in_json["monthly_knowledge_base_url"] is None or ' 'in item_in_json["monthly_knowledge_base_url"]:
-                        item_in_json["monthly_knowledge_base_url"] = undefined
-
-                    item_in_json["article_title1"] = item_in_details.get("articleTitle1", None)
-                    if item_in_json["article_title1"] is None or item_in_json["article_title1"] == "":
-                        item_in_json["article_title1"] = undefined
-
-                    item_in_json["article_url1"] = item_in_details.get("articleUrl1", None)
-                    if item_in_json["article_url1"] is None or ' ' in item_in_json["article_url1"]:
-                        item_in_json["article_url1"] = undefined
-
-                    item_in_json["article_title2"] = item_in_details.get("articleTitle2", None)
-                    if item_in_json["article_title2"] is None or item_in_json["article_title2"] == "":
-                        item_in_json["article_title2"] = undefined
-
-                    item_in_json["article_url2"] = item_in_details.get("articleUrl2", None)
-                    if item_in_json["article_url2"] is None or ' ' in item_in_json["article_url2"]:
-                        item_in_json["article_url2"] = undefined
-
-                    item_in_json["article_title3"] = item_in_details.get("articleTitle3", None)
-                    if item_in_json["article_title3"] is None or item_in_json["article_title3"] == "":
-                        item_in_json["article_title3"] = undefined
-
-                    item_in_json["article_url3"] = item_in_details.get("articleUrl3", None)
-                    if item_in_json["article_url3"] is None or ' ' in item_in_json["article_url3"]:
-                        item_in_json["article_url3"] = undefined
-
-                    item_in_json["article_title4"] = item_in_details.get("articleTitle4", None)
-                    if item_in_json["article_title4"] is None or item_in_json["article_title4"] == "":
-                        item_in_json["article_title4"] = undefined
-
-                    item_in_json["article_url4"] = item_in_details.get("articleUrl4", None)
-                    if item_in_json["article_url4"] is None or ' ' in item_in_json["article_url4"]:
-                        item_in_json["article_url4"] = undefined
-
-                    item_in_json["download_title1"] = item_in_details.get("downloadTitle1", None)
-                    if item_in_json["download_title1"] is None or item_in_json["download_title1"]:
-                        item_in_json["download_title1"] = undefined
-
-                    item_in_json["download_url1"] = item_in_details.get("downloadUrl1", None)
-                    if item_in_json["download_url1"] is None or ' ' in item_in_json["download_url1"]:
-                        item_in_json["download_url1"] = undefined
-
-                    item_in_json["download_title2"] = item_in_details.get("downloadTitle2", None)
-                    if item_in_json["download_title2"] is None or item_in_json["download_title2"] == "":
-                        item_in_json["download_title2"] = undefined
-
-                    item_in_json["download_url2"] = item_in_details.get("downloadUrl2", None)
-                    if item_in_json["download_url2"] is None or ' ' in item_in_json["download_url2"]:
-                        item_in_json["download_url2"] = undefined
-
-                    item_in_json["download_title3"] = item_in_details.get("downloadTitle3", None)
-                    if item_in_json["download_title3"] is None or item_in_json["download_title3"] == "":
-                        item_in_json["download_title3"] = undefined
-
-                    item_in_json["download_url3"] = item_in_details.get("downloadUrl3", None)
-                    if item_in_json["download_url3"] is None or ' ' in item_in_json["download_url3"]:
-                        item_in_json["download_url3"] = undefined
-
-                    item_in_json["download_title4"] = item_in_details.get("downloadTitle4", None)
-                    if item_in_json["download_title4"] is None or item_in_json["download_title4"] == "":
-                        item_in_json["download_title4"] = undefined
-
-                    item_in_json["download_url4"] = item_in_details.get("downloadUrl4", None)
-                    if item_in_json["download_url4"] is None or ' ' in item_in_json["download_url4"]:
-                        item_in_json["download_url4"] = undefined
-
-                    result, sid = create_of_update_ms_item_in_postgres(item_in_json)
-
-                    if result == "created":
-                        created.append(item_in_json)
-                    elif result == "modified":
-                        modified.append(item_in_json)
-                    else:
-                        skipped.append(item_in_json)
-
-                LOGINFO_IF_ENABLED("[+] Create {} vulnerabilities".format(len(created)))
-                LOGINFO_IF_ENABLED("[+] Modify {} vulnerabilities".format(len(modified)))
-                LOGINFO_IF_ENABLED("[+] Skip   {} vulnerabilities".format(len(skipped)))
+                created, modified, skipped = write_ms_items(track_published_date(details, feed_meta))
+                feed_meta.update(created=created, modified=modified, skipped=skipped)
             else:
                 LOGERR_IF_ENABLED("[e] Get empty data set from MS source")
         else:
             LOGERR_IF_ENABLED("[e] Get 0 items from MS source")
     else:
         LOGERR_IF_ENABLED("[e] Get not JSON data from MS source")
+    return feed_meta
 
-def run():
-    if drop_ms_table_before:
-        drop_ms_table()
-        create_ms_table()
+LEGACY_DATE_FORMATS = ("%Y%m%d", "%m/%d/%Y", "%Y-%m-%d", "%Y-%m-%dT%H:%M:%S")
 
-    update_ms_vulners()
+def parse_legacy_date(value):
+    for date_format in LEGACY_DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip()[:19], date_format).strftime("%Y-%m-%dT%H:%M:%S")
+        except (AttributeError, ValueError):
+            pass
+    return None
+
+def legacy_bulletin_to_details(record):
+    # Records that already look like security-guidance details[] entries pass
+    # through; BulletinSearch rows ("Bulletin Id", "CVEs", ...) are expanded
+    # into one details entry per CVE so normalize_ms_item applies unchanged.
+    if "cveNumber" in record:
+        return [record]
+    if isinstance(record.get("details"), list):
+        return record["details"]
+    bulletin_id = (record.get("Bulletin Id") or "").strip()
+    knowledge_base_id = (record.get("Component KB") or record.get("Bulletin KB") or "").strip()
+    bulletin_url = "https://technet.microsoft.com/library/security/{}".format(bulletin_id.lower()) if bulletin_id else None
+    details = []
+    for cve_number in (record.get("CVEs") or "").split(","):
+        cve_number = cve_number.strip()
+        if not cve_number:
+            continue
+        details.append({
+            "publishedDate": parse_legacy_date(record.get("Date Posted")) or undefined,
+            "cveNumber": cve_number,
+            "cveUrl": bulletin_url,
+            "name": (record.get("Affected Product") or "").strip() or undefined,
+            "platform": (record.get("Affected Component") or "").strip() or None,
+            "impact": record.get("Impact"),
+            "severity": record.get("Severity"),
+            "knowledgeBaseId": knowledge_base_id,
+            "knowledgeBaseUrl": "https://support.microsoft.com/kb/{}".format(knowledge_base_id) if knowledge_base_id else None,
+            "articleTitle1": record.get("Title"),
+            "articleUrl1": bulletin_url,
+        })
+    return details
+
+def iter_legacy_bulletins(path=GZIP_FILE):
+    # Stream records out of the gzip archive without decompressing it to
+    # memory. A JSON array, a JSON object with details[], JSON lines and a
+    # BulletinSearch CSV export are recognised by their first line.
+    with gzip.open(path, "rt", encoding="utf-8-sig", newline="") as archive:
+        first_line = archive.readline()
+        rest = iter(lambda: archive.read(stream_chunk_size), "")
+        if first_line.lstrip().startswith("["):
+            records = iter_json_array_items(chain([first_line], rest))
+        elif first_line.lstrip().startswith("{"):
+            try:
+                first_record = json.loads(first_line)
+            except ValueError:
+                records = iter_json_field_items(chain([first_line], rest), "details")
+            else:
+                records = chain([first_record], (json.loads(line) for line in archive if line.strip()))
+        else:
+            records = csv.DictReader(chain([first_line], archive))
+        for record in records:
+            for item_in_details in legacy_bulletin_to_details(record):
+                yield item_in_details
+
+def import_legacy_bulletins(path=GZIP_FILE):
+    # Load the pre-portal bulletin archive through the batched write path.
+    # Rows that already exist (from an earlier import or from the live feed)
+    # are never overwritten, so re-running the import is a cheap no-op. The
+    # import is recorded in SyncState (with the archive path as from_date)
+    # for rebuilds to load the archive again.
+    if not os.path.exists(path):
+        LOGERR_IF_ENABLED("[e] Legacy bulletin archive not found: {}".format(path))
+        return 0, 0, 0
+    with SyncSession() as session:
+        create_ms_table()
+        create_sync_state_table()
+        created, modified, skipped = sync_ms_items(iter_legacy_bulletins(path), update_existing=False)
+        SyncState.create(source=LEGACY_SOURCE_NAME, mode="import", from_date=os.path.abspath(path), status="success",
+                         finished=datetime.now(), created=created, modified=modified, skipped=skipped)
+        session.commit()
+    return created, modified, skipped
+
+def imported_legacy_archive():
+    # Path of the latest imported legacy archive, None without an import.
+    connect_database()
+    state = None
+    if SyncState.table_exists():
+        state = SyncState.select().where(
+            (SyncState.source == LEGACY_SOURCE_NAME) &
+            (SyncState.status == "success")
+        ).order_by(SyncState.id.desc()).first()
+    disconnect_database()
+    return state.from_date if state is not None else None
+
+def legacy_ms_items(force_rebuild=False):
+    # Normalized records of the imported legacy archive for a rebuild (see
+    # load_ms_items). An archive that is gone would make the rebuild remove
+    # its rows: RebuildRefusedError, unless force_rebuild is set.
+    path = imported_legacy_archive() if rebuild_keep_legacy else None
+    if path is None:
+        return iter(())
+    if not os.path.exists(path):
+        if not force_rebuild:
+            raise RebuildRefusedError("Imported legacy archive {} not found, its rows would be removed".format(path))
+        LOGERR_IF_ENABLED("[e] Imported legacy archive {} not found, its rows are removed".format(path))
+        return iter(())
+    LOGINFO_IF_ENABLED("[+] Load the legacy archive {} into the rebuild".format(path))
+    return map(normalize_ms_item, iter_legacy_bulletins(path))
+
+@contextmanager
+def sync_metrics(report, profile_stage=profile_stage, profile_mode=profile_mode):
+    # Measure the enclosed run and write its metrics when it ends, however it
+    # ends. The caller fills `report` with the status and counts.
+    if not metrics_enabled:
+        yield
+        return
+    metrics = SyncMetrics(SOURCE_NAME, profile_stage, profile_mode)
+    try:
+        with metrics:
+            yield
+    finally:
+        data = write_metrics(metrics, **report)
+        LOGINFO_IF_ENABLED("[+] Sync took {}s, {} DB round trips, {} bytes downloaded".format(
+            data["seconds"], data["db_round_trips"], data["bytes_downloaded"]))
+        for name, stage in data["stages"].items():
+            LOGVAR_IF_ENABLED("[+] Stage {}: {}s, {} rows, {} rows/sec".format(
+                name, stage["seconds"], stage["rows"], stage["rows_per_sec"]))
+
+def sync_report(state):
+    return dict(
+        status=state.status, mode=state.mode, from_date=state.from_date, watermark=state.watermark,
+        fetched=state.fetched, created=state.created, modified=state.modified, skipped=state.skipped)
+
+def run(full_sync=not incremental_sync, profile_stage=profile_stage, profile_mode=profile_mode,
+        update_vulners=update_ms_vulners, force_rebuild=False):
+    # update_vulners fetches and writes the feed: update_ms_vulners, or
+    # async_ms.update_ms_vulners_async for the asyncio pipeline. An attempt
+    # failing on a database error is retried with backoff, resuming from the
+    # checkpoint it committed. Returns the sync report; its status is
+    # "failed" when pages could not be fetched, as in SyncState.
+    report = dict(status="failed")
+    with sync_metrics(report, profile_stage, profile_mode):
+        attempt = 1
+        while True:
+            try:
+                recorder, mode, from_date = run_attempt(full_sync, update_vulners, report, force_rebuild)
+                break
+            except (peewee.OperationalError, peewee.InterfaceError) as ex:
+                if not resume_enabled or attempt >= run_attempts:
+                    raise
+                delay = retry_backoff_seconds * 2 ** (attempt - 1)
+                LOGERR_IF_ENABLED("[e] Sync attempt {} failed, resume in {}s: {}".format(attempt, delay, ex))
+                time.sleep(delay)
+                attempt += 1
+    if recorder is not None:
+        snapshot = recorder.save(source=SOURCE_NAME, mode=mode, from_date=from_date)
+        LOGINFO_IF_ENABLED("[+] Cache snapshot {}, evicted {} old files".format(snapshot, evict_cache()))
+    if report["status"] != "success":
+        LOGERR_IF_ENABLED("[e] Sync finished with status {}: pages failed, resume with the next run".format(
+            report["status"]))
+    return report
+
+def run_attempt(full_sync, update_vulners, report, force_rebuild=False):
+    state = None
+    previous = None
+    try:
+        with SyncSession() as session:
+            create_sync_state_table()
+            if not full_sync:
+                previous = last_sync_state()
+            interrupted = interrupted_sync_state() if resume_enabled else None
+            if interrupted is not None and full_sync and interrupted.mode != "full":
+                interrupted = None
+            rebuild = False
+            if interrupted is not None:
+                mode = interrupted.mode
+                from_date = interrupted.from_date
+                LOGINFO_IF_ENABLED("[+] Resume interrupted sync {}".format(interrupted.id))
+            elif previous is None or previous.watermark is None:
+                mode = "full"
+                from_date = FULL_SYNC_FROM_DATE
+                rebuild = drop_ms_table_before and bulk_rebuild
+                if drop_ms_table_before and not bulk_rebuild:
+                    drop_ms_table()
+            else:
+                mode = "incremental"
+                from_date = (previous.watermark - timedelta(days=incremental_overlap_days)).strftime("%m/%d/%Y")
+            if not rebuild:
+                create_ms_table()
+
+            LOGINFO_IF_ENABLED("[+] Start {} sync from {}".format(mode, from_date))
+            state = start_sync_state(mode, from_date, interrupted)
+            session.sync_id = state.id
+            # A resumed run only sees part of the feed: it is not cached as a
+            # snapshot.
+            recorder = SnapshotRecorder() if cache_enabled and interrupted is None else None
+            result = update_vulners(from_date, recorder, rebuild, SyncCheckpoint(state), force_rebuild)
+            with measure_stage("commit"):
+                session.commit()
+            maintain_ms_partitions()
+        report.update(sync_report(finish_sync_state(state, result, previous)))
+    except Exception:
+        if state is not None:
+            report.update(sync_report(finish_sync_state(state, None, previous)))
+        raise
+    return recorder, mode, from_date
+
+def replay(snapshot=None, full_sync=False, profile_stage=profile_stage, profile_mode=profile_mode, force_rebuild=False):
+    # Run normalization and the database writes from a cached snapshot.
+    # Replays do not move the incremental watermark. Only a snapshot of a
+    # full run holds the whole feed: others are synced into the table even
+    # with full_sync, never dropped or rebuilt from.
+    manifest = load_snapshot(snapshot)
+    if full_sync and manifest.get("mode") != "full":
+        LOGINFO_IF_ENABLED("[+] Snapshot {} is {} from {}, sync it instead of rebuilding".format(
+            manifest["name"], manifest.get("mode"), manifest.get("from_date")))
+        full_sync = False
+    rebuild = full_sync and drop_ms_table_before and bulk_rebuild
+    report = dict(status="failed", mode="replay")
+    with sync_metrics(report, profile_stage, profile_mode), SyncSession() as session:
+        if full_sync and drop_ms_table_before and not bulk_rebuild:
+            drop_ms_table()
+        if not rebuild:
+            create_ms_table()
+        feed_meta = dict()
+        details = measure_iter("read_cache", iter_msbulletin_replay(meta=feed_meta, manifest=manifest))
+        write_ms_items = (lambda details: load_ms_items(details, force_rebuild=force_rebuild)) if rebuild else sync_ms_items
+        created, modified, skipped = write_ms_items(track_published_date(details, feed_meta))
+        with measure_stage("commit"):
+            session.commit()
+        maintain_ms_partitions()
+        report.update(status="success", fetched=feed_meta.get("fetched", 0),
+                      created=created, modified=modified, skipped=skipped)
+    LOGINFO_IF_ENABLED("[+] Replay {} vulnerabilities".format(feed_meta.get("fetched", 0)))
+    return created, modified, skipped
 
 def main():
-    run()
+    parser = argparse.ArgumentParser(description="Sync Microsoft security guidance into Postgres")
+    parser.add_argument("--full", action="store_true", help="ignore the stored watermark and resync everything")
+    parser.add_argument("--replay", nargs="?", const="latest", metavar="SNAPSHOT",
+                        help="run from a cached snapshot (the newest one by default) without network access")
+    parser.add_argument("--import-legacy", nargs="?", const=GZIP_FILE, metavar="PATH",
+                        help="import the pre-portal gzip bulletin archive")
+    parser.add_argument("--force-rebuild", action="store_true",
+                        help="swap a rebuild in even when it has far fewer rows than the current table")
+    parser.add_argument("--profile", metavar="STAGE", default=profile_stage,
+                        help="profile one stage (fetch, normalize, snapshot, diff, write, commit, read_cache)")
+    parser.add_argument("--profile-mode", choices=PROFILE_MODES, default=profile_mode)
+    args = parser.parse_args()
+    if args.import_legacy:
+        import_legacy_bulletins(args.import_legacy)
+    elif args.replay:
+        replay(None if args.replay == "latest" else args.replay, full_sync=args.full,
+               profile_stage=args.profile, profile_mode=args.profile_mode, force_rebuild=args.force_rebuild)
+    else:
+        report = run(full_sync=args.full or not incremental_sync, profile_stage=args.profile,
+                     profile_mode=args.profile_mode, force_rebuild=args.force_rebuild)
+        if report["status"] != "success":
+            sys.exit(1)
 
 
 if __name__ == "__main__":
-    main()
-
+    main()
\ No newline at end of file
@@ -0,0 +1,156 @@
+import re
+from datetime import datetime, timedelta
+
+from settings import SETTINGS
+
+from model_ms import MS, MSChange, database, ms_published_index
+
+PARTITIONING = SETTINGS.get("partitioning", {})
+
+# "year" or "month": the published_date range of one partition.
+partition_interval = PARTITIONING.get("interval", "year")
+# Partitions made ahead of the current one, so new advisories rarely land in
+# the default partition.
+partition_premake = int(PARTITIONING.get("premake", 1))
+# Partitions whose range ended more than this many days ago are dropped; 0
+# keeps everything.
+partition_retention_days = int(PARTITIONING.get("retention_days", 0))
+
+PARTITION_INTERVALS = ("year", "month")
+DEFAULT_SUFFIX = "_default"
+PARTITION_NAME = re.compile(r"_(?:y(\d{4})|m(\d{4})(\d{2}))$")
+
+if partition_interval not in PARTITION_INTERVALS:
+    raise ValueError("Unknown partition interval {!r}, expected one of {!r}".format(
+        partition_interval, PARTITION_INTERVALS))
+
+
+def interval_start(date, interval=partition_interval):
+    if interval == "year":
+        return datetime(date.year, 1, 1)
+    return datetime(date.year, date.month, 1)
+
+def next_start(start, interval=partition_interval):
+    if interval == "year":
+        return datetime(start.year + 1, 1, 1)
+    return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+def partition_name(table, start, interval=partition_interval):
+    if interval == "year":
+        return "{}_y{:04d}".format(table, start.year)
+    return "{}_m{:04d}{:02d}".format(table, start.year, start.month)
+
+def brin_index_name(table):
+    return "{}_published_date_brin".format(table)
+
+def is_partitioned(table):
+    cursor = database.execute_sql("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table, ))
+    row = cursor.fetchone()
+    return row is not None and row[0] == "p"
+
+def list_partitions(table):
+    # (name, start) of the range partitions of table, oldest first; the
+    # default partition is left out.
+    cursor = database.execute_sql(
+        "SELECT c.relname FROM pg_inherits AS i JOIN pg_class AS c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = %s::regclass", (table, ))
+    partitions = []
+    for name, in cursor.fetchall():
+        match = PARTITION_NAME.search(name)
+        if match:
+            year, month_year, month = match.groups()
+            start = datetime(int(year), 1, 1) if year else datetime(int(month_year), int(month), 1)
+            partitions.append((name, start))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+def create_partition(table, start, interval=partition_interval):
+    database.execute_sql("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)".format(
+        partition_name(table, start, interval), table), (start, next_start(start, interval)))
+
+def create_default_partition(table):
+    database.execute_sql("CREATE TABLE IF NOT EXISTS {0}{1} PARTITION OF {0} DEFAULT".format(table, DEFAULT_SUFFIX))
+
+def create_brin_index(table):
+    if ms_published_index == "brin":
+        database.execute_sql("CREATE INDEX IF NOT EXISTS {} ON {} USING brin (published_date)".format(
+            brin_index_name(table), table))
+
+def create_ms_partitions(table, starts=()):
+    # Default partition and a partition for each of starts.
+    create_default_partition(table)
+    for start in starts:
+        create_partition(table, start)
+
+def partition_starts(table, interval=partition_interval):
+    # Start of every partition range the rows of table fall in.
+    cursor = database.execute_sql("SELECT DISTINCT date_trunc('{}', published_date) FROM {}".format(interval, table))
+    return sorted(start for start, in cursor.fetchall())
+
+def split_default_partition(table, interval=partition_interval):
+    # Move the rows of the default partition into partitions of their own,
+    # one transaction per partition: the rows are moved into a new table
+    # that is then attached. Returns the names of the new partitions.
+    default_table = table + DEFAULT_SUFFIX
+    # Generated columns are computed again on insert.
+    columns = ", ".join(field.column_name for field in MS._meta.sorted_fields)
+    created = []
+    for start in partition_starts(default_table, interval):
+        name = partition_name(table, start, interval)
+        end = next_start(start, interval)
+        with database.atomic():
+            database.execute_sql("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING GENERATED)".format(name, table))
+            database.execute_sql(
+                "WITH moved AS (DELETE FROM {0} WHERE published_date >= %s AND published_date < %s RETURNING {2}) "
+                "INSERT INTO {1} ({2}) SELECT {2} FROM moved".format(default_table, name, columns), (start, end))
+            database.execute_sql("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)".format(
+                table, name), (start, end))
+        created.append(name)
+    return created
+
+def drop_expired_partitions(table, retention_days=partition_retention_days, change_log=False, sync_id=None):
+    # Drop the partitions whose whole range is older than retention_days,
+    # with a "removed" MSChange entry per row when change_log is set.
+    # Returns the names of the dropped partitions.
+    if retention_days <= 0:
+        return []
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    dropped = []
+    for name, start in list_partitions(table):
+        if next_start(start) > cutoff:
+            break
+        with database.atomic():
+            if change_log:
+                database.execute_sql(
+                    "INSERT INTO {} (sync_id, ms_id, cve_number, change, columns, changed) "
+                    "SELECT %s, id, cve_number, 'removed', '{{}}', now() FROM {} ORDER BY id".format(
+                        MSChange._meta.table_name, name), (sync_id, ))
+            database.execute_sql("DROP TABLE {}".format(name))
+        dropped.append(name)
+    return dropped
+
+def maintain_partitions(table=MS._meta.table_name, change_log=False, sync_id=None):
+    # Housekeeping around a sync: rows that went to the default partition
+    # get partitions of their own, the current and the next partition_premake
+    # partitions are made and expired partitions dropped. Returns (created,
+    # dropped) partition names.
+    create_ms_partitions(table)
+    create_brin_index(table)
+    created = split_default_partition(table)
+    existing = set(name for name, _ in list_partitions(table))
+    start = interval_start(datetime.utcnow())
+    for _ in range(partition_premake + 1):
+        if partition_name(table, start) not in existing:
+            create_partition(table, start)
+            created.append(partition_name(table, start))
+        start = next_start(start)
+    return created, drop_expired_partitions(table, change_log=change_log, sync_id=sync_id)
+
+def rename_partitions(table, old_prefix):
+    # Partitions and BRIN index of a table renamed from old_prefix take its
+    # new name as prefix.
+    database.execute_sql("ALTER INDEX IF EXISTS {} RENAME TO {}".format(brin_index_name(old_prefix), brin_index_name(table)))
+    for name, _ in list_partitions(table):
+        if name.startswith(old_prefix):
+            database.execute_sql("ALTER TABLE {} RENAME TO {}".format(name, table + name[len(old_prefix):]))
+    if database.execute_sql("SELECT to_regclass(%s)", (old_prefix + DEFAULT_SUFFIX, )).fetchone()[0]:
+        database.execute_sql("ALTER TABLE {}{} RENAME TO {}{}".format(old_prefix, DEFAULT_SUFFIX, table, DEFAULT_SUFFIX))
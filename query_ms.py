@@ -0,0 +1,189 @@
+import re
+import time
+import peewee
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from settings import SETTINGS
+
+from model_ms import MS, MSChange, SyncState, SEARCH_COLUMN, SEARCH_CONFIG, ms_column, ms_column_equals
+
+QUERY_CACHE = SETTINGS.get("query_cache", {})
+
+query_cache_enabled = bool(QUERY_CACHE.get("enabled", True))
+query_cache_max_entries = int(QUERY_CACHE.get("max_entries", 10000))
+query_cache_ttl_seconds = float(QUERY_CACHE.get("ttl_seconds", 300))
+# How often a reader looks at sync_state for a run finished by another
+# process; a sync in this process invalidates the cache directly.
+query_cache_version_check_seconds = float(QUERY_CACHE.get("version_check_seconds", 5))
+
+PRODUCT_QUERY_LIMIT = 1000
+CHANGE_QUERY_LIMIT = 1000
+SEARCH_QUERY_LIMIT = 50
+
+
+class TTLCache(object):
+    # LRU cache whose entries also expire ttl seconds after they were stored.
+
+    def __init__(self, max_entries=query_cache_max_entries, ttl=query_cache_ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def info(self):
+        with self.lock:
+            return dict(entries=len(self.entries), max_entries=self.max_entries, ttl=self.ttl,
+                        hits=self.hits, misses=self.misses)
+
+
+query_cache = TTLCache()
+
+# [sync_state version, monotonic time of the last check]
+query_cache_version = [None, 0.0]
+
+
+def sync_version():
+    # Id of the latest finished sync run; a new one means the table changed.
+    if not SyncState.table_exists():
+        return None
+    return SyncState.select(peewee.fn.MAX(SyncState.id)).where(SyncState.finished.is_null(False)).scalar()
+
+def check_sync_version():
+    now = time.monotonic()
+    if now - query_cache_version[1] < query_cache_version_check_seconds:
+        return
+    query_cache_version[1] = now
+    version = sync_version()
+    if version != query_cache_version[0]:
+        query_cache_version[0] = version
+        query_cache.clear()
+
+def invalidate_ms_cache():
+    query_cache.clear()
+
+def ms_cache_info():
+    return query_cache.info()
+
+def cached_query(function):
+    # Cache the rows a lookup returns, keyed by its arguments. Callers get
+    # their own copies so they can modify the dicts freely.
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if not query_cache_enabled:
+            return function(*args, **kwargs)
+        check_sync_version()
+        key = (function.__name__, args, tuple(sorted(kwargs.items())))
+        rows = query_cache.get(key)
+        if rows is None:
+            rows = tuple(function(*args, **kwargs))
+            query_cache.set(key, rows)
+        return [dict(row) for row in rows]
+
+    return wrapper
+
+
+# Every lookup below is served by one of the MS indexes: the natural key
+# (cve_number first), knowledge_base_id, (family, published_date) and
+# (name, published_date); search_ms by the GIN index over the search vector.
+
+@cached_query
+def get_ms_by_cve(cve_number):
+    query = MS.select().where(MS.cve_number == cve_number).order_by(
+        MS.knowledge_base_id, MS.name, ms_column("platform"))
+    return [ms.to_json for ms in query]
+
+@cached_query
+def get_ms_by_kb(knowledge_base_id):
+    query = MS.select().where(MS.knowledge_base_id == knowledge_base_id).order_by(MS.cve_number, MS.name, ms_column("platform"))
+    return [ms.to_json for ms in query]
+
+@cached_query
+def find_ms_by_product(family=None, name=None, published_from=None, published_to=None, limit=PRODUCT_QUERY_LIMIT):
+    # Rows for a product family and/or product name, newest first, with an
+    # optional published_date range (from inclusive, to exclusive).
+    if family is None and name is None:
+        raise ValueError("find_ms_by_product needs a family or a name")
+    query = MS.select()
+    if family is not None:
+        query = query.where(ms_column_equals("family", family))
+    if name is not None:
+        query = query.where(MS.name == name)
+    if published_from is not None:
+        query = query.where(MS.published_date >= published_from)
+    if published_to is not None:
+        query = query.where(MS.published_date < published_to)
+    query = query.order_by(MS.published_date.desc(), MS.id.desc()).limit(limit)
+    return [ms.to_json for ms in query]
+
+def search_query(text):
+    # Every word of text as a prefix: "win serv" -> 'win':* & 'serv':*.
+    return " & ".join("'{}':*".format(word) for word in re.findall(r"\w+", text.lower()))
+
+@cached_query
+def search_ms(text, limit=SEARCH_QUERY_LIMIT):
+    # Rows whose name or article/download titles have a word starting with
+    # each word of text, served by the GIN index over SEARCH_COLUMN. Best
+    # matches first (name over article titles over download titles), each
+    # row with its "rank".
+    terms = search_query(text)
+    if not terms:
+        return []
+    vector = peewee.SQL(SEARCH_COLUMN)
+    tsquery = peewee.fn.to_tsquery(SEARCH_CONFIG, terms)
+    rank = peewee.fn.ts_rank_cd(vector, tsquery)
+    query = MS.select(MS, rank.alias("rank")).where(peewee.Expression(vector, "@@", tsquery)).order_by(
+        rank.desc(), MS.published_date.desc(), MS.id.desc()).limit(limit)
+    return [dict(ms.to_json, rank=ms.rank) for ms in query]
+
+
+def committed_changes(query):
+    # Entries of the latest sync are held back while it runs: its parallel
+    # writers commit out of id order, and a cursor must never move past an
+    # id that is not committed yet. Syncs run one at a time, so every
+    # earlier one is done.
+    latest = SyncState.select().order_by(SyncState.id.desc()).first() if SyncState.table_exists() else None
+    if latest is not None and latest.finished is None:
+        query = query.where((MSChange.sync_id != latest.id) | MSChange.sync_id.is_null())
+    return query
+
+def get_ms_changes(cursor=0, limit=CHANGE_QUERY_LIMIT):
+    # Up to `limit` change records after `cursor` (an MSChange id, 0 for the
+    # start of the log), oldest first, and the cursor to pass next time. Not
+    # cached: every call is a primary key range scan.
+    query = committed_changes(MSChange.select().where(MSChange.id > cursor))
+    changes = [change.to_json for change in query.order_by(MSChange.id).limit(limit)]
+    return changes, changes[-1]["id"] if changes else cursor
+
+def get_ms_change_cursor():
+    # Cursor past every committed change, for a consumer that has just read
+    # the whole table and follows the log from there.
+    if not MSChange.table_exists():
+        return 0
+    return committed_changes(MSChange.select(peewee.fn.MAX(MSChange.id))).scalar() or 0
@@ -5,12 +5,89 @@ SETTINGS = {
         "database": "updater_db",
         "host": "localhost",
         "port": "5432",
+        "pool": {
+            "enabled": False,
+            "max_connections": 8,
+            "stale_timeout": 300,
+        },
     },
     "debug": True,
     "enable_extra_logging": True,
     "enable_results_logging": False,
     "enable_exception_logging": True,
-    "json_filename": "snyk.json",
     "drop_ms_table_before": True,
+    "write_batch_size": 1000,
+    "commit_batch_size": 10000,
+    "outcome_sample_size": 10,
+    "sync_mode": "snapshot",
+    "bulk_rebuild": True,
+    "rebuild_min_ratio": 0.5,
+    "rebuild_keep_legacy": True,
+    "parallel": {
+        "enabled": False,
+        "normalize_processes": 0,
+        "writer_connections": 4,
+    },
+    "async_pipeline": {
+        "queue_size": 8,
+    },
+    "ms_slot_storage": "columns",
+    "ms_lookup_storage": "text",
+    "partitioning": {
+        "enabled": False,
+        "interval": "year",
+        "premake": 1,
+        "retention_days": 0,
+        "published_date_index": "brin",
+    },
+    "stream_feed": True,
+    "stream_chunk_size": 65536,
+    "fetch_pages": True,
+    "fetch_page_size": 1000,
+    "fetch_concurrency": 4,
+    "fetch_timeout": 60,
+    "fetch_retries": 3,
+    "incremental_sync": True,
+    "incremental_overlap_days": 3,
+    "resume": {
+        "enabled": True,
+        "run_attempts": 3,
+        "db_retries": 3,
+        "backoff_seconds": 1.0,
+        "breaker_failures": 5,
+        "breaker_reset_seconds": 60,
+    },
+    "cache": {
+        "enabled": True,
+        "max_age_days": 7,
+        "compress_level": 6,
+    },
+    "change_log": {
+        "enabled": True,
+    },
+    "export": {
+        "batch_size": 5000,
+        "basename": "vilnerabilities_ms",
+    },
+    "query_cache": {
+        "enabled": True,
+        "max_entries": 10000,
+        "ttl_seconds": 300,
+        "version_check_seconds": 5,
+    },
+    "enrich": {
+        "detail_url": "https://portal.msrc.microsoft.com/en-US/security-guidance/advisory/{}",
+        "concurrency": 8,
+        "refresh_hours": 24,
+        "timeout": 30,
+        "browser": False,
+        "browser_pool_size": 2,
+    },
+    "metrics": {
+        "enabled": True,
+        "textfile": "",
+        "profile_stage": None,
+        "profile_mode": "cprofile",
+    },
     "undefined": "undefined"
 }
\ No newline at end of file
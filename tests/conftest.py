@@ -0,0 +1,99 @@
+import io
+import os
+import sys
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer
+
+import peewee
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import msparser
+from bench_ms import FeedHandler, make_details
+from copy_ms import STAGING_SUFFIX
+from model_ms import MS, MSChange, MSEnrichment, SyncState, database, pg_database
+
+# Tests using ms_database drop and recreate the MS tables, so they only run
+# against a scratch database named in MS_TEST_DATABASE (on the PG_HOST server).
+TEST_DATABASE = os.environ.get("MS_TEST_DATABASE")
+
+FEED_SIZE = msparser.fetch_page_size * 3 + msparser.fetch_page_size // 2
+
+
+class StandInFeedHandler(FeedHandler):
+    # FeedHandler that records the page numbers asked for, answers 400 for
+    # failing_pages and holds each page for delays[page] seconds while
+    # counting the requests in flight.
+    pages = []
+    failing_pages = set()
+    delays = dict()
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        page_number = int(json.loads(body).get("pageNumber", 1))
+        cls = type(self)
+        with cls.lock:
+            cls.pages.append(page_number)
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        # Counted down before answering: the client may send its next
+        # request as soon as it has the response.
+        time.sleep(self.delays.get(page_number, 0))
+        with cls.lock:
+            cls.in_flight -= 1
+        if page_number in self.failing_pages:
+            self.send_error(400)
+            return
+        self.rfile = io.BytesIO(body)
+        FeedHandler.do_POST(self)
+
+
+def drop_ms_tables():
+    msparser.connect_database()
+    database.execute_sql("DROP TABLE IF EXISTS {}".format(MS._meta.table_name + STAGING_SUFFIX))
+    for model in (MS, MSChange, MSEnrichment, SyncState):
+        model.drop_table(safe=True, cascade=True)
+    msparser.disconnect_database()
+
+
+@pytest.fixture
+def ms_database(monkeypatch):
+    if not TEST_DATABASE:
+        pytest.skip("MS_TEST_DATABASE is not set")
+    database.init(TEST_DATABASE)
+    try:
+        database.connect()
+    except peewee.OperationalError as ex:
+        database.init(pg_database)
+        pytest.skip("Cannot connect to {}: {}".format(TEST_DATABASE, ex))
+    database.close()
+    monkeypatch.setattr(msparser, "cache_enabled", False)
+    monkeypatch.setattr(msparser, "metrics_enabled", False)
+    monkeypatch.setattr(msparser, "drop_ms_table_before", False)
+    drop_ms_tables()
+    yield database
+    drop_ms_tables()
+    database.init(pg_database)
+
+@pytest.fixture
+def feed(monkeypatch):
+    # A local stand-in for the security-guidance feed serving FEED_SIZE
+    # synthetic records; msparser.SOURCE_FILE points at it.
+    StandInFeedHandler.details = make_details(FEED_SIZE)
+    StandInFeedHandler.pages = []
+    StandInFeedHandler.failing_pages = set()
+    StandInFeedHandler.delays = dict()
+    StandInFeedHandler.in_flight = 0
+    StandInFeedHandler.max_in_flight = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInFeedHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(msparser, "SOURCE_FILE", "http://127.0.0.1:{}/".format(server.server_address[1]))
+    yield StandInFeedHandler
+    server.shutdown()
+    server.server_close()
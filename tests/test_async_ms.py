@@ -0,0 +1,36 @@
+from datetime import datetime
+
+import pytest
+
+from async_ms import asyncpg_rows
+from msparser import parse_published_date
+
+
+def test_asyncpg_rows_parses_feed_dates():
+    rows = asyncpg_rows({"key": {"cve_number": "CVE-2018-0001", "published_date": "2018-01-09T08:00:00Z"}})
+    assert rows["key"]["published_date"] == datetime(2018, 1, 9, 8, 0, 0)
+
+def test_asyncpg_rows_keeps_datetimes():
+    published_date = datetime(2018, 1, 9)
+    rows = asyncpg_rows({"key": {"cve_number": "CVE-2018-0001", "published_date": published_date}})
+    assert rows["key"]["published_date"] is published_date
+
+def test_asyncpg_rows_never_leaves_null_dates():
+    before = datetime.utcnow()
+    rows = asyncpg_rows({"key": {"cve_number": "CVE-2018-0001", "published_date": "not a date"}})
+    assert before <= rows["key"]["published_date"] <= datetime.utcnow()
+
+@pytest.mark.parametrize("published_date, expected", [
+    ("2018-01-09T08:00:00", datetime(2018, 1, 9, 8, 0, 0)),
+    ("2018-01-09T08:00:00Z", datetime(2018, 1, 9, 8, 0, 0)),
+    ("2018-01-09T08:00:00.25Z", datetime(2018, 1, 9, 8, 0, 0, 250000)),
+    ("2018-01-09T08:00:00.123456", datetime(2018, 1, 9, 8, 0, 0, 123456)),
+    ("2018-01-09T08:00:00+02:00", datetime(2018, 1, 9, 6, 0, 0)),
+    ("2018-01-09T23:30:00.5-01:00", datetime(2018, 1, 10, 0, 30, 0, 500000)),
+    ("2018-01-09", datetime(2018, 1, 9)),
+    ("undefined", None),
+    ("", None),
+    (None, None),
+])
+def test_parse_published_date(published_date, expected):
+    assert parse_published_date(published_date) == expected
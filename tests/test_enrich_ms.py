@@ -0,0 +1,170 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import enrich_ms
+from enrich_ms import enrich_advisory, parse_advisory_html, save_enrichments
+from model_ms import MSEnrichment
+from msparser import connect_database, disconnect_database, msbulletin_session
+
+ADVISORY_ID = "CVE-2018-0802"
+LAST_MODIFIED = "Tue, 09 Jan 2018 08:00:00 GMT"
+
+ADVISORY_PAGE = """<!DOCTYPE html>
+<html><head><title>Security Update Guide</title></head>
+<body>
+<div class="advisory">
+  <h1>CVE-2018-0802 | Microsoft Office
+      Memory Corruption Vulnerability</h1>
+  <p>Security Vulnerability</p>
+  <p>Published: 01/09/2018 | Last Updated : Jan 30, 2018</p>
+  <h2>Executive Summary</h2>
+  <p>A remote code execution vulnerability exists in Microsoft Office.</p>
+  <h2>FAQ</h2>
+  <p>Is the Preview Pane an attack vector?</p>
+  <ul><li>No, the Preview Pane is not an attack vector.</li></ul>
+  <h2>Acknowledgements:</h2>
+  <p>Yang Kang of Qihoo 360</p>
+  <h3>Disclaimer</h3>
+  <p>The information provided in the Microsoft Knowledge Base is provided "as is".</p>
+</div>
+</body></html>
+"""
+
+PARSED = dict(
+    title="CVE-2018-0802 | Microsoft Office Memory Corruption Vulnerability",
+    published="01/09/2018",
+    last_updated="Jan 30, 2018",
+    faq="Is the Preview Pane an attack vector? No, the Preview Pane is not an attack vector.",
+    acknowledgements="Yang Kang of Qihoo 360",
+    disclaimer='The information provided in the Microsoft Knowledge Base is provided "as is".')
+
+
+class AdvisoryHandler(BaseHTTPRequestHandler):
+    # Serves ADVISORY_PAGE for every path with last_modified as Last-Modified;
+    # with not_modified, answers 304 to a matching If-Modified-Since.
+    page = ADVISORY_PAGE
+    last_modified = LAST_MODIFIED
+    not_modified = True
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("If-Modified-Since")))
+        if self.not_modified and self.headers.get("If-Modified-Since") == self.last_modified:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = self.page.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if self.last_modified:
+            self.send_header("Last-Modified", self.last_modified)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def advisory_server():
+    AdvisoryHandler.page = ADVISORY_PAGE
+    AdvisoryHandler.last_modified = LAST_MODIFIED
+    AdvisoryHandler.not_modified = True
+    AdvisoryHandler.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), AdvisoryHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:{}/advisory/{{}}".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def parse_calls(monkeypatch):
+    calls = []
+
+    def counting_parse(html):
+        calls.append(html)
+        return parse_advisory_html(html)
+
+    monkeypatch.setattr(enrich_ms, "parse_advisory_html", counting_parse)
+    return calls
+
+def stored(**fields):
+    return MSEnrichment(advisory_id=ADVISORY_ID, **fields)
+
+
+def test_parse_advisory_html():
+    assert parse_advisory_html(ADVISORY_PAGE) == PARSED
+
+def test_parse_unrendered_page():
+    details = parse_advisory_html("<html><body><div id='root'></div></body></html>")
+    assert details == dict((field, "") for field in enrich_ms.ENRICH_FIELDS)
+
+def test_enrich_advisory_parses_page(advisory_server):
+    details = enrich_advisory(ADVISORY_ID, None, msbulletin_session(), detail_url=advisory_server)
+    assert details == dict(PARSED, advisory_id=ADVISORY_ID, last_modified=LAST_MODIFIED, source="http")
+    assert AdvisoryHandler.requests == [("/advisory/" + ADVISORY_ID, None)]
+
+def test_not_modified_skips_parse(advisory_server, parse_calls):
+    details = enrich_advisory(ADVISORY_ID, stored(last_modified=LAST_MODIFIED), msbulletin_session(),
+                              detail_url=advisory_server)
+    assert details is None
+    assert AdvisoryHandler.requests == [("/advisory/" + ADVISORY_ID, LAST_MODIFIED)]
+    assert parse_calls == []
+
+def test_unchanged_last_modified_skips_parse(advisory_server, parse_calls):
+    # A server that ignores If-Modified-Since but sends the same Last-Modified.
+    AdvisoryHandler.not_modified = False
+    details = enrich_advisory(ADVISORY_ID, stored(last_modified=LAST_MODIFIED), msbulletin_session(),
+                              detail_url=advisory_server)
+    assert details is None
+    assert parse_calls == []
+
+def test_changed_last_modified_is_parsed(advisory_server, parse_calls):
+    AdvisoryHandler.last_modified = "Tue, 30 Jan 2018 08:00:00 GMT"
+    details = enrich_advisory(ADVISORY_ID, stored(last_modified=LAST_MODIFIED), msbulletin_session(),
+                              detail_url=advisory_server)
+    assert details["last_modified"] == "Tue, 30 Jan 2018 08:00:00 GMT"
+    assert len(parse_calls) == 1
+
+def test_unchanged_last_updated_without_header(advisory_server):
+    AdvisoryHandler.last_modified = ""
+    session = msbulletin_session()
+    assert enrich_advisory(ADVISORY_ID, stored(last_updated="Jan 30, 2018"), session, detail_url=advisory_server) is None
+    assert enrich_advisory(ADVISORY_ID, stored(last_updated="Jan 9, 2018"), session, detail_url=advisory_server)
+
+
+def test_save_enrichments_is_idempotent(ms_database):
+    connect_database()
+    MSEnrichment.create_table(safe=True)
+    row = dict(PARSED, advisory_id=ADVISORY_ID, last_modified=LAST_MODIFIED, source="http")
+
+    def stored_rows():
+        return [dict((field, getattr(enrichment, field)) for field in row) for enrichment in MSEnrichment.select()]
+
+    save_enrichments([dict(row)], [])
+    first_id = MSEnrichment.get().id
+    save_enrichments([dict(row)], [])
+    assert stored_rows() == [row]
+    save_enrichments([dict(row, faq="Revised FAQ")], [])
+    assert stored_rows() == [dict(row, faq="Revised FAQ")]
+    assert MSEnrichment.get().id == first_id
+    disconnect_database()
+
+def test_enrich_ms_skips_upsert_when_not_modified(ms_database, advisory_server, parse_calls):
+    assert enrich_ms.enrich_ms([ADVISORY_ID], concurrency=2, detail_url=advisory_server) == (1, 0, 0)
+    connect_database()
+    first = MSEnrichment.get(MSEnrichment.advisory_id == ADVISORY_ID)
+    disconnect_database()
+    assert (first.title, first.faq, first.last_modified) == (PARSED["title"], PARSED["faq"], LAST_MODIFIED)
+
+    # refresh_hours=0 checks it again: the 304 only moves checked.
+    assert enrich_ms.enrich_ms([ADVISORY_ID], concurrency=2, detail_url=advisory_server, refresh_hours=0) == (0, 1, 0)
+    assert len(parse_calls) == 1
+    connect_database()
+    second = MSEnrichment.get(MSEnrichment.advisory_id == ADVISORY_ID)
+    disconnect_database()
+    assert second.changed == first.changed
+    assert second.checked > first.checked
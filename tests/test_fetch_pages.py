@@ -0,0 +1,75 @@
+import msparser
+from bench_ms import make_details
+from msparser import iter_msbulletin_pages, msbulletin_session
+
+PAGE_SIZE = 50
+PAGES = 11
+
+
+def fetch(feed, concurrency=3, **kwargs):
+    meta = dict()
+    items = list(iter_msbulletin_pages(msparser.SOURCE_FILE, meta=meta, page_size=PAGE_SIZE, concurrency=concurrency,
+                                       session=msbulletin_session(concurrency), **kwargs))
+    return items, meta
+
+def page_of(feed, item_in_details):
+    return feed.details.index(item_in_details) // PAGE_SIZE + 1
+
+def page_runs(feed, items):
+    # The page of each run of consecutive records from the same page.
+    runs = []
+    for item_in_details in items:
+        page_number = page_of(feed, item_in_details)
+        if not runs or runs[-1] != page_number:
+            runs.append(page_number)
+    return runs
+
+
+def test_pages_come_back_whole_and_in_order(feed):
+    feed.details = make_details(PAGE_SIZE * (PAGES - 1) + 20)
+    # Early pages answer last, so pages arrive out of order.
+    feed.delays = dict((page_number, 0.02 * (PAGES - page_number)) for page_number in range(2, PAGES + 1))
+    items, meta = fetch(feed)
+    runs = page_runs(feed, items)
+    # Every page's records come back together and in feed order, page 1
+    # (fetched alone for the count) first.
+    assert sorted(runs) == list(range(1, PAGES + 1))
+    assert runs[0] == 1 and runs != sorted(runs)
+    assert sorted(items, key=feed.details.index) == feed.details
+    for page_number in runs:
+        page = [item_in_details for item_in_details in items if page_of(feed, item_in_details) == page_number]
+        assert page == feed.details[(page_number - 1) * PAGE_SIZE:page_number * PAGE_SIZE]
+    assert meta["count"] == len(feed.details)
+    assert meta["pages_done"] == runs
+    assert meta["failed_pages"] == []
+
+def test_requests_in_flight_stay_within_concurrency(feed):
+    feed.details = make_details(PAGE_SIZE * PAGES)
+    feed.delays = dict((page_number, 0.05) for page_number in range(2, PAGES + 1))
+    items, _ = fetch(feed, concurrency=3)
+    assert len(items) == len(feed.details)
+    assert feed.max_in_flight == 3
+
+def test_failed_pages_are_reported(feed):
+    feed.details = make_details(PAGE_SIZE * PAGES)
+    feed.failing_pages = {4, 7}
+    items, meta = fetch(feed)
+    assert sorted(meta["failed_pages"]) == [4, 7]
+    assert sorted(meta["pages_done"]) == [page_number for page_number in range(1, PAGES + 1) if page_number not in (4, 7)]
+    assert set(page_runs(feed, items)) == set(meta["pages_done"])
+
+def test_failed_first_page_stops_fetch(feed):
+    feed.details = make_details(PAGE_SIZE * PAGES)
+    feed.failing_pages = {1}
+    items, meta = fetch(feed)
+    assert items == []
+    assert meta["failed_pages"] == [1]
+    assert feed.pages == [1]
+
+def test_skip_pages_are_not_fetched(feed):
+    feed.details = make_details(PAGE_SIZE * PAGES)
+    items, meta = fetch(feed, skip_pages=[1, 3, 5], skip_count=len(feed.details))
+    # Page 1 is still asked for the count, but its records are not yielded.
+    assert sorted(feed.pages) == [1, 2, 4] + list(range(6, PAGES + 1))
+    assert sorted(set(page_runs(feed, items))) == [2, 4] + list(range(6, PAGES + 1))
+    assert sorted(meta["pages_done"]) == [2, 4] + list(range(6, PAGES + 1))
@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+from msparser import iter_json_array_items, iter_json_field_items
+
+# Every JSON token type: strings with escapes and a surrogate pair, integers,
+# fractions and exponents of both signs, literals, nested and empty
+# containers, and whitespace between tokens.
+DOCUMENT = (
+    '{"count": 3, "ratio": -12.5e-3, "next": null,\n'
+    ' "details": [\n'
+    '  {"cveNumber": "CVE-2018-0001", "name": "Windows \\"10\\"\\n\\u00e9\\ud83d\\ude00", "impactId": 1,\n'
+    '   "score": 7.25, "big": 1E+21, "zero": 0, "negative": -40, "flags": [true, false, null], "empty": {}},\n'
+    '  {"cveNumber": "CVE-2018-0002", "platform": null, "urls": [], "nested": {"a": [1, [2.0, {"b": "c"}]]}},\n'
+    '  12345, 6.02e23, "text", true, false, null\n'
+    ' ],\n'
+    ' "trailer": {"ok": true}}'
+)
+
+
+def split(text, *positions):
+    bounds = (0, ) + positions + (len(text), )
+    return [text[start:end] for start, end in zip(bounds, bounds[1:])]
+
+def expected():
+    data = json.loads(DOCUMENT)
+    details = data.pop("details")
+    return details, data
+
+
+@pytest.mark.parametrize("position", range(1, len(DOCUMENT)))
+def test_field_items_split_anywhere(position):
+    details, rest = expected()
+    meta = dict()
+    assert list(iter_json_field_items(split(DOCUMENT, position), "details", meta)) == details
+    assert meta == rest
+
+def test_field_items_one_character_chunks():
+    details, rest = expected()
+    meta = dict()
+    assert list(iter_json_field_items(list(DOCUMENT), "details", meta)) == details
+    assert meta == rest
+
+@pytest.mark.parametrize("chunks, items", [
+    (["[1", "2]"], [12]),
+    (["[1.", "5]"], [1.5]),
+    (["[1.5e", "3]"], [1500.0]),
+    (["[1.5e-", "3, 2]"], [0.0015, 2]),
+    (["[-", "7]"], [-7]),
+    (["[1.5", "]"], [1.5]),
+    (["[1", "", ".", "25", "]"], [1.25]),
+    (["[tr", "ue, nu", "ll]"], [True, None]),
+    (['["a\\', 'u00e9"]'], ["aé"]),
+    (["[]"], []),
+])
+def test_array_items_number_and_literal_boundaries(chunks, items):
+    assert list(iter_json_array_items(chunks)) == items
+
+def test_truncated_input_raises():
+    with pytest.raises(ValueError):
+        list(iter_json_array_items(["[1, 2"]))
+    with pytest.raises(ValueError):
+        list(iter_json_field_items(['{"details": [{"a": 1}'], "details"))
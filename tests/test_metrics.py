@@ -0,0 +1,41 @@
+import metrics_ms
+from metrics_ms import SyncMetrics, measure_iter, measure_stage, prometheus_text
+
+MB = 1024 * 1024
+
+
+def test_stage_rss_is_growth_not_process_peak(monkeypatch):
+    # The peak RSS grows by 10MB in fetch and by 30MB in normalize, and is
+    # flat in write.
+    peak = [500 * MB]
+    monkeypatch.setattr(metrics_ms, "peak_rss_bytes", lambda: peak[0])
+
+    def fetch():
+        for item in range(3):
+            if item:
+                peak[0] += 5 * MB
+            yield item
+
+    with SyncMetrics("test", profile_stage=None) as metrics:
+        for item in measure_iter("fetch", fetch()):
+            with measure_stage("normalize"):
+                peak[0] += 10 * MB
+        with measure_stage("write", rows=3):
+            pass
+    data = metrics.to_json(status="success")
+    assert data["stages"]["fetch"]["rss_growth_bytes"] == 10 * MB
+    assert data["stages"]["normalize"]["rss_growth_bytes"] == 30 * MB
+    assert data["stages"]["write"]["rss_growth_bytes"] == 0
+    assert data["peak_rss_bytes"] == 540 * MB
+    assert "peak_rss_bytes" not in data["stages"]["fetch"]
+
+def test_prometheus_stage_rss_growth(monkeypatch):
+    peak = [100 * MB]
+    monkeypatch.setattr(metrics_ms, "peak_rss_bytes", lambda: peak[0])
+    with SyncMetrics("test", profile_stage=None) as metrics:
+        with measure_stage("write"):
+            peak[0] += MB
+    text = prometheus_text(metrics.to_json(status="success"))
+    assert 'msbulletin_sync_stage_rss_growth_bytes{{source="test",stage="write"}} {}'.format(MB) in text
+    assert 'msbulletin_sync_peak_rss_bytes{{source="test"}} {}'.format(101 * MB) in text
+    assert "stage_peak_rss_bytes" not in text
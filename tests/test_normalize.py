@@ -0,0 +1,68 @@
+import pytest
+
+from bench_ms import legacy_normalize_ms_item, make_details
+from model_ms import FINGERPRINT_FIELDS, ms_fingerprint
+from msparser import MS_COLUMNS, MS_FIELD_MAP, compile_ms_normalizer, normalize_ms_item, undefined
+
+# Records that hit every branch of the legacy blocks: missing keys, nulls,
+# empty strings, URLs with spaces, non-string values and non-ASCII text.
+EDGE_CASES = [
+    {},
+    {"cveNumber": None, "name": None, "platform": None, "family": None, "knowledgeBaseUrl": None},
+    {"cveNumber": "", "name": "", "platform": "", "family": "", "impact": "", "severityId": "",
+     "knowledgeBaseId": "", "articleTitle1": "", "downloadTitle2": ""},
+    {"cveNumber": "CVE-2018-0001", "impactId": 0, "severityId": 3, "knowledgeBaseId": 4056890,
+     "knowledgeBaseUrl": "https://support.microsoft.com/help/4056890",
+     "monthlyKnowledgeBaseUrl": "Monthly Rollup", "articleUrl1": "https://x/1", "articleUrl2": "see notes",
+     "downloadUrl1": "Security Update", "downloadUrl4": "https://catalog/4"},
+    {"cveNumber": "CVE-2018-0002", "name": "Windows 10 für x64", "platform": "x64-based Systems",
+     "family": "Windows", "impact": "Élévation de privilèges", "articleTitle4": "Mise à jour",
+     "downloadTitle3": "\x1f", "publishedDate": "2018-01-09T08:00:00Z"},
+]
+
+DETAILS = make_details(100) + EDGE_CASES
+
+
+def legacy_record(item_in_details):
+    # The legacy blocks with their inverted download_title1 check corrected,
+    # which is the one intended difference of MS_FIELD_MAP.
+    item_in_json = legacy_normalize_ms_item(item_in_details)
+    title = item_in_details.get("downloadTitle1")
+    item_in_json["download_title1"] = undefined if title is None or title == "" else title
+    return item_in_json
+
+
+@pytest.mark.parametrize("item_in_details", DETAILS)
+def test_normalize_matches_legacy(item_in_details):
+    record = normalize_ms_item(item_in_details)._asdict()
+    assert record.pop("fingerprint") == ms_fingerprint(record)
+    assert record == legacy_record(item_in_details)
+
+@pytest.mark.parametrize("item_in_details", DETAILS)
+def test_fingerprint_matches_legacy(item_in_details):
+    assert normalize_ms_item(item_in_details).fingerprint == ms_fingerprint(legacy_record(item_in_details))
+
+def test_download_title1_is_kept():
+    assert legacy_normalize_ms_item({"downloadTitle1": "Security Update"})["download_title1"] == undefined
+    assert normalize_ms_item({"downloadTitle1": "Security Update"}).download_title1 == "Security Update"
+    assert normalize_ms_item({"downloadTitle1": ""}).download_title1 == undefined
+
+def test_record_columns():
+    assert normalize_ms_item.record_type._fields == MS_COLUMNS
+    assert set(FINGERPRINT_FIELDS) <= set(MS_COLUMNS)
+
+def test_fingerprint_ignores_published_date():
+    item_in_details = dict(DETAILS[0])
+    fingerprint = normalize_ms_item(item_in_details).fingerprint
+    item_in_details["publishedDate"] = "1999-12-31T00:00:00"
+    assert normalize_ms_item(item_in_details).fingerprint == fingerprint
+
+def test_fingerprint_changes_with_content():
+    item_in_details = dict(DETAILS[0])
+    fingerprint = normalize_ms_item(item_in_details).fingerprint
+    item_in_details["severity"] = item_in_details["severity"] + " (revised)"
+    assert normalize_ms_item(item_in_details).fingerprint != fingerprint
+
+def test_unknown_rule():
+    with pytest.raises(ValueError):
+        compile_ms_normalizer(MS_FIELD_MAP + (("extra", "extra", "trim"), ))
@@ -0,0 +1,127 @@
+import gzip
+import json
+
+import pytest
+
+import msparser
+from bench_ms import make_details
+from copy_ms import STAGING_SUFFIX, RebuildRefusedError, rebuild_ms_table
+from model_ms import MS, MSChange, SyncState, database
+from msparser import LEGACY_SOURCE_NAME, load_ms_snapshot, ms_natural_key, normalize_ms_item
+
+
+def feed_records(count, seed=0):
+    return [normalize_ms_item(item_in_details) for item_in_details in make_details(count, seed)]
+
+def stored_fingerprints():
+    return dict((key, fingerprint) for key, (_, fingerprint) in load_ms_snapshot().items())
+
+def expected_fingerprints(records):
+    # The last record of a repeated natural key wins.
+    return dict((ms_natural_key(record), record.fingerprint) for record in records)
+
+def staging_exists():
+    msparser.connect_database()
+    return database.table_exists(MS._meta.table_name + STAGING_SUFFIX)
+
+
+@pytest.fixture
+def live_table(ms_database):
+    records = feed_records(1000)
+    msparser.connect_database()
+    rebuild_ms_table(iter(records))
+    yield records
+    msparser.disconnect_database()
+
+
+def test_rebuild_replaces_table(live_table):
+    records = feed_records(1500, seed=1)
+    loaded, duplicates, _ = rebuild_ms_table(iter(records))
+    expected = expected_fingerprints(records)
+    assert loaded == len(records)
+    assert loaded - duplicates == len(expected)
+    assert stored_fingerprints() == expected
+    assert not staging_exists()
+
+def test_rebuild_keeps_last_duplicate(ms_database):
+    item_in_details = make_details(1)[0]
+    records = feed_records(100) + [normalize_ms_item(dict(item_in_details, severity="Low"))]
+    msparser.connect_database()
+    loaded, duplicates, _ = rebuild_ms_table(iter(records))
+    assert duplicates >= 1
+    assert stored_fingerprints()[ms_natural_key(records[-1])] == records[-1].fingerprint
+
+def test_incomplete_rebuild_keeps_table(live_table):
+    assert rebuild_ms_table(iter(feed_records(500, seed=1)), complete=lambda: False) is None
+    assert stored_fingerprints() == expected_fingerprints(live_table)
+    assert not staging_exists()
+
+def test_rebuild_copies_escaped_text(ms_database):
+    name = "Windows\t10\\n\r\nVersion 1709 für x64"
+    record = normalize_ms_item(dict(make_details(1)[0], name=name, family=None))
+    msparser.connect_database()
+    rebuild_ms_table(iter([record]))
+    stored = MS.select().get()
+    assert (stored.name, stored.family, stored.fingerprint) == (name, record.family, record.fingerprint)
+
+def test_rebuild_refuses_empty_load(live_table):
+    with pytest.raises(RebuildRefusedError):
+        rebuild_ms_table(iter(()), min_ratio=0.5)
+    assert stored_fingerprints() == expected_fingerprints(live_table)
+    assert not staging_exists()
+
+def test_rebuild_refuses_truncated_load(live_table):
+    with pytest.raises(RebuildRefusedError):
+        rebuild_ms_table(iter(feed_records(300, seed=1)), min_ratio=0.5)
+    assert stored_fingerprints() == expected_fingerprints(live_table)
+    assert not staging_exists()
+
+def test_forced_rebuild_swaps_truncated_load(live_table):
+    records = feed_records(300, seed=1)
+    rebuild_ms_table(iter(records), min_ratio=0)
+    assert stored_fingerprints() == expected_fingerprints(records)
+
+@pytest.mark.parametrize("change_log", [False, True])
+def test_load_counts_changes_against_live_table(live_table, monkeypatch, change_log):
+    monkeypatch.setattr(msparser, "change_log_enabled", change_log)
+    details = make_details(1000)[10:] + make_details(50, seed=1)
+    for item_in_details in details[:30]:
+        item_in_details["severity"] = "Low"
+    old = expected_fingerprints(live_table)
+    new = expected_fingerprints(map(normalize_ms_item, details))
+    created = len(set(new) - set(old))
+    modified = len([key for key in set(new) & set(old) if new[key] != old[key]])
+    unchanged = len(set(new) & set(old)) - modified
+    assert created and modified and unchanged
+
+    stats = msparser.load_ms_items(iter(details))
+    assert tuple(stats) == (created, modified, unchanged + len(details) - len(new))
+    assert stored_fingerprints() == new
+    if change_log:
+        removed = len(set(old) - set(new))
+        assert MSChange.select().count() == created + modified + removed
+
+def test_rebuild_keeps_legacy_rows(ms_database, tmp_path):
+    legacy = make_details(200, seed=7)
+    path = str(tmp_path / "legacy.json.gz")
+    with gzip.open(path, "wt", encoding="utf-8") as archive:
+        archive.writelines(json.dumps(item_in_details) + "\n" for item_in_details in legacy)
+    msparser.import_legacy_bulletins(path)
+    details = make_details(1000, seed=1)
+    msparser.load_ms_items(iter(details))
+    # Feed rows win over legacy rows with the same natural key.
+    expected = expected_fingerprints(map(normalize_ms_item, legacy))
+    expected.update(expected_fingerprints(map(normalize_ms_item, details)))
+    assert stored_fingerprints() == expected
+
+def test_rebuild_refuses_missing_legacy_archive(live_table, tmp_path):
+    msparser.create_sync_state_table()
+    msparser.connect_database()
+    SyncState.create(source=LEGACY_SOURCE_NAME, mode="import", from_date=str(tmp_path / "missing.gz"), status="success")
+    details = make_details(1000, seed=1)
+    with pytest.raises(RebuildRefusedError):
+        msparser.load_ms_items(iter(details))
+    assert stored_fingerprints() == expected_fingerprints(live_table)
+
+    msparser.load_ms_items(iter(details), force_rebuild=True)
+    assert stored_fingerprints() == expected_fingerprints(map(normalize_ms_item, details))
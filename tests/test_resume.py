@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+import msparser
+from bench_ms import make_details
+from model_ms import SyncState
+from msparser import fetch_page_size, load_ms_snapshot, ms_natural_key, normalize_ms_item
+
+
+def sync_states():
+    msparser.connect_database()
+    states = list(SyncState.select().where(SyncState.source == msparser.SOURCE_NAME).order_by(SyncState.id))
+    msparser.disconnect_database()
+    return states
+
+def feed_keys(details):
+    return set(ms_natural_key(normalize_ms_item(item_in_details)) for item_in_details in details)
+
+
+def test_resume_fetches_only_unfinished_pages(ms_database, feed):
+    feed.failing_pages = {3}
+    assert msparser.run(full_sync=True)["status"] == "failed"
+    interrupted = sync_states()[-1]
+    assert interrupted.status == "failed"
+    assert json.loads(interrupted.checkpoint)["pages"] == [1, 2, 4]
+    assert set(load_ms_snapshot()) == feed_keys(feed.details[:2 * fetch_page_size] + feed.details[3 * fetch_page_size:])
+
+    feed.failing_pages = set()
+    feed.pages = []
+    assert msparser.run(full_sync=True)["status"] == "success"
+    resumed = sync_states()[-1]
+    # Page 1 is always fetched for the feed count.
+    assert sorted(feed.pages) == [1, 3]
+    assert resumed.status == "success"
+    assert resumed.resumed_from == interrupted.id
+    assert json.loads(resumed.checkpoint)["pages"] == [1, 2, 3, 4]
+    assert set(load_ms_snapshot()) == feed_keys(feed.details)
+
+def test_resume_refetches_shifted_feed(ms_database, feed):
+    feed.failing_pages = {2}
+    msparser.run(full_sync=True)
+    assert sync_states()[-1].status == "failed"
+
+    feed.details = make_details(len(feed.details) + 100)
+    feed.failing_pages = set()
+    feed.pages = []
+    msparser.run(full_sync=True)
+    assert sorted(feed.pages) == [1, 2, 3, 4]
+    assert sync_states()[-1].status == "success"
+    assert set(load_ms_snapshot()) == feed_keys(feed.details)
+
+def test_main_exits_nonzero_on_failed_pages(ms_database, feed, monkeypatch):
+    monkeypatch.setattr("sys.argv", ["msparser.py", "--full"])
+    feed.failing_pages = {2}
+    with pytest.raises(SystemExit) as exit_info:
+        msparser.main()
+    assert exit_info.value.code == 1
+
+    feed.failing_pages = set()
+    msparser.main()
+    assert sync_states()[-1].status == "success"
+
+def test_failed_run_keeps_committed_checkpoint(ms_database):
+    msparser.create_sync_state_table()
+    state = msparser.start_sync_state("full", msparser.FULL_SYNC_FROM_DATE)
+    msparser.SyncCheckpoint(state).save(dict(count=1000, pages_done=[2, 1]))
+    # An in-memory checkpoint whose transaction never committed.
+    state.checkpoint = json.dumps(dict(pages=[1, 2, 3]))
+    msparser.finish_sync_state(state, None)
+    msparser.connect_database()
+    stored = SyncState.get_by_id(state.id)
+    msparser.disconnect_database()
+    assert stored.status == "failed"
+    assert json.loads(stored.checkpoint)["pages"] == [1, 2]